@@ -0,0 +1,5 @@
+"""Benchmarks for measuring how Botfriend performs.
+
+These aren't part of the test suite, since their results depend on the
+machine they're run on. Run them through the scripts in bin/.
+"""
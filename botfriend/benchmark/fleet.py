@@ -0,0 +1,185 @@
+"""Build a large, realistic set of bots to benchmark against.
+
+generate_fleet() creates a configuration directory full of bots that
+use FleetBot and the simulated publisher, and fills botfriend.sqlite
+with their archives: published posts (some of which failed on their
+last attempt), scheduled posts, attachments and backlogs. It also
+writes input files for the backlog and scheduled post loaders.
+"""
+import datetime
+import json
+import os
+import random
+
+import yaml
+
+from botfriend.benchmark.simulated import SimulatedPublisher
+from botfriend.bot import (
+    Publisher,
+    ScriptedBot,
+    TextGeneratorBot,
+)
+from botfriend.model import (
+    _now,
+    Attachment,
+    BacklogItem,
+    BotModel,
+    content_digest,
+    Post,
+    production_session,
+    Publication,
+    TIME_FORMAT,
+)
+
+class FleetBot(TextGeneratorBot, ScriptedBot):
+    """Generates meaningless text on demand, and can also load
+    scheduled posts from a file.
+    """
+
+    def generate_text(self):
+        return "%s says %08x" % (self.name, random.getrandbits(32))
+
+    def load_publisher(self, module, config):
+        if module == 'simulated':
+            return Publisher.from_config(
+                self, module, config, publisher_class=SimulatedPublisher
+            )
+        return super(FleetBot, self).load_publisher(module, config)
+
+
+BOT_CODE = "from botfriend.benchmark.fleet import FleetBot as Bot\n"
+
+# Input files written into each bot's directory.
+BACKLOG_FILE = "backlog.txt"
+SCHEDULE_FILE = "schedule.json"
+
+def generate_fleet(directory, bots=50, posts=1000, backlog=100,
+                   scheduled=10, attachment_rate=0.05, error_rate=0.05,
+                   latency=0.0, seed=0):
+    """Create a configuration directory full of bots.
+
+    :param bots: Create this many bots.
+    :param posts: Give each bot this many published posts.
+    :param backlog: Give each bot this many backlog items, and write
+        this many more into its backlog input file.
+    :param scheduled: Give each bot this many scheduled posts, and
+        write this many more into its schedule input file.
+    :param attachment_rate: This proportion of posts have an attachment.
+    :param error_rate: This proportion of publications failed, both in
+        the archive and when the simulated publisher is used.
+    :param latency: The simulated publisher takes this many seconds
+        to publish a post.
+    :param seed: Seed for the random number generator, so the same
+        arguments always produce the same fleet.
+    :return: A list of the bots' names.
+    """
+    rand = random.Random(seed)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    open(os.path.join(directory, '__init__.py'), 'w').close()
+    _db = production_session(os.path.join(directory, 'botfriend.sqlite'))
+    connection = _db.connection()
+    now = _now()
+    names = []
+    post_id = (_db.query(Post.id).order_by(Post.id.desc()).limit(1).scalar()
+               or 0)
+    for i in range(bots):
+        name = "fleet%04d" % i
+        names.append(name)
+        _write_bot(directory, name, i, latency, error_rate, backlog,
+                   scheduled, now)
+        bot = BotModel(name=name)
+        _db.add(bot)
+        _db.flush()
+
+        post_rows = []
+        publication_rows = []
+        attachment_rows = []
+        for j in range(posts + scheduled):
+            post_id += 1
+            content = "%s post %d" % (name, j)
+            if j < posts:
+                publish_at = now - datetime.timedelta(
+                    minutes=60 * (posts - j)
+                )
+            else:
+                publish_at = now + datetime.timedelta(
+                    minutes=60 * (j - posts + 1)
+                )
+            post_rows.append(dict(
+                id=post_id, bot_id=bot.id, created=publish_at,
+                publish_at=publish_at, content=content,
+                content_hash=content_digest(content), buffered=False,
+            ))
+            size = len(content)
+            if rand.random() < attachment_rate:
+                media = os.urandom(rand.randint(1024, 16 * 1024))
+                size += len(media)
+                attachment_rows.append(dict(
+                    post_id=post_id, media_type="image/png", content=media,
+                ))
+            if j >= posts:
+                # Scheduled for the future; not published yet.
+                continue
+            publication = dict(
+                post_id=post_id, service="simulated", first_attempt=publish_at,
+                most_recent_attempt=publish_at, attempts=1, error=None,
+                error_class=None, next_retry_at=None, external_id=None,
+                duration=latency, requests=1, bytes_sent=size,
+            )
+            if rand.random() < error_rate:
+                publication.update(
+                    error="Simulated failure",
+                    error_class=Publication.TRANSIENT,
+                    next_retry_at=publish_at + datetime.timedelta(minutes=1),
+                )
+            else:
+                publication['external_id'] = "simulated-%d" % post_id
+            publication_rows.append(publication)
+
+        backlog_rows = [
+            dict(bot_id=bot.id, position=k,
+                 payload=json.dumps("%s backlog item %d" % (name, k)))
+            for k in range(backlog)
+        ]
+        for table, rows in (
+            (Post.__table__, post_rows),
+            (Publication.__table__, publication_rows),
+            (Attachment.__table__, attachment_rows),
+            (BacklogItem.__table__, backlog_rows),
+        ):
+            if rows:
+                connection.execute(table.insert(), rows)
+    _db.commit()
+    _db.close()
+    return names
+
+
+def _write_bot(directory, name, i, latency, error_rate, backlog, scheduled,
+               now):
+    """Write a bot's configuration, code, and input files."""
+    bot_directory = os.path.join(directory, name)
+    if not os.path.exists(bot_directory):
+        os.makedirs(bot_directory)
+    config = dict(
+        name=name,
+        schedule=60,
+        publish=dict(
+            simulated=dict(latency=latency, error_rate=error_rate, seed=i)
+        ),
+    )
+    with open(os.path.join(bot_directory, 'bot.yaml'), 'w') as out:
+        yaml.safe_dump(config, out, default_flow_style=False)
+    with open(os.path.join(bot_directory, '__init__.py'), 'w') as out:
+        out.write(BOT_CODE)
+    with open(os.path.join(bot_directory, BACKLOG_FILE), 'w') as out:
+        for k in range(backlog):
+            out.write("%s loaded backlog item %d\n" % (name, k))
+    with open(os.path.join(bot_directory, SCHEDULE_FILE), 'w') as out:
+        for k in range(scheduled):
+            publish_at = now + datetime.timedelta(days=30, minutes=k)
+            out.write(json.dumps(dict(
+                content="%s loaded scheduled post %d" % (name, k),
+                publish_at=publish_at.strftime(TIME_FORMAT),
+                key="%s-scheduled-%d" % (name, k),
+            )) + "\n")
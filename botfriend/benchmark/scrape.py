@@ -0,0 +1,171 @@
+"""Compare the shared HTTP client with one-off requests.
+
+A local server serves a fixture RSS feed over keep-alive HTTP/1.1,
+gzipped for clients that ask for it. The feed is fetched the way
+ScraperBot used to fetch it, with a separate call to `requests.get()`
+each time, and then through HTTPClient. For each, we report how long
+the fetches took and how many connections the server had to accept.
+"""
+from argparse import ArgumentParser
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+import gzip
+import json
+import sys
+import threading
+import time
+
+from botfriend.scripts import Script
+from botfriend.web import HTTPClient
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves the same document in response to every request."""
+
+    protocol_version = "HTTP/1.1"
+
+    # The headers and body are sent separately; don't let the second
+    # write wait for the client to acknowledge the first.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(FixtureHandler, self).setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        body = self.server.body
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = self.server.compressed
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, body):
+        super(FixtureServer, self).__init__(('127.0.0.1', 0), FixtureHandler)
+        self.body = body
+        self.compressed = gzip.compress(body)
+        self.lock = threading.Lock()
+        self.connections = 0
+
+    @property
+    def url(self):
+        return "http://%s:%d/feed.xml" % self.server_address
+
+
+def fixture_feed(items):
+    """Make an RSS feed with the given number of items."""
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        '<rss version="2.0"><channel><title>Fixture</title>\n'
+    ]
+    for i in range(items):
+        parts.append(
+            '<item><guid>item-%d</guid><title>Item %d</title>'
+            '<link>https://example.com/%d</link>'
+            '<description>This is item number %d in the fixture feed.'
+            '</description></item>\n' % (i, i, i, i)
+        )
+    parts.append('</channel></rss>\n')
+    return "".join(parts).encode("utf8")
+
+
+class ScrapeBenchmarkScript(Script):
+    """See how much the shared HTTP client saves over one-off requests."""
+
+    @classmethod
+    def parser(cls):
+        parser = ArgumentParser()
+        parser.add_argument(
+            '--requests', help="Fetch the feed this many times. (Default is 200)",
+            type=int, default=200
+        )
+        parser.add_argument(
+            '--items', help="Put this many items in the feed. (Default is 100)",
+            type=int, default=100
+        )
+        parser.add_argument(
+            '--json', help="Also write the results to this file."
+        )
+        return parser
+
+    def __init__(self, args=None):
+        self.args = args or self.parser().parse_args()
+
+    @classmethod
+    def run(cls):
+        instance = cls()
+        sys.exit(instance.benchmark())
+
+    def strategies(self):
+        """The ways of fetching the feed to compare.
+
+        :return: A list of (name, function) 2-tuples. Each function
+            takes a URL and returns the response body.
+        """
+        import requests
+        client = HTTPClient()
+        timeout = client.timeout
+        return [
+            ('one-off', lambda url: requests.get(url, timeout=timeout).content),
+            ('pooled', lambda url: client.get(url).content),
+        ]
+
+    def measure(self, server):
+        """Fetch the feed with each strategy.
+
+        :return: A dictionary mapping strategy names to dictionaries
+            of results.
+        """
+        results = {}
+        for name, fetch in self.strategies():
+            connections = server.connections
+            started = time.perf_counter()
+            for i in range(self.args.requests):
+                body = fetch(server.url)
+                if body != server.body:
+                    raise ValueError("Got the wrong document from %s" % name)
+            elapsed = time.perf_counter() - started
+            results[name] = dict(
+                seconds=round(elapsed, 3),
+                connections=server.connections - connections,
+            )
+        return results
+
+    def benchmark(self):
+        server = FixtureServer(fixture_feed(self.args.items))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            results = self.measure(server)
+        finally:
+            HTTPClient.close()
+            server.shutdown()
+            server.server_close()
+        for name, result in sorted(results.items()):
+            print("%s: %.3fs, %d connections (%.2fms per request)" % (
+                name, result['seconds'], result['connections'],
+                1000 * result['seconds'] / self.args.requests
+            ))
+        if self.args.json:
+            with open(self.args.json, 'w') as out:
+                json.dump(dict(
+                    parameters=dict(
+                        requests=self.args.requests, items=self.args.items
+                    ),
+                    results=results
+                ), out, indent=2, sort_keys=True)
+        return 0
@@ -0,0 +1,34 @@
+"""A publisher that pretends to talk to a remote service.
+
+It doesn't send the post anywhere. It just waits as long as a real
+service might take to respond and sometimes fails, which makes it
+useful for benchmarks.
+
+It lives here rather than in botfriend.publish so that a real bot
+can't be configured to use it; only FleetBot knows how to load it.
+"""
+import random
+import time
+from botfriend.bot import Publisher
+
+class SimulatedPublisher(Publisher):
+    def __init__(
+            self, bot, full_config, module_config
+    ):
+        module_config = module_config or {}
+        # Take this many seconds to publish each post.
+        self.latency = module_config.get('latency', 0)
+        # Fail this proportion of the time.
+        self.error_rate = module_config.get('error_rate', 0)
+        self.random = random.Random(module_config.get('seed'))
+
+    def self_test(self):
+        return "simulated, %ss latency" % self.latency
+
+    def publish(self, post, publication):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            publication.report_failure("Simulated failure")
+        else:
+            publication.report_success("simulated-%s" % post.id)
@@ -0,0 +1,197 @@
+"""Measure how long each script in bin/ takes to start up.
+
+Each script is run in a fresh interpreter with `python -X importtime`
+and `--help`, so it exits as soon as it has imported everything and
+parsed its arguments. The median total import time over several runs
+is compared against a budget stored in startup_budget.json. The budget
+is recorded with --update, as the measured time plus 50% (SLACK).
+
+A script also fails if it imports any of HEAVY_MODULES at all.
+
+-X importtime is new in Python 3.7, so this only runs on Python 3.
+"""
+from argparse import ArgumentParser
+import json
+import os
+import subprocess
+import sys
+
+from botfriend.scripts import Script
+from botfriend.util import percentile
+
+class StartupBenchmarkScript(Script):
+    """Make sure the bin/ scripts start up quickly."""
+
+    package_dir = os.path.split(os.path.split(__file__)[0])[0]
+    BIN_DIR = os.path.join(os.path.split(package_dir)[0], "bin")
+    BUDGET_FILE = os.path.join(
+        os.path.split(__file__)[0], "startup_budget.json"
+    )
+
+    # When recording a new budget, allow this much slack over the
+    # measured time.
+    SLACK = 1.5
+
+    # These modules are slow to import, and none of the scripts need
+    # them just to start up. A script that imports one fails the
+    # benchmark whatever its budget.
+    HEAVY_MODULES = (
+        'feedgen', 'feedparser', 'mastodon', 'pytumblr', 'requests', 'tweepy',
+    )
+
+    @classmethod
+    def parser(cls):
+        parser = ArgumentParser()
+        parser.add_argument(
+            '--runs',
+            help="Run each script this many times and use the median. (Default is 5)",
+            type=int,
+            default=5
+        )
+        parser.add_argument(
+            '--budget',
+            help="Load the budget from this file instead of the default.",
+            default=cls.BUDGET_FILE
+        )
+        parser.add_argument(
+            '--update',
+            help="Write a new budget based on this run instead of checking the old one.",
+            action='store_true'
+        )
+        parser.add_argument(
+            'scripts',
+            help='Only benchmark these scripts.',
+            metavar='SCRIPT',
+            nargs='*'
+        )
+        return parser
+
+    def __init__(self, args=None):
+        self.args = args or self.parser().parse_args()
+
+    @classmethod
+    def run(cls):
+        instance = cls()
+        sys.exit(instance.benchmark())
+
+    @property
+    def scripts(self):
+        if self.args.scripts:
+            return self.args.scripts
+        return sorted(
+            x for x in os.listdir(self.BIN_DIR)
+            if not x.startswith('.') and not x.startswith('benchmark')
+        )
+
+    def import_profile(self, script):
+        """Start `script` in a new interpreter and record what it
+        imports.
+
+        :return: The output of `python -X importtime`.
+        """
+        path = os.path.join(self.BIN_DIR, script)
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", path, "--help"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        return process.stderr
+
+    def import_time(self, script):
+        """Find out how long `script` spends importing modules.
+
+        :return: The total import time, in milliseconds.
+        """
+        return self.total_import_time(self.import_profile(script))
+
+    @classmethod
+    def imported_modules(cls, output):
+        """Find the names of the modules imported, according to the
+        output of `python -X importtime`.
+        """
+        modules = set()
+        for line in output.splitlines():
+            if line.startswith("import time:"):
+                name = line.split("|")[-1].strip()
+                modules.add(name)
+        return modules
+
+    @classmethod
+    def heavy_imports(cls, output):
+        """Find any HEAVY_MODULES (or their submodules) imported,
+        according to the output of `python -X importtime`.
+        """
+        return sorted(
+            x for x in cls.imported_modules(output)
+            if x.split(".")[0] in cls.HEAVY_MODULES
+        )
+
+    @classmethod
+    def total_import_time(cls, output):
+        """Add up the cumulative time of every top-level import in the
+        output of `python -X importtime`.
+
+        :return: A number of milliseconds.
+        """
+        total = 0
+        for line in output.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            self_time, cumulative, name = line[len("import time:"):].split("|")
+            if not cumulative.strip().isdigit():
+                # This is the header line.
+                continue
+            if name.startswith("  "):
+                # This module was imported by some other module, and
+                # its time is already counted.
+                continue
+            total += int(cumulative)
+        return total / 1000.0
+
+    def benchmark(self):
+        """Measure every script and compare it against the budget.
+
+        :return: An exit code: 0 if every script was within budget.
+        """
+        if os.path.exists(self.args.budget):
+            budget = json.load(open(self.args.budget))
+        else:
+            budget = {}
+        over = []
+        # Take turns running each script, so that a change in how busy
+        # the machine is affects every script equally.
+        scripts = self.scripts
+        profiles = dict((script, []) for script in scripts)
+        for i in range(self.args.runs):
+            for script in scripts:
+                profiles[script].append(self.import_profile(script))
+        for script in scripts:
+            elapsed = percentile(
+                sorted(self.total_import_time(x) for x in profiles[script]),
+                0.5
+            )
+            heavy = self.heavy_imports(profiles[script][0])
+            limit = budget.get(script)
+            if heavy:
+                status = "IMPORTS %s" % ", ".join(heavy)
+                over.append(script)
+            elif self.args.update:
+                budget[script] = int(elapsed * self.SLACK)
+                status = "recorded"
+            elif limit is None:
+                status = "no budget"
+            elif elapsed > limit:
+                status = "OVER BUDGET (%dms)" % limit
+                over.append(script)
+            else:
+                status = "ok (%dms)" % limit
+            print("%-20s %7.1fms %s" % (script, elapsed, status))
+
+        if self.args.update:
+            with open(self.args.budget, 'w') as out:
+                json.dump(budget, out, indent=2, sort_keys=True)
+                out.write("\n")
+        if over:
+            print("%d script(s) over budget: %s" % (len(over), ", ".join(over)))
+            return 1
+        return 0
@@ -0,0 +1,154 @@
+"""Load-test a bot's text generator.
+
+The rounds are split between worker processes. Each worker loads the
+bot from the database on its own, seeds the random number generator
+with its own deterministic seed, and times every call to
+generate_text(). The timings are combined into a single report.
+"""
+import json
+import random
+import sys
+
+from botfriend.config import Configuration
+from botfriend.model import (
+    content_digest,
+    Post,
+)
+from botfriend.util import (
+    percentile,
+    timer,
+)
+
+def peak_rss_kb():
+    """The peak resident set size of this process, in KiB."""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS reports bytes rather than KiB.
+        peak = peak // 1024
+    return peak
+
+
+def _generate(job):
+    """Generate text in a worker process.
+
+    :param job: A 5-tuple (config directory, bot name, number of
+        rounds, random seed, whether to print the generated text).
+    :return: A dictionary of raw measurements.
+    """
+    directory, name, rounds, seed, show = job
+    config = Configuration.from_directory(directory, [name])
+    [bot_model] = config.bots
+    bot = bot_model.implementation
+    archive = set(
+        x for [x] in config._db.query(Post.content_hash).filter(
+            Post.bot==bot_model
+        )
+    )
+    random.seed(seed)
+    latencies = []
+    nones = 0
+    duplicates = 0
+    for i in range(rounds):
+        started = timer()
+        text = bot.generate_text()
+        latencies.append(timer() - started)
+        if text is None:
+            nones += 1
+            continue
+        if show:
+            print(text)
+        if isinstance(text, (str, bytes)) and content_digest(text) in archive:
+            duplicates += 1
+    config._db.close()
+    return dict(
+        latencies=latencies, nones=nones, duplicates=duplicates,
+        peak_rss_kb=peak_rss_kb()
+    )
+
+
+def stress_test(directory, name, rounds, workers=1, seed=0, show=False):
+    """Run a bot's text generator `rounds` times.
+
+    :param directory: The configuration directory.
+    :param name: The name of the bot's directory.
+    :param workers: Split the rounds between this many processes.
+    :param seed: Worker N seeds the random number generator with
+        `seed` + N, so runs with the same seed are comparable.
+    :param show: Print the generated text.
+    :return: A dictionary summarizing the results, suitable for
+        serializing as JSON.
+    """
+    workers = max(1, min(workers, rounds))
+    jobs = [
+        (directory, name, rounds // workers + (1 if i < rounds % workers else 0),
+         seed + i, show)
+        for i in range(workers)
+    ]
+    started = timer()
+    if workers == 1:
+        results = [_generate(jobs[0])]
+    else:
+        import multiprocessing
+        context = multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            # Python 3 may default to another way of starting processes.
+            context = multiprocessing.get_context("fork")
+        pool = context.Pool(workers)
+        try:
+            results = pool.map(_generate, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = timer() - started
+
+    latencies = sorted(x for result in results for x in result['latencies'])
+    nones = sum(result['nones'] for result in results)
+    duplicates = sum(result['duplicates'] for result in results)
+    generated = len(latencies) - nones
+
+    def ms(seconds):
+        if seconds is None:
+            return None
+        return round(seconds * 1000, 3)
+    return dict(
+        bot=name,
+        rounds=rounds,
+        workers=workers,
+        seed=seed,
+        seconds=round(elapsed, 3),
+        posts_per_second=round(len(latencies) / elapsed, 1) if elapsed else None,
+        latency_ms=dict(
+            p50=ms(percentile(latencies, 0.5)),
+            p95=ms(percentile(latencies, 0.95)),
+            p99=ms(percentile(latencies, 0.99)),
+            max=ms(latencies[-1] if latencies else None),
+        ),
+        peak_rss_kb=max(result['peak_rss_kb'] for result in results),
+        none_rate=round(nones / float(rounds), 4) if rounds else None,
+        duplicate_rate=(
+            round(duplicates / float(generated), 4) if generated else None
+        ),
+    )
+
+
+def describe(result):
+    """Turn the output of stress_test() into a human-readable report."""
+    latency = result['latency_ms']
+    lines = [
+        "%(rounds)d rounds in %(seconds).2fs with %(workers)d workers: %(posts_per_second)s posts/sec" % result,
+        "Latency: p50 %sms, p95 %sms, p99 %sms, max %sms" % (
+            latency['p50'], latency['p95'], latency['p99'], latency['max']
+        ),
+        "Peak RSS: %d KiB" % result['peak_rss_kb'],
+        "No result: %s, duplicates of archived posts: %s" % (
+            _percent(result['none_rate']), _percent(result['duplicate_rate'])
+        ),
+    ]
+    return lines
+
+
+def _percent(rate):
+    if rate is None:
+        return "n/a"
+    return "%.2f%%" % (rate * 100)
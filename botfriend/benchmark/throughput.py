@@ -0,0 +1,210 @@
+"""Time the main scripts against a large synthetic fleet of bots.
+
+A fleet is generated in a temporary directory (see fleet.py) and each
+script is run against it in this process, with the simulated
+publisher standing in for real services. The timings are compared
+against a baseline stored in fleet_baseline.json, which was recorded
+with the same fleet parameters.
+"""
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from botfriend.benchmark.fleet import (
+    BACKLOG_FILE,
+    generate_fleet,
+    SCHEDULE_FILE,
+)
+from botfriend.scripts import (
+    BacklogLoadScript,
+    DashboardScript,
+    PostScript,
+    RepublicationScript,
+    ScheduledPostsLoadScript,
+    Script,
+    StatsScript,
+)
+
+class FleetBenchmarkScript(Script):
+    """Make sure the scripts stay fast when there are a lot of bots."""
+
+    BASELINE_FILE = os.path.join(
+        os.path.split(__file__)[0], "fleet_baseline.json"
+    )
+
+    @classmethod
+    def parser(cls):
+        parser = ArgumentParser()
+        parser.add_argument(
+            '--bots', help="Generate this many bots. (Default is 50)",
+            type=int, default=50
+        )
+        parser.add_argument(
+            '--posts', help="Give each bot this many posts. (Default is 1000)",
+            type=int, default=1000
+        )
+        parser.add_argument(
+            '--backlog',
+            help="Give each bot this many backlog items. (Default is 100)",
+            type=int, default=100
+        )
+        parser.add_argument(
+            '--latency',
+            help="The simulated publisher takes this many seconds per post. (Default is 0.01)",
+            type=float, default=0.01
+        )
+        parser.add_argument(
+            '--error-rate',
+            help="The proportion of publications that fail. (Default is 0.05)",
+            type=float, default=0.05
+        )
+        parser.add_argument(
+            '--seed', help="Seed for generating the fleet. (Default is 0)",
+            type=int, default=0
+        )
+        parser.add_argument(
+            '--baseline',
+            help="Compare against the baseline in this file instead of the default.",
+            default=cls.BASELINE_FILE
+        )
+        parser.add_argument(
+            '--tolerance',
+            help="Fail if a script takes this many times as long as the baseline. (Default is 1.5)",
+            type=float, default=1.5
+        )
+        parser.add_argument(
+            '--update',
+            help="Record this run as the new baseline instead of checking the old one.",
+            action='store_true'
+        )
+        parser.add_argument(
+            '--json', help="Also write the results to this file."
+        )
+        parser.add_argument(
+            '--keep',
+            help="Generate the fleet in this directory and leave it there afterwards.",
+        )
+        return parser
+
+    def __init__(self, args=None):
+        self.args = args or self.parser().parse_args()
+
+    @classmethod
+    def run(cls):
+        instance = cls()
+        sys.exit(instance.benchmark())
+
+    @property
+    def parameters(self):
+        """The arguments that determine what's being measured."""
+        return dict(
+            bots=self.args.bots, posts=self.args.posts,
+            backlog=self.args.backlog, latency=self.args.latency,
+            error_rate=self.args.error_rate, seed=self.args.seed,
+        )
+
+    def steps(self, directory, names):
+        """The scripts to time, in the order they should run.
+
+        :return: A list of (name, script class, command-line arguments)
+            3-tuples.
+        """
+        config = ['--config', directory]
+        one_bot = os.path.join(directory, names[0])
+        return [
+            ('dashboard', DashboardScript, config),
+            ('stats', StatsScript, config + ['--days', '30']),
+            ('post', PostScript, config),
+            ('republish', RepublicationScript, config + ['--limit', '10']),
+            ('scheduled.load', ScheduledPostsLoadScript, config + [
+                '--file', os.path.join(one_bot, SCHEDULE_FILE), names[0]
+            ]),
+            ('backlog.load', BacklogLoadScript, config + [
+                '--file', os.path.join(one_bot, BACKLOG_FILE), names[0]
+            ]),
+        ]
+
+    def time_script(self, script_class, argv):
+        """Run a script, including loading its configuration.
+
+        :return: The number of seconds it took.
+        """
+        started = time.perf_counter()
+        script = script_class(script_class.parser().parse_args(argv))
+        with redirect_stdout(io.StringIO()):
+            script.process_bots()
+        script.config._db.close()
+        return time.perf_counter() - started
+
+    def measure(self):
+        """Generate a fleet and time each script against it.
+
+        :return: A dictionary mapping step names to seconds.
+        """
+        directory = self.args.keep or tempfile.mkdtemp(prefix="botfriend-fleet-")
+        try:
+            started = time.perf_counter()
+            names = generate_fleet(
+                directory, bots=self.args.bots, posts=self.args.posts,
+                backlog=self.args.backlog, error_rate=self.args.error_rate,
+                latency=self.args.latency, seed=self.args.seed,
+            )
+            print("Generated %d bots in %.2fs" % (
+                len(names), time.perf_counter() - started
+            ))
+            # The scripts log every post; that's not what we're measuring.
+            logging.disable(logging.INFO)
+            try:
+                return dict(
+                    (name, round(self.time_script(script_class, argv), 3))
+                    for name, script_class, argv in self.steps(directory, names)
+                )
+            finally:
+                logging.disable(logging.NOTSET)
+        finally:
+            if not self.args.keep:
+                shutil.rmtree(directory)
+
+    def benchmark(self):
+        seconds = self.measure()
+        results = dict(parameters=self.parameters, seconds=seconds)
+        if self.args.json:
+            with open(self.args.json, 'w') as out:
+                json.dump(results, out, indent=2, sort_keys=True)
+
+        if self.args.update:
+            with open(self.args.baseline, 'w') as out:
+                json.dump(results, out, indent=2, sort_keys=True)
+                out.write("\n")
+            for name, value in sorted(seconds.items()):
+                print("%s: %.3fs" % (name, value))
+            return 0
+
+        baseline = json.load(open(self.args.baseline))
+        if baseline['parameters'] != self.parameters:
+            print("Baseline was recorded with different parameters: %r" % (
+                baseline['parameters']
+            ))
+            return 1
+        failures = 0
+        for name, value in sorted(seconds.items()):
+            expected = baseline['seconds'].get(name)
+            if expected is None:
+                status = "NEW"
+            elif value > expected * self.args.tolerance:
+                status = "SLOW"
+                failures += 1
+            else:
+                status = "OK"
+            print("%-4s %s: %.3fs (baseline %s)" % (
+                status, name, value,
+                "%.3fs" % expected if expected is not None else "none"
+            ))
+        return 1 if failures else 0
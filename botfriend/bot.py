@@ -1,19 +1,32 @@
 # encoding: utf-8
+import copy
+import hashlib
 import importlib
 import datetime
 import json
 import os
 import random
-import requests
-from nose.tools import set_trace
+import threading
+import time
 from .model import (
     get_one_or_create,
     InvalidPost,
+    CircuitBreaker,
+    HTTPCacheEntry,
+    media_digest,
+    MediaUpload,
     Post,
     Publication,
+    RateLimit,
     _now,
 )
+from .metrics import (
+    METRICS,
+    phase,
+)
 from .util import isstr
+from .web import HTTPClient
+from sqlalchemy import inspect
 from sqlalchemy.orm.session import Session
 
 class NothingToPost(Exception):
@@ -58,14 +71,28 @@ class Bot(object):
         self.config = config
         self.schedule = self._extract_from_config(config, 'schedule')
         self.state_update_schedule = config.get( 'state_update_schedule', None)
+        # If this is set, state is refreshed in a worker thread this
+        # many minutes before it's due to be updated.
+        self.state_update_lead = config.get('state_update_lead', None)
+        self._state_refresh = None
+        # When the most recent background refresh failed, if it did.
+        self._state_refresh_failed_at = None
         self.duplicate_filter = self.config.get('duplicate_filter', True)
+        self.publish_concurrency = self.config.get('publish_concurrency', 1)
+        # Use this to make HTTP requests, so connections are reused.
+        self.http = HTTPClient.from_config(self.config.get('http'))
         publishers = self.config.get('publish', {})
         if not publishers:
             self.log.warn("Bot %s defines no publishers.", self.name)
         self.publishers = [
-            Publisher.from_config(self, module, config)
-            for module in publishers
+            self.load_publisher(module, config) for module in publishers
         ]
+
+    def load_publisher(self, module, config):
+        """Create a Publisher for one of the services listed in the
+        `publish` section of the bot's configuration.
+        """
+        return Publisher.from_config(self, module, config)
         
     def _extract_from_config(self, config, key):
         value = config.get(key, None)
@@ -86,7 +113,8 @@ class Bot(object):
         :return: A list of Posts that should be published right now.
         """
         # Make sure state is up to date.
-        self.check_and_update_state()        
+        with phase(self.module_name, 'state'):
+            self.check_and_update_state()
 
         posts = self.model.ready_scheduled_posts
         if posts:
@@ -101,10 +129,12 @@ class Bot(object):
         # want to make a new post.
         
         # Look in the backlog for an object we can convert into a post.
-        posts = self.model.pop_backlog()
+        with phase(self.module_name, 'pop_backlog'):
+            posts = self.model.pop_backlog()
         if not posts:
             # Create a new post
-            posts = self.new_post()
+            with phase(self.module_name, 'new_post'):
+                posts = self.new_post()
 
         if not posts:
             # We didn't actually do any work, possibly because the
@@ -117,7 +147,8 @@ class Bot(object):
         # overwritten after the new posts are published, but doing it
         # now prevents a large number of unpublishable posts from being
         # created when a publisher isn't working.
-        post_list = self._to_post_list(posts)
+        with phase(self.module_name, 'object_to_post'):
+            post_list = self._to_post_list(posts)
         self.schedule_next_post(post_list)
         return post_list
 
@@ -163,6 +194,16 @@ class Bot(object):
         """
         return None
 
+    def fill_buffer(self):
+        """Do work ahead of time so that publishable_posts has less
+        to do when a post is due.
+
+        By default, there's nothing to do.
+
+        :return: The number of posts generated.
+        """
+        return 0
+
     def object_to_post(self, obj):
         """Turn an object retrieved from backlog or from new_post(), into a
         Post object.
@@ -252,7 +293,17 @@ class Bot(object):
     # Methods dealing with bot state.
     
     def check_and_update_state(self, force=False):
-        """Update the bot's internal state, assuming it needs to be updated."""
+        """Update the bot's internal state, assuming it needs to be updated.
+
+        If the bot refreshes its state in the background and already
+        has some state, the update happens in the background instead,
+        and the current state is used until the new state is ready.
+        """
+        if (not force and self.refreshes_state_in_background
+            and self.model.last_state_update_time):
+            self.finish_state_refresh()
+            self.start_state_refresh()
+            return False
         if force or self.state_needs_update:
             result = self.update_state()
             if result:
@@ -264,30 +315,197 @@ class Bot(object):
             return True
         return False
 
+    # After a background state refresh fails, wait this fraction of
+    # `state_update_lead` before trying again.
+    STATE_REFRESH_RETRY = 0.25
+
+    @property
+    def next_state_refresh_time(self):
+        """When should a background refresh of this bot's state start?
+
+        :return: A datetime, or None if this bot doesn't refresh its
+            state in the background.
+        """
+        update_at = self.next_state_update_time
+        if update_at is None or not self.refreshes_state_in_background:
+            return None
+        refresh_at = update_at - datetime.timedelta(
+            minutes=self.state_update_lead
+        )
+        if self._state_refresh_failed_at:
+            # Don't try again right after a failure.
+            retry_at = self._state_refresh_failed_at + datetime.timedelta(
+                minutes=self.state_update_lead * self.STATE_REFRESH_RETRY
+            )
+            refresh_at = max(refresh_at, retry_at)
+        return refresh_at
+
+    @property
+    def refreshes_state_in_background(self):
+        """Can this bot refresh its state in a worker thread?
+
+        Only a bot that sets `state_update_lead` and implements
+        refresh_state() can. Any other bot's update_state() might use
+        the database, so it's always called synchronously.
+        """
+        return bool(self.state_update_lead) and (
+            type(self).refresh_state is not Bot.refresh_state
+        )
+
+    @property
+    def state_refresh_in_progress(self):
+        return self._state_refresh is not None
+
+    def start_state_refresh(self):
+        """Start calling refresh_state() in a worker thread, if it's time.
+
+        The current state is read here, in the calling thread, so the
+        worker thread never has to touch the database session. The
+        worker is a daemon thread, so a refresh that never finishes
+        can't keep the process from exiting.
+
+        :return: True if a refresh was started.
+        """
+        if self._state_refresh:
+            return False
+        refresh_at = self.next_state_refresh_time
+        if refresh_at is None or refresh_at > _now():
+            return False
+        state = self.model.state
+        last_update = self.model.last_state_update_time
+        outcome = {}
+
+        def work():
+            try:
+                outcome['result'] = self.refresh_state(state, last_update)
+            except Exception as e:
+                outcome['error'] = e
+
+        thread = threading.Thread(
+            target=work, name="refresh-state-%s" % self.name
+        )
+        thread.daemon = True
+        thread.start()
+        # Don't wait for the thread here; finish_state_refresh does that.
+        self._state_refresh = (time.time(), thread, outcome)
+        return True
+
+    def finish_state_refresh(self, timeout=0):
+        """If a background state refresh has finished, swap the new
+        state into the BotModel.
+
+        A failed refresh is logged and recorded in the BotModel; the
+        old state stays in place and the refresh will be tried again
+        after a delay (see STATE_REFRESH_RETRY).
+
+        :param timeout: Wait this many seconds for the refresh to
+            finish. None means wait as long as it takes.
+        :return: True if new state was swapped in.
+        """
+        if not self._state_refresh:
+            return False
+        started, thread, outcome = self._state_refresh
+        thread.join(timeout)
+        if thread.is_alive():
+            # Still running.
+            return False
+        if 'error' in outcome:
+            e = outcome['error']
+            self._state_refresh = None
+            self.model.state_refresh_seconds = time.time() - started
+            self.model.state_refresh_error = str(e) or repr(e)
+            self._state_refresh_failed_at = _now()
+            self.log.error("State refresh failed: %s", e, exc_info=e)
+            return False
+        result = outcome.get('result')
+        self._state_refresh = None
+        self._state_refresh_failed_at = None
+        self.model.state_refresh_seconds = time.time() - started
+        self.model.state_refresh_error = None
+        if isinstance(result, bytes):
+            result = result.decode("utf8")
+        if result:
+            self.model.state = result
+        else:
+            # The bot had nothing new, but the state is fresh as of now.
+            self.model.last_state_update_time = _now()
+        return True
+
+    def abandon_state_refresh(self):
+        """Stop waiting for a background state refresh.
+
+        The worker thread is left to finish (or not) on its own; its
+        result will be ignored. The timeout is recorded in the BotModel
+        like any other failed refresh, and the old state stays in
+        place.
+
+        :return: True if a refresh was abandoned.
+        """
+        if not self._state_refresh:
+            return False
+        started = self._state_refresh[0]
+        self._state_refresh = None
+        elapsed = time.time() - started
+        self.model.state_refresh_seconds = elapsed
+        self.model.state_refresh_error = (
+            "Didn't finish within %.1f seconds" % elapsed
+        )
+        self._state_refresh_failed_at = _now()
+        self.log.warn("State refresh abandoned after %.1fs", elapsed)
+        return True
+
     @property
     def state_needs_update(self):
         """Does this bot's internal state need to be updated?"""
-        if self.state_update_schedule is None:
+        update_at = self.next_state_update_time
+        if update_at is None:
             # This bot doesn't update state on a schedule.
             return False
+        if not self.model.last_state_update_time:
+            return True
+        return _now() > update_at
+
+    @property
+    def next_state_update_time(self):
+        """When will this bot's internal state need to be updated?
+
+        :return: A datetime, or None if this bot doesn't update state
+            on a schedule.
+        """
+        if self.state_update_schedule is None:
+            return None
         last_update = self.model.last_state_update_time
         if not last_update:
-            return True
-        now = _now()
-        update_at = last_update + datetime.timedelta(
+            return _now()
+        return last_update + datetime.timedelta(
             minutes=self.state_update_schedule
         )
-        return now > update_at
 
     def update_state(self):
         """Update a bot's internal state.
 
-        By default, does nothing.
+        By default, calls refresh_state() if the bot implements it,
+        and otherwise does nothing.
 
         :return: A string. If a bytestring is returned it will be automatically
             decoded as UTF-8.
         """
-        pass
+        if type(self).refresh_state is not Bot.refresh_state:
+            return self.refresh_state(
+                self.model.state, self.model.last_state_update_time
+            )
+
+    def refresh_state(self, state, last_update):
+        """Work out a bot's new internal state without using the database.
+
+        Implement this instead of update_state() to let the bot
+        refresh its state in a worker thread (see `state_update_lead`).
+
+        :param state: The bot's current state, as a string, or None.
+        :param last_update: The time the state was last updated, or None.
+        :return: The new state, as for update_state().
+        """
+        raise NotImplementedError()
 
     # Methods dealing with backlog posts
         
@@ -297,10 +515,7 @@ class Bot(object):
         return self.model.backlog
 
     def extend_backlog(self, items):
-        backlog = self.model.backlog
-        for item in items:
-            backlog.append(self.backlog_item(item))
-        self.model.backlog = backlog
+        self.model.extend_backlog([self.backlog_item(x) for x in items])
 
     def backlog_item(self, data):
         """Convert an input string into a backlog item.
@@ -312,7 +527,7 @@ class Bot(object):
         
     def clear_backlog(self):
         """Clear a bot's backlog."""
-        self.model.backlog = []
+        self.model.clear_backlog()
         
     # Methods dealing with scheduling posts.
     
@@ -373,6 +588,34 @@ class Bot(object):
             how_long = random.gauss(mean, stdev)
         return datetime.timedelta(minutes=how_long)
 
+    @property
+    def next_action_time(self):
+        """When might this bot next have something to do?
+
+        This is the earliest of the next post time, the publication time
+        of the earliest scheduled post, the time the bot's state
+        needs to be updated (or, if state is refreshed in the
+        background, the time that refresh should start), and the time
+        the first failed or deferred publication is due to be retried.
+
+        :return: A datetime. If this is in the past, the bot should be
+            processed immediately.
+        """
+        if self.model.should_make_new_post:
+            return self.model.next_post_time or _now()
+        if self.state_refresh_in_progress:
+            # Check back as soon as possible to pick up the new state.
+            return _now()
+        candidates = [self.model.next_post_time]
+        state_time = self.next_state_refresh_time or self.next_state_update_time
+        for candidate in (
+            self.model.next_scheduled_post_time, state_time,
+            self.model.next_retry_time
+        ):
+            if candidate:
+                candidates.append(candidate)
+        return min(candidates)
+
     # Methods dealing with publishing posts.
     
     def publish(self, post):
@@ -389,26 +632,335 @@ class Bot(object):
             )
             return []
         
-        publications = []
+        pending = []
+        deferred = []
         for publisher in self.publishers:
             publication, is_new = self.make_publication(
                 publisher, post
             )
-            if not is_new and not publication.error:
+            if not is_new and not publication.needs_publishing:
                 # There was a previous, successful attempt to publish
                 # this Post. Skip this Publisher.
                 continue
-            try:
-                self.post_to_publisher(publisher, post, publication)
-            except Exception as e:
-                message = str(e)
-                publication.report_failure("Uncaught exception: %s" % message)
-            publications.append(publication)
+            if (self.circuit_open(publisher, publication)
+                or self.rate_limited(publisher, publication)):
+                deferred.append(publication)
+                continue
+            publisher.load_media_cache(self._db, post)
+            pending.append((publisher, publication))
+
+        # Note how many times each publication has been tried, so we
+        # can tell whether the publisher reported anything.
+        attempts = [publication.attempts or 0 for x, publication in pending]
+        if pending:
+            # Commit the post and its publications, so other
+            # processes aren't locked out of the database while we
+            # wait for the services to respond.
+            self.mark_in_flight(pending)
+            self._db.commit()
+
+        if self.publish_concurrency > 1 and len(pending) > 1:
+            self._publish_concurrently(post, pending)
+        else:
+            # Publishers run in this thread, one at a time, and aren't
+            # timed out: there'd be no way to stop one that ran long
+            # without abandoning a thread. Publishers pass their
+            # timeout on to the service's client instead.
+            for publisher, publication in pending:
+                try:
+                    self.post_to_publisher(publisher, post, publication)
+                except Exception as e:
+                    message = str(e)
+                    publication.report_failure("Uncaught exception: %s" % message)
+        for (publisher, publication), before in zip(pending, attempts):
+            self.record_outcome(publisher, publication, before)
+        publications = [publication for publisher, publication in pending]
+        publications.extend(deferred)
 
         # Update the time at which we will try to publish the next post.
         self.schedule_next_post([post])
         return publications
 
+    def republish(self, publications):
+        """Try again to publish Publications that failed or were
+        deferred, and are now due.
+
+        :param publications: A list of Publications, probably from
+            BotModel.due_publications().
+        """
+        for publication in publications:
+            post = publication.post
+            # Find the publisher responsible for this
+            matches = [x for x in self.publishers
+                        if x.service == publication.service]
+            if not matches:
+                # This bot doesn't use this publisher anymore. Stop
+                # trying to publish to it.
+                publication.next_retry_at = None
+                continue
+            [publisher] = matches
+            self.log.info(
+                "Attempting to republish to %s: %s" % (
+                    publication.service,
+                    post.content
+                )
+            )
+            if self.circuit_open(publisher, publication):
+                self.log.info(
+                    "Circuit breaker open, deferred until %s" % (
+                        publication.next_retry_at
+                    )
+                )
+                continue
+            if self.rate_limited(publisher, publication):
+                self.log.info(
+                    "Rate limited, deferred until %s" % (
+                        publication.next_retry_at
+                    )
+                )
+                continue
+            publisher.load_media_cache(self._db, post)
+            attempts = publication.attempts or 0
+            # Don't hold the database while we wait for the service.
+            self.mark_in_flight([(publisher, publication)])
+            self._db.commit()
+            try:
+                self.post_to_publisher(publisher, post, publication)
+            except Exception as e:
+                publication.report_failure("Uncaught exception: %s" % e)
+            self.record_outcome(publisher, publication, attempts)
+            if publication.error:
+                self.log.info("Failure: %s" % publication.display())
+            elif publication.next_retry_at:
+                self.log.info(
+                    "Deferred until %s" % publication.next_retry_at
+                )
+            else:
+                self.log.info("Success!")
+
+    def _publish_concurrently(self, post, pending):
+        """Send a Post to several publishers at once.
+
+        The publishers run in worker threads and never see the actual
+        Post or Publication objects, since those belong to this
+        thread's database session. Instead they get a PostSnapshot and
+        a DeferredPublication, and the outcome is copied into the real
+        Publication here once the worker finishes.
+
+        No more than `publish_concurrency` workers run at once. A
+        worker isn't started until there's room for it, and a
+        publisher's timeout starts when its worker does, so a
+        publisher isn't penalized for waiting its turn.
+
+        A publisher that doesn't finish within its timeout may still
+        deliver the post, so it isn't counted as a failure (which
+        would be retried right away). Instead, the Publication is
+        deferred for as long as a failure can be, and its worker no
+        longer counts against `publish_concurrency`. The worker
+        threads are daemon threads, so one that never finishes can't
+        keep the process from exiting; publishers should pass their
+        timeout on to the service's client so that doesn't happen.
+        Since the abandoned thread may still be using the publisher,
+        the bot switches to a replacement (see
+        Publisher.replacement()).
+
+        :param pending: A list of (Publisher, Publication) 2-tuples.
+            A publisher that times out is replaced in this list, as
+            well as in self.publishers.
+        """
+        snapshot = PostSnapshot(post)
+        finished = []
+        condition = threading.Condition()
+
+        def work(i, publisher, deferred, errors):
+            try:
+                self.post_to_publisher(publisher, snapshot, deferred)
+            except Exception as e:
+                errors.append(e)
+            with condition:
+                finished.append(i)
+                condition.notify()
+
+        waiting = list(range(len(pending)))
+        # Map the index of each running job to the time it has to
+        # finish by, and its DeferredPublication and errors.
+        running = {}
+        with condition:
+            while waiting or running:
+                while waiting and len(running) < self.publish_concurrency:
+                    i = waiting.pop(0)
+                    publisher, publication = pending[i]
+                    deferred = DeferredPublication(publication)
+                    errors = []
+                    thread = threading.Thread(
+                        target=work, args=(i, publisher, deferred, errors),
+                        name="publish-%s" % publisher.service
+                    )
+                    thread.daemon = True
+                    running[i] = (
+                        time.time() + publisher.timeout, deferred, errors
+                    )
+                    thread.start()
+
+                if not finished:
+                    deadline = min(x[0] for x in running.values())
+                    condition.wait(max(0, deadline - time.time()))
+                while finished:
+                    i = finished.pop(0)
+                    if i not in running:
+                        # This job was already abandoned.
+                        continue
+                    deadline, deferred, errors = running.pop(i)
+                    publisher, publication = pending[i]
+                    if errors:
+                        message = str(errors[0])
+                        publication.report_failure(
+                            "Uncaught exception: %s" % message
+                        )
+                    else:
+                        deferred.apply(publication)
+
+                now = time.time()
+                for i, (deadline, deferred, errors) in list(running.items()):
+                    if deadline <= now:
+                        del running[i]
+                        self._abandon_publisher(post, pending, i)
+
+    def _abandon_publisher(self, post, pending, i):
+        """Give up on a publisher that didn't finish within its timeout.
+
+        :param i: The publisher's index in `pending`.
+        """
+        publisher, publication = pending[i]
+        self.log.warn(
+            "%s didn't finish within %s seconds; not retrying "
+            "%s until it's clear whether it was published.",
+            publisher.service, publisher.timeout, post.content
+        )
+        replacement = publisher.replacement()
+        if publisher in self.publishers:
+            self.publishers[self.publishers.index(publisher)] = replacement
+        pending[i] = (replacement, publication)
+        publication.report_deferred(
+            _now() + datetime.timedelta(seconds=Publication.MAX_RETRY_DELAY)
+        )
+
+    def circuit_open(self, publisher, publication):
+        """Check whether a publisher's service has been failing.
+
+        If it has, the Publication is deferred until it's time to
+        try the service again.
+
+        :return: True if the Publication was deferred.
+        """
+        breaker = publisher.circuit_breaker(self._db)
+        if not breaker:
+            return False
+        retry_at = breaker.allow(publisher.circuit_breaker_reset)
+        if not retry_at:
+            return False
+        publication.report_deferred(retry_at)
+        self.count_publication(publisher, 'circuit_open')
+        return True
+
+    def mark_in_flight(self, pending):
+        """Mark Publications as being published, before they're
+        committed and sent to the publishers.
+
+        If this process dies or hangs before the outcome is recorded,
+        the Publications come due for a retry once the publishers
+        would have timed out, instead of looking like successes.
+
+        record_outcome() takes the mark off a Publication whose
+        publisher didn't report anything.
+
+        :param pending: A list of (Publisher, Publication) 2-tuples.
+        """
+        # The publishers may run one after another, so allow for
+        # every one of them taking as long as it can.
+        until = _now() + datetime.timedelta(
+            seconds=sum(publisher.timeout for publisher, x in pending)
+        )
+        for publisher, publication in pending:
+            publication._in_flight = (until, publication.next_retry_at)
+            publication.report_deferred(until)
+
+    def record_outcome(self, publisher, publication, attempts=None):
+        """Let the publisher finish up after an attempt to publish,
+        and update its rate limit, media uploads and circuit breaker.
+
+        :param attempts: The number of attempts that had been made
+            before this one. If `publication.attempts` hasn't gone up
+            since, the publisher didn't report an attempt, and the
+            circuit breaker is left alone.
+        """
+        in_flight = getattr(publication, '_in_flight', None)
+        if in_flight:
+            publication._in_flight = None
+            until, retry_at = in_flight
+            if publication.next_retry_at == until:
+                # The publisher didn't report anything.
+                publication.next_retry_at = retry_at
+        if publication.error:
+            outcome = 'error'
+        elif publication.next_retry_at:
+            outcome = 'deferred'
+        else:
+            outcome = 'success'
+        self.count_publication(publisher, outcome)
+        try:
+            publisher.after_publish(self._db, publication)
+        except Exception as e:
+            # The post has already gone out (or not), so this doesn't
+            # change the outcome, and the bookkeeping below still
+            # needs to happen.
+            self.log.error(
+                "%s failed to finish up after publishing: %s",
+                publisher.service, e, exc_info=e
+            )
+        publisher.update_rate_limit(self._db)
+        publisher.update_media_cache(self._db, publication)
+        breaker = publisher.circuit_breaker(self._db)
+        if not breaker:
+            return
+        if attempts is not None and (publication.attempts or 0) <= attempts:
+            # We never heard back from the service.
+            return
+        if publication.error_class == Publication.TRANSIENT:
+            breaker.record_failure(
+                publisher.circuit_breaker_threshold,
+                publisher.circuit_breaker_reset
+            )
+            if breaker.state == CircuitBreaker.OPEN:
+                self.log.warn(
+                    "Circuit breaker open for %s", breaker.display()
+                )
+        elif publication.error or not publication.next_retry_at:
+            # The service responded, even if it didn't like the post.
+            breaker.record_success()
+
+    def count_publication(self, publisher, outcome):
+        METRICS.increment(
+            'botfriend_publications_total',
+            dict(bot=self.module_name, service=publisher.service,
+                 outcome=outcome)
+        )
+
+    def rate_limited(self, publisher, publication):
+        """Check whether a publisher has used up its rate limit.
+
+        If it has, the Publication is deferred until the publisher
+        should be able to take it.
+
+        :return: True if the Publication was deferred.
+        """
+        retry_at = publisher.take_rate_limit_token(self._db)
+        if not retry_at:
+            return False
+        publication.report_deferred(retry_at)
+        self.count_publication(publisher, 'rate_limited')
+        return True
+
     def make_publication(self, publisher, post):
         """Create a Publication for this Publisher and this Post.
         
@@ -421,7 +973,18 @@ class Bot(object):
         )
     
     def post_to_publisher(self, publisher, post, publication):
-        return publisher.publish(post, publication)
+        with phase(self.module_name, 'publish', publisher.service):
+            return publisher.send(post, publication)
+
+    def flush_publishers(self):
+        """Write out anything the publishers have buffered."""
+        for publisher in self.publishers:
+            try:
+                publisher.flush()
+            except Exception as e:
+                self.log.error(
+                    "Could not flush %s: %s", publisher.service, e, exc_info=e
+                )
 
     def prepare_input(self, line):
         """Turn input data into a dictionary which can be used to
@@ -502,15 +1065,69 @@ BasicBot = Bot
     
 class TextGeneratorBot(Bot):
     """A bot that comes up with a new piece of text every time it's invoked.
+
+    If `pregenerate` is set in bot.yaml, the bot keeps a buffer of
+    posts generated ahead of time, so that generating text doesn't
+    delay publication.
     """
+
+    def __init__(self, model, directory, config):
+        super(TextGeneratorBot, self).__init__(model, directory, config)
+        pregenerate = config.get('pregenerate') or {}
+        # Keep this many posts in the buffer.
+        self.buffer_depth = pregenerate.get('depth', 0)
+        # Throw away buffered posts after this many minutes.
+        self.buffer_ttl = pregenerate.get('ttl')
+
     def new_post(self):
-        """Create a brand new Post.
+        """Create a brand new Post, or take one from the buffer.
 
-        :return: Some text.
+        :return: Some text, or a Post.
         """
+        if self.buffer_depth:
+            post = self.model.pop_buffer(self.buffer_ttl)
+            if post:
+                return post
         # Make sure state is up to date.
         self.check_and_update_state()
         return self.generate_text()
+
+    def fill_buffer(self):
+        """Generate posts until the buffer is full.
+
+        Only posts created by this call are buffered. Text that
+        duplicates an existing post -- published, buffered or
+        scheduled -- is discarded.
+
+        :return: The number of posts generated.
+        """
+        if not self.buffer_depth:
+            return 0
+        self.model.expire_buffer(self.buffer_ttl)
+        needed = self.buffer_depth - self.model.buffer_size
+        if needed <= 0:
+            return 0
+        self.check_and_update_state()
+        started = _now()
+        added = 0
+        # Give up eventually if the bot keeps repeating itself.
+        for attempt in range(needed * 2):
+            text = self.generate_text()
+            if not text:
+                break
+            for post in self._to_post_list(text):
+                if post.buffered or post.publications:
+                    continue
+                if post.publish_at or (post.created and post.created < started):
+                    # This post was already waiting to be published,
+                    # maybe at a time someone chose for it. Leave it
+                    # alone.
+                    continue
+                post.buffered = True
+                added += 1
+            if added >= needed:
+                break
+        return added
         
     def generate_text(self):
         raise NotImplementedError()
@@ -591,15 +1208,204 @@ class ScriptedBot(Bot):
         raise ValueError("Could not parse time: %s" % date)
 
 
+class Snapshot(object):
+    """A copy of a database object's column values.
+
+    Unlike the original object, a Snapshot can safely be used from a
+    thread other than the one that owns the database session.
+    """
+
+    def __init__(self, obj):
+        for attribute in inspect(obj).mapper.column_attrs:
+            setattr(self, attribute.key, getattr(obj, attribute.key))
+
+
+class PostSnapshot(Snapshot):
+    """A copy of a Post and its attachments, for use by a publisher
+    running in a worker thread.
+    """
+
+    def __init__(self, post):
+        super(PostSnapshot, self).__init__(post)
+        self.attachments = [Snapshot(x) for x in post.attachments]
+        self.content_snippet = post.content_snippet
+
+    @property
+    def json_state(self):
+        if not self.state:
+            return {}
+        return json.loads(self.state)
+
+
+class DeferredPublication(object):
+    """Stands in for a Publication while a publisher runs in a worker
+    thread, recording the outcome so it can be applied to the real
+    Publication later.
+    """
+
+    def __init__(self, publication):
+        self.service = publication.service
+        self.content = publication.content
+        self.external_id = publication.external_id
+        self.error = publication.error
+        self.permanent = False
+        self.next_retry_at = None
+        self.reported = False
+        self.cost = None
+
+    def report_attempt(self, error=None):
+        self.reported = True
+        self.error = error
+        self.next_retry_at = None
+
+    def report_deferred(self, until):
+        self.next_retry_at = until
+
+    def report_cost(self, duration, requests, bytes_sent):
+        self.cost = (duration, requests, bytes_sent)
+
+    def report_success(self, external_id=None):
+        self.report_attempt(error=None)
+        if external_id:
+            self.external_id = str(external_id)
+
+    def report_failure(self, error="Unknown error.", permanent=False):
+        if isinstance(error, Exception):
+            error = str(error)
+        self.report_attempt(error)
+        self.permanent = permanent
+
+    def apply(self, publication):
+        """Copy the recorded outcome into a real Publication."""
+        publication.content = self.content
+        if self.next_retry_at:
+            publication.report_deferred(self.next_retry_at)
+        if self.cost:
+            publication.report_cost(*self.cost)
+        if not self.reported:
+            # The publisher didn't report anything.
+            return
+        if self.error:
+            publication.report_failure(self.error, self.permanent)
+        else:
+            publication.report_success(self.external_id)
+
+
 class Publisher(object):
 
     """A way of publishing the output of a bot."""
 
+    # By default, give up on a publisher that takes longer than this
+    # many seconds to publish a post. The bot only enforces this when
+    # it publishes to several publishers concurrently; otherwise it's
+    # up to the publisher to pass the timeout on to the service's
+    # client.
+    timeout = 60
+
+    # By default, publishers aren't rate-limited. A publisher that sets
+    # these takes a token from a bucket shared by every bot with the
+    # same credentials before it publishes anything. The bucket holds
+    # up to `rate_limit_capacity` tokens and refills at
+    # `rate_limit_per_minute` tokens per minute.
+    rate_limit_capacity = None
+    rate_limit_per_minute = None
+
+    # Rate limit information reported by the service during the most
+    # recent call to publish().
+    _observed_rate_limit = None
+
+    # The requests made during the current call to publish(), as a
+    # list of the number of bytes sent in each one.
+    _requests = None
+
+    # By default, attachments are sent every time a post is
+    # published. A publisher that uploads files separately from posts
+    # can set this to the number of seconds the service keeps an
+    # uploaded file, and use cached_media_id() and remember_media() to
+    # avoid uploading the same file twice.
+    media_cache_lifetime = None
+
+    # Whether an uploaded file can be attached to more than one post.
+    # If it can't, an upload is only reused when the same post is
+    # retried.
+    media_reusable = True
+
+    # The key under which the uploads for the current post are cached.
+    _media_key = None
+
+    # Uploads found in the database before the current call to
+    # publish(), as a dictionary mapping digests to media IDs.
+    _cached_media = None
+
+    # The digests of the cached uploads used by publish().
+    _used_media = None
+
+    # The files uploaded by publish(), as a list of (digest, media ID,
+    # lifetime) 3-tuples.
+    _uploaded_media = None
+
+    # Digests of files on disk, keyed by (path, size, modification time).
+    _file_digests = None
+
+    # The attributes above that only last for one call to publish().
+    PER_CALL_STATE = (
+        '_observed_rate_limit', '_requests', '_media_key', '_cached_media',
+        '_used_media', '_uploaded_media',
+    )
+
+    # After this many failures in a row, stop sending posts to this
+    # publisher's endpoint, and wait this many seconds before trying
+    # it again.
+    circuit_breaker_threshold = 5
+    circuit_breaker_reset = 300
+
     @classmethod
-    def from_config(cls, bot, module, full_config):
+    def from_config(cls, bot, module, full_config, publisher_class=None):
+        """Create a Publisher from a bot's configuration.
+
+        :param module: The name of a module in botfriend.publish.
+        :param publisher_class: Use this class instead of looking in
+            botfriend.publish for one.
+        """
         publish_config = full_config.get('publish', {})
         module_config = publish_config.get(module)
-        
+
+        if publisher_class:
+            module_name = publisher_class.__module__
+        else:
+            publisher_class, module_name = cls._import_class(module)
+        try:
+            publisher = publisher_class(bot, full_config, module_config)
+        except Exception as e:
+            raise Exception(
+                "Could not import %s publisher for %s: %s" % (
+                    module_name, bot.name, str(e)
+                )
+            )
+        publisher.service = module
+        if isinstance(module_config, dict):
+            if 'timeout' in module_config:
+                publisher.timeout = module_config['timeout']
+            rate_limit = module_config.get('rate_limit')
+            if rate_limit:
+                publisher.rate_limit_capacity = rate_limit['capacity']
+                publisher.rate_limit_per_minute = rate_limit['per_minute']
+            circuit_breaker = module_config.get('circuit_breaker')
+            if circuit_breaker:
+                publisher.circuit_breaker_threshold = circuit_breaker.get(
+                    'failures', publisher.circuit_breaker_threshold
+                )
+                publisher.circuit_breaker_reset = circuit_breaker.get(
+                    'reset', publisher.circuit_breaker_reset
+                )
+        return publisher
+
+    @classmethod
+    def _import_class(cls, module):
+        """Find the Publisher class in botfriend.publish.<module>.
+
+        :return: A 2-tuple (class, name of the module it came from).
+        """
         # Try both publish.foo and publish._foo, in case the module
         # needs to import a package called 'foo' from elsewhere (see
         # _mastodon.py for an example.)
@@ -621,29 +1427,307 @@ class Publisher(object):
         publisher_class = getattr(publisher_module, "Publisher", None)
         if not publisher_class:
             raise Exception(
-                "Loaded module %s but could not find a class called Publisher inside." % bot_module
-            )
-        try:
-            publisher = publisher_class(bot, full_config, module_config)
-        except Exception as e:
-            raise Exception(
-                "Could not import %s publisher for %s: %s" % (
-                    module_name, bot.name, str(e)
-                )
+                "Loaded module %s but could not find a class called Publisher inside." % module_name
             )
-        publisher.service = module
-        return publisher
+        return publisher_class, module_name
     
     def __init__(self, service_name, bot, full_config, **config):
         self.service_name=service_name
         self.bot = bot
 
+    def replacement(self):
+        """Make a copy of this publisher, to use instead of it after a
+        call to publish() timed out.
+
+        The abandoned call may still be running in its worker thread,
+        using this publisher's per-call state. The copy shares
+        everything else, such as the service's client, but starts out
+        with no per-call state of its own, so the two calls can't
+        interfere with each other.
+        """
+        replacement = copy.copy(self)
+        for name in self.PER_CALL_STATE:
+            setattr(replacement, name, None)
+        return replacement
+
     def attachment_path(self, path):
         """Convert a path relative to the botfriend root to an absolute
         path."""
         d = os.path.split(__file__)[0]
         return os.path.join(d, path)
         
+    @property
+    def endpoint(self):
+        """The remote server this publisher sends posts to.
+
+        :return: A string, or None if this publisher doesn't talk to a
+            remote server and so doesn't need a circuit breaker.
+        """
+        return None
+
+    @property
+    def circuit_breaker_key(self):
+        endpoint = self.endpoint
+        if not endpoint:
+            return None
+        return "%s:%s" % (self.service, endpoint)
+
+    def circuit_breaker(self, _db, create=True):
+        """Find the CircuitBreaker for this publisher's endpoint.
+
+        :param create: If this is False, a breaker won't be created
+            if there isn't one already.
+        :return: A CircuitBreaker, or None if this publisher doesn't
+            use one.
+        """
+        key = self.circuit_breaker_key
+        if not key:
+            return None
+        if create:
+            return CircuitBreaker.for_key(_db, key)
+        return _db.query(CircuitBreaker).filter(
+            CircuitBreaker.key==key).first()
+
+    @property
+    def rate_limit_credential(self):
+        """A string identifying the account or application whose rate
+        limit this publisher uses up, and whose uploaded files it
+        can use.
+
+        :return: A string, or None if this publisher isn't rate-limited.
+        """
+        return None
+
+    @classmethod
+    def _credential_key(cls, service, credential):
+        """Identify a service and a set of credentials.
+
+        The credentials are hashed so they don't end up in the database.
+        """
+        digest = hashlib.sha256(credential.encode("utf8")).hexdigest()[:16]
+        return "%s:%s" % (service, digest)
+
+    @property
+    def rate_limit_key(self):
+        """The key of the RateLimit shared by every publisher for this
+        service with the same credentials.
+        """
+        credential = self.rate_limit_credential
+        if (credential is None or not self.rate_limit_capacity
+            or not self.rate_limit_per_minute):
+            return None
+        return self._credential_key(self.service, credential)
+
+    def take_rate_limit_token(self, _db):
+        """Make sure this publisher is allowed to make a request.
+
+        :return: None if the request can go ahead; otherwise, the time
+            at which it should be tried again.
+        """
+        key = self.rate_limit_key
+        if not key:
+            return None
+        return RateLimit.take(
+            _db, key, self.rate_limit_capacity,
+            self.rate_limit_per_minute / 60.0
+        )
+
+    def observe_rate_limit(self, remaining=None, reset_at=None):
+        """Pass on rate limit information sent by the service.
+
+        This is called from inside publish(), which may be running in a
+        worker thread, so the information isn't written to the database
+        until update_rate_limit() is called.
+
+        :param remaining: The number of requests the service says we
+            can still make.
+        :param reset_at: The time, in seconds since the epoch, at which
+            the service says the limit will be reset.
+        """
+        self._observed_rate_limit = (remaining, reset_at)
+
+    def update_rate_limit(self, _db):
+        """Write any rate limit information observed by publish() to
+        the database.
+        """
+        observed = self._observed_rate_limit
+        self._observed_rate_limit = None
+        key = self.rate_limit_key
+        if observed and key:
+            remaining, reset_at = observed
+            RateLimit.observe(
+                _db, key, self.rate_limit_capacity, remaining, reset_at
+            )
+
+    @property
+    def media_cache_key(self):
+        """The key of the MediaUploads shared by every publisher for
+        this service with the same credentials.
+        """
+        credential = self.rate_limit_credential
+        if credential is None or not self.media_cache_lifetime:
+            return None
+        return self._credential_key(self.service, credential)
+
+    def attachment_digest(self, attachment):
+        """A digest of an attachment's contents.
+
+        :return: A string, or None if the attachment can't be found.
+        """
+        if attachment.content is not None:
+            return media_digest(attachment.content)
+        if not attachment.filename:
+            return None
+        path = self.attachment_path(attachment.filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        # Don't read the same file every time it's published.
+        if self._file_digests is None:
+            self._file_digests = {}
+        key = (path, stat.st_size, stat.st_mtime)
+        digest = self._file_digests.get(key)
+        if digest is None:
+            with open(path, 'rb') as data:
+                digest = media_digest(data.read())
+            self._file_digests[key] = digest
+        return digest
+
+    def post_media_key(self, post):
+        """The key of the MediaUploads that can be attached to `post`.
+
+        If uploaded files can't be reused, each post has its own
+        uploads, so another post with the same file can't pick up a
+        media ID that's already been used.
+        """
+        key = self.media_cache_key
+        if key and not self.media_reusable:
+            key = "%s:post-%s" % (key, post.id)
+        return key
+
+    def load_media_cache(self, _db, post):
+        """Find out which of a post's attachments have already been
+        uploaded, before publish() is called.
+        """
+        self._cached_media = {}
+        self._used_media = set()
+        self._uploaded_media = []
+        key = self._media_key = self.post_media_key(post)
+        if not key or not post.attachments:
+            return
+        digests = [self.attachment_digest(x) for x in post.attachments]
+        self._cached_media = MediaUpload.lookup(
+            _db, key, [x for x in digests if x]
+        )
+
+    def cached_media_id(self, attachment):
+        """Called from publish() to find out whether an attachment has
+        already been uploaded.
+
+        :return: The media ID the service gave the file, or None if
+            it needs to be uploaded.
+        """
+        if not self._cached_media:
+            return None
+        digest = self.attachment_digest(attachment)
+        media_id = self._cached_media.get(digest)
+        if media_id is not None:
+            self._used_media.add(digest)
+        return media_id
+
+    def remember_media(self, attachment, media_id, lifetime=None):
+        """Called from publish() after uploading an attachment.
+
+        Like observe_rate_limit(), this doesn't touch the database;
+        the upload is recorded by update_media_cache().
+
+        :param lifetime: The number of seconds the service says it
+            will keep the file, if it said.
+        """
+        if self._uploaded_media is None or not self._media_key:
+            return
+        digest = self.attachment_digest(attachment)
+        if digest:
+            self._uploaded_media.append(
+                (digest, media_id, lifetime or self.media_cache_lifetime)
+            )
+
+    def update_media_cache(self, _db, publication):
+        """Write any uploads made by publish() to the database.
+
+        If a post that used a cached upload failed, the service may
+        have forgotten the file, so the upload is forgotten too. If
+        files can't be reused, uploads are forgotten once a post
+        that used them is published.
+        """
+        used = self._used_media or set()
+        uploaded = self._uploaded_media or []
+        key = self._media_key
+        self._cached_media = self._used_media = self._uploaded_media = None
+        self._media_key = None
+        if not key or not (used or uploaded):
+            return
+        if publication.error:
+            stale = used
+        elif publication.next_retry_at or self.media_reusable:
+            stale = set()
+        else:
+            # The post was published, and its files went with it.
+            stale = used | set(digest for digest, i, l in uploaded)
+            uploaded = []
+        MediaUpload.forget(_db, key, stale, family=self.media_cache_key)
+        for digest, media_id, lifetime in uploaded:
+            MediaUpload.record(_db, key, digest, media_id, lifetime)
+
+    def send(self, post, publication):
+        """Call publish() and record how long it took and how much
+        data it sent.
+
+        A publisher that makes more than one request, or knows exactly
+        how much it sent, can call record_request() from publish().
+        Otherwise it's assumed to have made a single request containing
+        the post's content and attachments.
+        """
+        self._requests = []
+        started = time.time()
+        try:
+            return self.publish(post, publication)
+        finally:
+            duration = time.time() - started
+            requests = self._requests
+            self._requests = None
+            if not requests:
+                requests = [self.payload_size(post, publication)]
+            publication.report_cost(duration, len(requests), sum(requests))
+
+    def record_request(self, bytes_sent=0):
+        """Note that publish() made a request to the service.
+
+        :param bytes_sent: The size of the request body.
+        """
+        if self._requests is not None:
+            self._requests.append(bytes_sent)
+
+    def payload_size(self, post, publication=None):
+        """The number of bytes in a post's content and attachments."""
+        content = (publication and publication.content) or post.content or ""
+        if not isinstance(content, bytes):
+            content = content.encode("utf8")
+        return len(content) + sum(
+            self.attachment_size(x) for x in post.attachments
+        )
+
+    def attachment_size(self, attachment):
+        """The number of bytes in an attachment."""
+        if attachment.content is not None:
+            return len(attachment.content)
+        if attachment.filename:
+            path = self.attachment_path(attachment.filename)
+            if os.path.exists(path):
+                return os.path.getsize(path)
+        return 0
+
     def publish(self, post, publication):
         """Publish the content of the given Post object.
 
@@ -657,33 +1741,57 @@ class Publisher(object):
         """
         raise NotImplementedError()
 
+    def after_publish(self, _db, publication):
+        """Do any work that needs the database after an attempt to
+        publish a post.
+
+        publish() may run in a worker thread, where it can't use the
+        database. This is called afterwards from the bot's own thread,
+        once the outcome has been recorded in `publication`.
+        """
+        pass
+
+    def flush(self):
+        """Write out anything publish() has buffered.
+
+        Scripts call this once they're done with a bot. By default,
+        publishers don't buffer anything.
+        """
+        pass
+
 
 class ScraperBot(Bot):
     """This bot downloads a resource via HTTP and extracts dated posts from 
     it.
 
-    The bot's state contains the last update time, for use in making
-    HTTP conditional requests.
+    The validators sent with the resource (ETag and Last-Modified) are
+    kept in the database and used to make HTTP conditional requests.
+    If the resource hasn't changed since it was last scraped, scrape()
+    isn't called.
     """
 
     def __init__(self, model, directory, config):
         super(ScraperBot, self).__init__(model, directory, config)
         if 'url' in config:
             self._url = config['url']
+        # Set `http_cache: false` to scrape the resource every time.
+        self.http_cache = config.get('http_cache', True)
         
     @property
     def url(self):
         return self._url
 
     def make_request(self):
-        return requests.get(self.url, headers=self.headers)
+        return self.http.get(self.url, headers=self.headers)
     
     def new_post(self):
         """Scrape the site and get a number of new Posts out of it."""
         response = self.make_request()
-        if response.status_code == 304: # Not Modified
+        if not self.modified(response):
+            # The server may have sent new validators for the same
+            # document.
+            self.remember(response)
             return
-        utcnow = datetime.datetime.utcnow()
         now = _now()
         new_last_update_time = None
         posts = []
@@ -695,18 +1803,49 @@ class ScraperBot(Bot):
             if not post.publish_at:
                 post.publish_at = now
             posts.append(post)
-        self.model.last_state_update_time = utcnow
+        # Only once the document has been turned into posts is it
+        # safe to stop asking for it. If anything above failed, the
+        # next request will fetch and scrape it again.
+        self.remember(response)
         return posts
         
     @property
     def headers(self):
         headers = {}
-        if self.model.last_state_update_time:
-            headers['If-Modified-Since'] = self.model.last_state_update_time.strftime(
-                self.HTTP_TIME_FORMAT
-            )
+        if self.http_cache:
+            entry = HTTPCacheEntry.for_url(self._db, self.model, self.url)
+            if entry:
+                headers.update(entry.validators)
         return headers
 
+    def modified(self, response):
+        """Has the resource changed since the last time it was scraped?"""
+        if not self.http_cache or response.status_code not in (200, 304):
+            return response.status_code != 304 # Not Modified
+        if response.status_code == 304:
+            modified = False
+        else:
+            entry = HTTPCacheEntry.for_url(self._db, self.model, self.url)
+            modified = not (entry and entry.unchanged(response))
+        METRICS.increment(
+            'botfriend_http_cache_total',
+            dict(bot=self.module_name, outcome='miss' if modified else 'hit')
+        )
+        return modified
+
+    def remember(self, response):
+        """Store the response's validators for use in the next request.
+
+        This is called once the response has been scraped, so that a
+        document that couldn't be scraped is fetched again next time.
+        """
+        if not self.http_cache or response.status_code not in (200, 304):
+            return
+        entry, is_new = get_one_or_create(
+            self._db, HTTPCacheEntry, bot_id=self.model.id, url=self.url
+        )
+        entry.update(response)
+
     def scrape(self, response):
         raise NotImplementedError()
 
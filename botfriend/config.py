@@ -1,4 +1,3 @@
-from nose.tools import set_trace
 import os
 import sys
 import logging
@@ -62,8 +61,6 @@ class Configuration(object):
         """
         directory = directory or cls.default_directory()
         log = logging.getLogger("Loading configuration from %s" % directory)
-        database_path = os.path.join(directory, 'botfriend.sqlite')
-        _db = production_session(database_path)
         botmodels = []
         seen_names = set()
         package_init = os.path.join(directory, '__init__.py')
@@ -81,6 +78,8 @@ class Configuration(object):
             defaults = yaml.safe_load(open(default_path))
         else:
             defaults = {}
+        database_path = os.path.join(directory, 'botfriend.sqlite')
+        _db = production_session(database_path, defaults.get('storage'))
         for f in os.listdir(directory):
             bot_directory = os.path.join(directory, f)
             if os.path.isdir(bot_directory):
@@ -97,17 +96,23 @@ class Configuration(object):
                             )
                         break
                 if can_load:
-                    botmodel = BotModel.from_directory(_db, bot_directory, defaults)
+                    # Reading the configuration is cheap; importing
+                    # the bot's code is put off until it's needed.
+                    bot_config = BotModel.load_config(bot_directory, defaults)
+                    name = bot_config['name']
                     if consider_only and (
-                            botmodel.name not in consider_only
+                            name not in consider_only
                             and f not in consider_only
                     ):
                         continue
-                    if botmodel.name in seen_names:
+                    if name in seen_names:
                         raise Exception(
-                            "Two different bots are configured with the same name. (%s)" % botmodel.name
+                            "Two different bots are configured with the same name. (%s)" % name
                         )
-                    seen_names.add(botmodel.name)
+                    seen_names.add(name)
+                    botmodel = BotModel.for_directory(
+                        _db, bot_directory, bot_config
+                    )
                     botmodels.append(botmodel)
                     
         return Configuration(_db, botmodels, directory)
@@ -2,7 +2,6 @@
 # Connects feedparser to feedgen allowing round-trip creation
 # and parsing of RSS and Atom feeds.
 
-from pdb import set_trace
 import sys
 import feedparser
 from feedgen.feed import FeedGenerator
@@ -0,0 +1,304 @@
+"""Measure where the time goes while bots are processed.
+
+Code that does something worth measuring wraps it in `phase()`:
+
+    with phase(bot.module_name, 'new_post'):
+        ...
+
+This records how long the phase took, and how many SQL statements it
+ran, in the module-level registry METRICS. Nothing is recorded until
+the registry is enabled, which the scripts do when asked to export
+metrics. The numbers are exported in the Prometheus text format,
+either to a file (for node_exporter's textfile collector) or over
+HTTP.
+"""
+from contextlib import contextmanager
+import os
+import re
+import threading
+
+from .util import timer
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'
+    )
+
+def _unescape(value):
+    return re.sub(
+        r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value
+    )
+
+# A sample line from render(): a name, optional labels, and a value.
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+def _labels(labels):
+    """Render a sorted tuple of (name, value) pairs as Prometheus labels."""
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, _escape(value)) for name, value in labels
+    )
+
+
+class Metrics(object):
+    """A registry of counters and histograms."""
+
+    HELP = dict(
+        botfriend_phase_seconds="Time spent in each phase of processing a bot.",
+        botfriend_sql_statements_total="SQL statements run during each phase of processing a bot.",
+        botfriend_publications_total="Attempts to publish a post, by outcome.",
+        botfriend_http_cache_total="Resources scraped, by whether they had changed since the last time (miss) or not (hit).",
+    )
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        # Maps (name, labels) to [bucket counts, sum, count].
+        self.histograms = {}
+        self.local = threading.local()
+
+    def enable(self):
+        """Start recording, and count SQL statements from now on."""
+        if self.enabled:
+            return
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, "before_cursor_execute", self._count_statement)
+        self.enabled = True
+
+    def _count_statement(self, conn, cursor, statement, parameters, context,
+                         executemany):
+        stack = getattr(self.local, 'phases', None)
+        if stack:
+            stack[-1][1] += 1
+
+    def increment(self, name, labels, amount=1):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0, 0]
+            buckets = histogram[0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def phase(self, bot, phase, service=None):
+        """Time a phase of processing a bot, and count the SQL
+        statements it runs.
+
+        Statements run by a nested phase are counted only once, in the
+        innermost phase.
+        """
+        if not self.enabled:
+            yield
+            return
+        stack = getattr(self.local, 'phases', None)
+        if stack is None:
+            stack = self.local.phases = []
+        labels = dict(bot=bot, phase=phase)
+        if service:
+            labels['service'] = service
+        entry = [labels, 0]
+        stack.append(entry)
+        started = timer()
+        try:
+            yield
+        finally:
+            elapsed = timer() - started
+            stack.pop()
+            self.observe('botfriend_phase_seconds', labels, elapsed)
+            self.increment('botfriend_sql_statements_total', labels, entry[1])
+
+    def reset(self):
+        """Forget everything that's been measured so far."""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        """Copy the current measurements, so they can be sent from a
+        worker process to the parent and merged there.
+        """
+        with self.lock:
+            return (
+                dict(self.counters),
+                dict((k, [list(v[0]), v[1], v[2]])
+                     for k, v in self.histograms.items())
+            )
+
+    def merge(self, snapshot):
+        """Add measurements from snapshot() to this registry."""
+        counters, histograms = snapshot
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (buckets, total, count) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [
+                        [0] * len(BUCKETS), 0, 0
+                    ]
+                for i, bucket in enumerate(buckets):
+                    histogram[0][i] += bucket
+                histogram[1] += total
+                histogram[2] += count
+
+    def render(self):
+        """Export everything in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (k, [list(v[0]), v[1], v[2]])
+                for k, v in self.histograms.items()
+            )
+        seen = set()
+        def header(name, type):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self.HELP:
+                lines.append("# HELP %s %s" % (name, self.HELP[name]))
+            lines.append("# TYPE %s %s" % (name, type))
+
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name, "histogram")
+            for bound, bucket in zip(BUCKETS, buckets):
+                lines.append("%s_bucket%s %d" % (
+                    name, _labels(labels + (('le', repr(float(bound))),)),
+                    bucket
+                ))
+            lines.append("%s_bucket%s %d" % (
+                name, _labels(labels + (('le', '+Inf'),)), count
+            ))
+            lines.append("%s_sum%s %r" % (name, _labels(labels), total))
+            lines.append("%s_count%s %d" % (name, _labels(labels), count))
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append("%s%s %d" % (name, _labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def read_textfile(cls, path):
+        """Read back a file written by write_textfile().
+
+        :return: A snapshot that can be passed to merge(), or an empty
+            snapshot if the file doesn't exist. Lines that render()
+            wouldn't have written are ignored.
+        """
+        counters = {}
+        histograms = {}
+        if not os.path.exists(path):
+            return counters, histograms
+        types = {}
+        with open(path) as source:
+            for line in source:
+                line = line.rstrip("\n")
+                if line.startswith("# TYPE "):
+                    parts = line.split()
+                    if len(parts) == 4:
+                        types[parts[2]] = parts[3]
+                    continue
+                match = SAMPLE.match(line)
+                if not match:
+                    continue
+                name, labels, value = match.groups()
+                labels = [
+                    (label, _unescape(v))
+                    for label, v in LABEL.findall(labels or "")
+                ]
+                try:
+                    value = float(value)
+                except ValueError:
+                    continue
+                if types.get(name) == "counter":
+                    counters[(name, tuple(labels))] = int(value)
+                    continue
+                for suffix in ("_bucket", "_sum", "_count"):
+                    base = name[:-len(suffix)]
+                    if name.endswith(suffix) and types.get(base) == "histogram":
+                        break
+                else:
+                    continue
+                le = dict(labels).get('le')
+                key = (base, tuple(x for x in labels if x[0] != 'le'))
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histogram = histograms[key] = [[0] * len(BUCKETS), 0, 0]
+                if suffix == "_sum":
+                    histogram[1] = value
+                elif suffix == "_count":
+                    histogram[2] = int(value)
+                elif le is not None and le != '+Inf':
+                    for i, bound in enumerate(BUCKETS):
+                        if float(le) == bound:
+                            histogram[0][i] = int(value)
+        return counters, histograms
+
+    def write_textfile(self, path):
+        """Write the metrics to a file for the textfile collector.
+
+        The file is written under a temporary name and renamed into
+        place, so the collector never reads a partial file.
+        """
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, 'w') as out:
+            out.write(self.render())
+        os.rename(tmp, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the metrics over HTTP from a background thread.
+
+        :return: The HTTPServer.
+        """
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            # Python 2
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+METRICS = Metrics()
+phase = METRICS.phase
@@ -1,23 +1,37 @@
 # encoding: utf-8
 import datetime
+import hashlib
 import importlib
 import logging
 import json
 import os
+import random
 import sys
+import time
+import unicodedata
 import yaml
-from .util import isstr
-from nose.tools import set_trace
+from .metrics import phase
+from .util import (
+    isstr,
+)
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import (
     create_engine,
+    event,
+    func,
     Binary,
     Boolean,
     Column,
     Integer,
     Unicode,
     DateTime,
+    Float,
     ForeignKey,
+    Index,
+    and_,
+    case,
+    or_,
+    select,
 )
 from sqlalchemy.exc import (
     IntegrityError
@@ -25,6 +39,7 @@ from sqlalchemy.exc import (
 from sqlalchemy.orm import (
     backref,
     relationship,
+    validates,
 )
 from sqlalchemy.orm.exc import (
     NoResultFound,
@@ -51,6 +66,23 @@ def _now():
     return datetime.datetime.utcnow()
 
 Base = declarative_base()
+
+
+def content_digest(content):
+    """Calculate a fixed-width digest of a post's content, so posts
+    can be looked up by content without comparing full strings.
+
+    :param content: A string. If this is a bytestring it will be decoded
+        as UTF-8.
+    :return: The first 16 bytes of the SHA-256 digest of the
+        NFC-normalized content, or None if there is no content.
+    """
+    if content is None:
+        return None
+    if isinstance(content, bytes):
+        content = content.decode("utf8")
+    content = unicodedata.normalize("NFC", content)
+    return hashlib.sha256(content.encode("utf8")).digest()[:16]
         
 
 def create(db, model, create_method='',
@@ -109,17 +141,99 @@ def get_one_or_create(db, model, create_method='',
             return db.query(model).filter_by(**kwargs).one(), False
 
 
-def engine(filename):
+# The SQLite pragmas applied to every database connection. Any of
+# these can be overridden in the 'storage' section of default.yaml.
+DEFAULT_STORAGE_PROFILE = dict(
+    # Readers don't block the writer and the writer doesn't block
+    # readers, so the dashboard can run while bots are posting.
+    journal_mode='WAL',
+
+    # In WAL mode this is still safe against corruption; a power
+    # failure may lose the most recent commit.
+    synchronous='NORMAL',
+
+    # Memory-map up to 256 MiB of the database file.
+    mmap_size=256 * 1024 * 1024,
+
+    # Negative numbers are in KiB, so this is a 16 MiB page cache.
+    cache_size=-16000,
+
+    temp_store='MEMORY',
+
+    # Wait this many milliseconds for another process to release a
+    # lock before giving up.
+    busy_timeout=5000,
+)
+
+def storage_profile(storage=None):
+    """Combine DEFAULT_STORAGE_PROFILE with any overrides.
+
+    :param storage: A dictionary mapping SQLite pragma names to values.
+    :return: A dictionary mapping SQLite pragma names to values.
+    """
+    profile = dict(DEFAULT_STORAGE_PROFILE)
+    for pragma, value in list((storage or {}).items()):
+        if pragma not in DEFAULT_STORAGE_PROFILE:
+            raise ValueError("Unsupported storage setting: %s" % pragma)
+        invalid = ValueError(
+            "Invalid value for storage setting %s: %r" % (pragma, value)
+        )
+        if isinstance(value, bool):
+            # Otherwise this would become PRAGMA ...=True.
+            raise invalid
+        if isstr(value):
+            try:
+                value = int(value)
+            except ValueError:
+                # This must be a keyword such as WAL or NORMAL.
+                if not value.replace('_', '').isalnum():
+                    raise invalid
+        elif not isinstance(value, int):
+            raise invalid
+        profile[pragma] = value
+    return profile
+
+def storage_pragmas(connection):
+    """Find the values of the tunable SQLite pragmas currently in effect
+    for a database connection.
+
+    :return: A list of (pragma, value) 2-tuples.
+    """
+    values = []
+    for pragma in sorted(DEFAULT_STORAGE_PROFILE):
+        row = connection.execute("PRAGMA %s" % pragma).fetchone()
+        if row:
+            [value] = row
+        else:
+            # The database doesn't support this pragma, e.g. mmap_size
+            # for an in-memory database.
+            value = None
+        values.append((pragma, value))
+    return values
+
+def engine(filename, storage=None):
     """Return an engine for and database connection to the
     SQLite database at `filename`.
+
+    :param storage: A dictionary of SQLite pragmas to apply to every
+        connection, overriding DEFAULT_STORAGE_PROFILE.
     """
+    profile = storage_profile(storage)
     engine = create_engine('sqlite:///%s' % filename, echo=False)
+
+    @event.listens_for(engine, "connect")
+    def apply_storage_profile(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in sorted(profile.items()):
+            cursor.execute("PRAGMA %s=%s" % (pragma, value))
+        cursor.close()
+
     Base.metadata.create_all(engine)
     return engine, engine.connect()    
         
-def production_session(filename):
+def production_session(filename, storage=None):
     """Get a database connection to the SQLite database at `filename`."""
-    e, connection = engine(filename)
+    e, connection = engine(filename, storage)
     session = Session(connection)
     return session
 
@@ -135,23 +249,70 @@ class BotModel(Base):
     # If this is set, the bot will not post anything until this time.
     next_post_time = Column(DateTime)
 
-    # The bot's implementation may store a backlog of unscheduled
-    # posts in this field.
-    _backlog = Column(Unicode, name='backlog')
-    
     # The bot's implementation may store anything it wants in this field
     # to keep track of state between posts.
     _state = Column(Unicode, name="state")
 
     # The last time update_state() was called.
     last_state_update_time = Column(DateTime)
+
+    # How long the most recent background state refresh took, in
+    # seconds, and the error it raised, if any.
+    state_refresh_seconds = Column(Float)
+    state_refresh_error = Column(Unicode)
     
     posts = relationship('Post', backref='bot')
+
+    # The bot's implementation may store a backlog of unscheduled
+    # posts, one BacklogItem per post.
+    backlog_items = relationship(
+        'BacklogItem', backref='bot', lazy='dynamic',
+        order_by='BacklogItem.position'
+    )
     
     @property
     def log(self):
         return logging.getLogger(self.name)
    
+    # The directory containing the bot's code and configuration, and
+    # the name of that directory, which is also the name of the bot's
+    # Python module. These are set when the bot is discovered.
+    directory = None
+    module_name = None
+
+    # The Bot object that implements the creative side of this bot, and
+    # a function that will create it on demand.
+    _implementation = None
+    _implementation_loader = None
+
+    @property
+    def implementation(self):
+        """The Bot object that implements the creative side of this bot.
+
+        If the bot was discovered with BotModel.for_directory, its code
+        is imported and the Bot is created the first time this is
+        accessed.
+        """
+        if self._implementation is None and self._implementation_loader:
+            loader = self._implementation_loader
+            self._implementation_loader = None
+            with phase(self.module_name, 'load'):
+                self._implementation = loader()
+        return self._implementation
+
+    @implementation.setter
+    def implementation(self, value):
+        self._implementation = value
+
+    def flush_publishers(self):
+        """Write out anything the bot's publishers have buffered.
+
+        If the bot's code was never loaded, it hasn't published
+        anything, so there's nothing to do.
+        """
+        if self._implementation is not None:
+            self._implementation.flush_publishers()
+
     @classmethod
     def from_directory(cls, _db, directory, defaults=None):
         """Load bot code from `directory`, and find or create the
@@ -162,12 +323,41 @@ class BotModel(Base):
         :param defaults: A set of default configuration items that can
         fill in when the bot configuration is missing something.
 
-        :return: A Bot object with a reference to the appropriate
-        BotModel.
+        :return: A BotModel with a reference to the appropriate
+        Bot object.
+        """
+        config = cls.load_config(directory, defaults)
+        bot_model = cls.for_directory(_db, directory, config)
+        bot_model.implementation
+        return bot_model
+
+    @classmethod
+    def for_directory(cls, _db, directory, config):
+        """Find or create the BotModel for the bot in `directory`,
+        without importing the bot's code.
+
+        The bot's code will be imported when its implementation is
+        first needed.
+
+        :param config: The bot's configuration, as returned by
+            load_config().
+        """
+        bot_model, is_new = get_one_or_create(_db, BotModel, name=config['name'])
+        bot_model.directory = directory
+        path, bot_model.module_name = os.path.split(directory)
+        bot_model._implementation = None
+        bot_model._implementation_loader = lambda: cls.load_implementation(
+            bot_model, directory, config
+        )
+        return bot_model
+
+    @classmethod
+    def load_implementation(cls, bot_model, directory, config):
+        """Import the bot's code from `directory` and create its Bot object.
+
+        Note that the parent of `directory` must be in sys.path
         """
         path, module = os.path.split(directory)
-        bot_module = None
-        bot_class = None
         logger = logging.getLogger()
         bot_module = importlib.import_module(module)
         bot_class = getattr(bot_module, "Bot", None)
@@ -175,6 +365,20 @@ class BotModel(Base):
             from botfriend.bot import Bot
             bot_class = Bot
             logger.debug("No Bot class defined in %s/__init__.py. Assuming the default implementation is okay.", directory)
+        return bot_class(bot_model, directory, config)
+
+    @classmethod
+    def load_config(cls, directory, defaults=None):
+        """Load a bot's configuration from bot.yaml in `directory`.
+
+        This doesn't import the bot's code, so it's cheap.
+
+        :param defaults: A set of default configuration items that can
+        fill in when the bot configuration is missing something.
+
+        :return: A dictionary.
+        """
+        defaults = defaults or {}
         bot_config_file = os.path.join(directory, "bot.yaml")
         if not os.path.exists(bot_config_file):
             raise Exception(
@@ -188,6 +392,9 @@ class BotModel(Base):
             if k == 'publish':
                 # Handled separately, below.
                 continue
+            if k == 'storage':
+                # This configures the database, not the bot.
+                continue
             if not k in config:
                 config[k] = v
 
@@ -212,12 +419,9 @@ class BotModel(Base):
         if not name:
             raise Exception(
                 "Bot config file (%s) does not define a value for 'name'!" %
-                bot_config
+                bot_config_file
             )
-        bot_model, is_new = get_one_or_create(_db, BotModel, name=name)
-        bot_implementation = bot_class(bot_model, directory, config)
-        bot_model.implementation = bot_implementation
-        return bot_model
+        return config
 
     @property
     def should_make_new_post(self):
@@ -243,7 +447,7 @@ class BotModel(Base):
         _db = Session.object_session(self)
         now = _now()
         base_query = _db.query(Post).filter(
-            Post.bot==self).outerjoin(
+            Post.bot==self).filter(Post.buffered==False).outerjoin(
                 Post.publications).filter(
                     Publication.id==None)
         past_due = base_query.filter(Post.publish_at <= now).order_by(
@@ -257,6 +461,30 @@ class BotModel(Base):
             Post.created.asc()).limit(1).all()
         return next_in_line
 
+    @property
+    def next_retry_time(self):
+        """When is the earliest failed or deferred Publication due to be
+        tried again?
+
+        :return: A datetime, or None if nothing is waiting to be retried.
+        """
+        _db = Session.object_session(self)
+        return _db.query(func.min(Publication.next_retry_at)).join(
+            Publication.post).filter(Post.bot==self).scalar()
+
+    @property
+    def next_scheduled_post_time(self):
+        """When is the earliest unpublished Post scheduled to be published?
+
+        :return: A datetime, or None if no unpublished Post has a
+            `publish_at` time.
+        """
+        _db = Session.object_session(self)
+        return _db.query(func.min(Post.publish_at)).filter(
+            Post.bot==self).outerjoin(
+                Post.publications).filter(
+                    Publication.id==None).scalar()
+
     @property
     def scheduled(self):
         """All scheduled posts, in the order they will be posted.
@@ -267,7 +495,7 @@ class BotModel(Base):
         _db = Session.object_session(self)
 
         base_query = _db.query(Post).outerjoin(Post.publications).filter(
-            Post.bot==self).filter(
+            Post.bot==self).filter(Post.buffered==False).filter(
                 Publication.id==None)
 
         # We want all scheduled posts with a specific post time to
@@ -311,13 +539,30 @@ class BotModel(Base):
     @property
     def undeliverable_posts(self):
         """Find posts that had errrors when we tried to publish them to one or
-        more publications.
+        more publications, or that were never published to some service
+        because it was rate-limited.
         """
         _db = Session.object_session(self)
         return _db.query(Post).join(Post.publications).filter(
-            Post.bot==self).filter(Publication.error != None).order_by(
+            Post.bot==self).filter(
+                or_(Publication.error != None,
+                    Publication.next_retry_at != None)
+            ).order_by(
                 Publication.most_recent_attempt.asc()
-            )                
+            )
+
+    def due_publications(self, now=None):
+        """Find publications that failed, or were deferred, and are
+        now due to be tried again.
+
+        The earliest-scheduled retries come first.
+        """
+        now = now or _now()
+        _db = Session.object_session(self)
+        return _db.query(Publication).join(Publication.post).filter(
+            Post.bot==self).filter(
+                Publication.next_retry_at <= now
+            ).order_by(Publication.next_retry_at.asc(), Publication.id)
     
     @hybrid_property
     def json_state(self):
@@ -341,12 +586,14 @@ class BotModel(Base):
         self._state = new_value
         self.last_state_update_time = _now()
         
-    @hybrid_property
+    @property
     def backlog(self):
-        """Parse the bot's backlog as a JSON list."""
-        if not self._backlog:
-            return []
-        return json.loads(self._backlog)
+        """The bot's entire backlog, as a list.
+
+        This loads every item in the backlog. Use backlog_size or
+        backlog_page() if you only need part of it.
+        """
+        return [item.value for item in self.backlog_items]
 
     @backlog.setter
     def backlog(self, backlog):
@@ -358,8 +605,54 @@ class BotModel(Base):
             raise ValueError(
                 "Backlog must be a list (got %s)" % type(backlog)
             )
-        self._backlog = json.dumps(backlog)
-        
+        self.clear_backlog()
+        self.extend_backlog(backlog)
+
+    @property
+    def backlog_size(self):
+        """The number of items in the backlog."""
+        return self.backlog_items.count()
+
+    def backlog_page(self, limit=None, after=None):
+        """Load part of the backlog.
+
+        :param limit: Load at most this many items.
+        :param after: Only load items that come after this position
+            in the backlog.
+        :return: A list of BacklogItem objects.
+        """
+        qu = self.backlog_items
+        if after is not None:
+            qu = qu.filter(BacklogItem.position > after)
+        if limit is not None:
+            qu = qu.limit(limit)
+        return qu.all()
+
+    def extend_backlog(self, items):
+        """Add items to the end of the backlog.
+
+        :param items: A list of JSONable objects.
+        """
+        _db = Session.object_session(self)
+        last = _db.query(func.max(BacklogItem.position)).filter(
+            BacklogItem.bot_id==self.id).scalar()
+        if last is None:
+            position = 0
+        else:
+            position = last + 1
+        for item in items:
+            _db.add(
+                BacklogItem(
+                    bot=self, position=position, payload=json.dumps(item)
+                )
+            )
+            position += 1
+
+    def clear_backlog(self):
+        """Remove every item from the backlog."""
+        _db = Session.object_session(self)
+        _db.query(BacklogItem).filter(BacklogItem.bot_id==self.id).delete()
+
     def pop_backlog(self):
         """Pop one item off the backlog.
 
@@ -367,20 +660,197 @@ class BotModel(Base):
         item. Probably a string, but depending on the bot, it could be
         any JSONable item.
         """
-        backlog = self.backlog
-        if not backlog:
+        item = self.backlog_items.first()
+        if not item:
             return None
-        obj = backlog[0]
-        self.backlog = backlog[1:]
-        return obj
+        _db = Session.object_session(self)
+        _db.delete(item)
+        return item.value
+
+    @property
+    def buffered_posts(self):
+        """Posts that were generated ahead of time and are waiting to
+        be published, oldest first.
+        """
+        _db = Session.object_session(self)
+        return _db.query(Post).filter(Post.bot==self).filter(
+            Post.buffered==True).order_by(Post.created.asc(), Post.id.asc())
+
+    @property
+    def buffer_size(self):
+        """The number of posts generated ahead of time."""
+        return self.buffered_posts.count()
+
+    @classmethod
+    def fleet_status(cls, _db, bots, now=None):
+        """Gather what the dashboard shows about a number of bots,
+        using a handful of queries no matter how many bots there are.
+
+        :param bots: A list of BotModels.
+        :return: A dictionary mapping each bot's ID to a dictionary
+            with these keys:
+
+            last_post: The bot's most recently published Post, or None.
+            publications: The Publications of that Post.
+            scheduled: The number of posts scheduled to be published.
+            next_scheduled: The first scheduled Post, or None.
+            backlog: The number of items in the backlog.
+            next_backlog: The value of the first backlog item, or None.
+            buffered: The number of posts generated ahead of time.
+            next_post_time: When the bot will next post, if known.
+        """
+        now = now or _now()
+        ids = [bot.id for bot in bots]
+        status = dict(
+            (bot.id, dict(
+                last_post=None, publications=[], scheduled=0,
+                next_scheduled=None, backlog=0, next_backlog=None,
+                buffered=0, next_post_time=bot.next_post_time
+            ))
+            for bot in bots
+        )
+        if not ids:
+            return status
+        connection = _db.connection()
+        posts = Post.__table__
+        publications = Publication.__table__
+        backlog = BacklogItem.__table__
+
+        def first_per_bot(order_by, from_obj, *where):
+            """Find the first post for each bot, and count the posts."""
+            inner = select([
+                posts.c.bot_id, posts.c.id,
+                func.row_number().over(
+                    partition_by=posts.c.bot_id, order_by=order_by
+                ).label('rank'),
+                func.count().over(partition_by=posts.c.bot_id).label('total'),
+            ]).select_from(from_obj).where(
+                posts.c.bot_id.in_(ids)
+            ).where(and_(*where)).alias()
+            return dict(
+                (bot_id, (post_id, total))
+                for bot_id, post_id, rank, total in connection.execute(
+                    select([inner]).where(inner.c.rank==1)
+                )
+            )
+
+        # The most recent post that was published successfully.
+        last = first_per_bot(
+            publications.c.most_recent_attempt.desc(),
+            posts.join(publications),
+            publications.c.error==None,
+            publications.c.most_recent_attempt < now,
+        )
+        # Posts that haven't been published yet, in the same order as
+        # BotModel.scheduled.
+        scheduled = first_per_bot(
+            [posts.c.publish_at==None, posts.c.publish_at, posts.c.id],
+            posts.outerjoin(publications),
+            publications.c.id==None,
+            posts.c.buffered==False,
+        )
+        post_ids = [x[0] for x in list(last.values()) + list(scheduled.values())]
+        loaded = dict(
+            (post.id, post) for post in
+            _db.query(Post).filter(Post.id.in_(post_ids))
+        ) if post_ids else {}
+        for bot_id, (post_id, total) in last.items():
+            status[bot_id]['last_post'] = loaded[post_id]
+        for bot_id, (post_id, total) in scheduled.items():
+            first = loaded[post_id]
+            status[bot_id].update(scheduled=total, next_scheduled=first)
+            if first.publish_at:
+                status[bot_id]['next_post_time'] = first.publish_at
+        if last:
+            for publication in _db.query(Publication).filter(
+                Publication.post_id.in_([x[0] for x in last.values()])
+            ).order_by(Publication.id):
+                bot_id = loaded[publication.post_id].bot_id
+                status[bot_id]['publications'].append(publication)
+
+        # The size of the backlog, and the item at the front.
+        sizes = select([
+            backlog.c.bot_id, func.min(backlog.c.position).label('first'),
+            func.count().label('total')
+        ]).where(backlog.c.bot_id.in_(ids)).group_by(backlog.c.bot_id).alias()
+        for bot_id, payload, total in connection.execute(
+            select([backlog.c.bot_id, backlog.c.payload, sizes.c.total]).where(
+                and_(backlog.c.bot_id==sizes.c.bot_id,
+                     backlog.c.position==sizes.c.first)
+            )
+        ):
+            status[bot_id]['backlog'] = total
+            status[bot_id]['next_backlog'] = json.loads(payload)
+
+        for bot_id, total in connection.execute(
+            select([posts.c.bot_id, func.count()]).where(
+                posts.c.bot_id.in_(ids)
+            ).where(posts.c.buffered==True).group_by(posts.c.bot_id)
+        ):
+            status[bot_id]['buffered'] = total
+        return status
+
+    def expire_buffer(self, ttl=None):
+        """Delete buffered posts that have gone stale.
+
+        :param ttl: Delete posts created more than this many minutes
+            ago. If this is None, nothing is deleted.
+        :return: The number of posts deleted.
+        """
+        if not ttl:
+            return 0
+        _db = Session.object_session(self)
+        cutoff = _now() - datetime.timedelta(minutes=ttl)
+        expired = self.buffered_posts.filter(Post.created < cutoff).all()
+        for post in expired:
+            for attachment in post.attachments:
+                _db.delete(attachment)
+            _db.delete(post)
+        return len(expired)
+
+    def pop_buffer(self, ttl=None):
+        """Take the oldest fresh post out of the buffer.
+
+        :param ttl: Ignore (and delete) posts created more than this
+            many minutes ago.
+        :return: A Post, or None if the buffer is empty.
+        """
+        self.expire_buffer(ttl)
+        post = self.buffered_posts.first()
+        if post:
+            post.buffered = False
+        return post
+
+
+class BacklogItem(Base):
+    """An unscheduled post waiting in a bot's backlog."""
+    __tablename__ = 'backlog_items'
+    id = Column(Integer, primary_key=True)
+    bot_id = Column(Integer, ForeignKey('bots.id'), nullable=False)
+
+    # Items are popped off the backlog in order of position.
+    position = Column(Integer, nullable=False)
+
+    # The item itself, serialized as JSON.
+    payload = Column(Unicode)
+
+    __table_args__ = (
+        Index(
+            'ix_backlog_items_bot_id_position', bot_id, position,
+            unique=True
+        ),
+    )
+
+    @property
+    def value(self):
+        """Parse the payload as JSON."""
+        return json.loads(self.payload)
 
 
 class Post(Base):
     __tablename__ = 'posts'
     id = Column(Integer, primary_key=True)
-    bot_id = Column(
-        Integer, ForeignKey('bots.id'), index=True, nullable=False
-    )
+    bot_id = Column(Integer, ForeignKey('bots.id'), nullable=False)
 
     # The time the post was created.
     created = Column(DateTime)
@@ -393,8 +863,16 @@ class Post(Base):
     # to do that automatically.
     content = Column(Unicode)
 
+    # A digest of `content`, used to find duplicate posts. This is
+    # kept up to date automatically whenever `content` changes.
+    content_hash = Column(Binary(16))
+
     # A post may be marked as containing sensitive material.
     sensitive = Column(Boolean)
+
+    # A post may have been generated ahead of time, and be waiting in
+    # the bot's buffer until it's time to publish something.
+    buffered = Column(Boolean, default=False, nullable=False)
     
     # A Post may be a reply to another botfriend post.
     reply_to_id = Column(
@@ -419,9 +897,23 @@ class Post(Base):
     publications = relationship('Publication', backref='post')
     attachments = relationship('Attachment', backref='post')
 
+    __table_args__ = (
+        # Used to find a bot's scheduled posts in the order they
+        # will be published.
+        Index('ix_posts_bot_id_publish_at_id', bot_id, publish_at, id),
+
+        # Used to find a bot's existing post with some specific content.
+        Index('ix_posts_bot_id_content_hash', bot_id, content_hash),
+    )
+
     def __repr__(self):
         return "<Post %s: %s>" % (self.id, self.content)
 
+    @validates('content')
+    def _update_content_hash(self, key, content):
+        self.content_hash = content_digest(content)
+        return content
+
     @hybrid_property
     def json_state(self):
         """Parse the post's state as a JSON dictionary."""
@@ -458,9 +950,12 @@ class Post(Base):
         if isinstance(content, bytes):
             content = content.decode("utf8")
         if reuse_existing:
+            # Look the post up by its content hash, so that this is a
+            # single index probe; checking the content itself guards
+            # against the vanishingly unlikely hash collision.
             post, is_new = get_one_or_create(
                 _db, Post, bot=bot, on_multiple='interchangeable',
-                content=content
+                content_hash=content_digest(content), content=content
             )
         else:
             post, is_new = create(_db, Post, bot=bot)
@@ -523,9 +1018,7 @@ class Publication(Base):
     """
     __tablename__ = 'publications'
     id = Column(Integer, primary_key=True)
-    post_id = Column(
-        Integer, ForeignKey('posts.id'), index=True, nullable=False
-    )
+    post_id = Column(Integer, ForeignKey('posts.id'), nullable=False)
 
     # The service we published this post to.
     service = Column(Unicode)
@@ -548,11 +1041,73 @@ class Publication(Base):
     # is None, it is assumed the post was successfully published.
     error = Column(Unicode)
 
+    # If this is set, the post still needs to be published to this
+    # service, but not before this time. If `error` is None, no
+    # attempt has been made yet -- the attempt was deferred because
+    # the service wasn't ready for it.
+    next_retry_at = Column(DateTime)
+
+    # The number of times we've tried to publish this post.
+    attempts = Column(Integer, default=0, nullable=False)
+
+    # How long the most recent attempt took, in seconds, how many
+    # requests it made to the service, and how many bytes it sent.
+    duration = Column(Float)
+    requests = Column(Integer)
+    bytes_sent = Column(Integer)
+
+    # Whether `error` is worth retrying (TRANSIENT) or not (PERMANENT).
+    TRANSIENT = 'transient'
+    PERMANENT = 'permanent'
+    error_class = Column(Unicode)
+
+    # After a transient error, wait about this many seconds before
+    # trying again, doubling the wait after each failure up to
+    # MAX_RETRY_DELAY. Give up entirely after MAX_ATTEMPTS attempts.
+    RETRY_DELAY = 60
+    MAX_RETRY_DELAY = 24 * 60 * 60
+    MAX_ATTEMPTS = 10
+
+    # While a publisher is working on this Publication, it's deferred
+    # until the publisher should have finished (see
+    # Bot.mark_in_flight). This is a 2-tuple (that time, the value
+    # next_retry_at had before). It isn't stored in the database.
+    _in_flight = None
+
+    __table_args__ = (
+        # Used to check whether (and when) a post was published
+        # without loading the Publication itself.
+        Index(
+            'ix_publications_post_id_error_most_recent_attempt',
+            post_id, error, most_recent_attempt
+        ),
+        # Used to find publications that are due to be retried.
+        Index(
+            'ix_publications_next_retry_at', next_retry_at,
+            sqlite_where=next_retry_at != None
+        ),
+        # Covers everything bin/stats needs to know about the
+        # publications in a time window.
+        Index(
+            'ix_publications_most_recent_attempt_stats',
+            most_recent_attempt, service, post_id, duration, bytes_sent,
+            error_class
+        ),
+    )
+
     def display(self):
         if self.error:
             msg = self.error
             if self.most_recent_attempt != self.first_attempt:
                 msg += " (since %s)" % self.first_attempt
+            if self.next_retry_at:
+                msg += " (attempt %d, retrying %s)" % (
+                    self.attempts, self.next_retry_at.strftime(TIME_FORMAT)
+                )
+            else:
+                msg += " (gave up after %d attempts)" % self.attempts
+        elif self.next_retry_at:
+            msg = "Deferred until %s" % self.next_retry_at.strftime(TIME_FORMAT)
         else:
             if self.most_recent_attempt:
                 msg = "Published %s" % self.most_recent_attempt.strftime(TIME_FORMAT)
@@ -566,17 +1121,548 @@ class Publication(Base):
         if not self.first_attempt:
             self.first_attempt = now
         self.most_recent_attempt = now
+        self.attempts = (self.attempts or 0) + 1
         self.error = error
+        self.error_class = None
+        self.next_retry_at = None
+
+    def report_deferred(self, until):
+        """Report that we didn't try to publish this post, because
+        the service can't take it until `until`.
+        """
+        self.next_retry_at = until
+
+    def report_cost(self, duration, requests, bytes_sent):
+        """Report how much work the most recent attempt took."""
+        self.duration = duration
+        self.requests = requests
+        self.bytes_sent = bytes_sent
+
+    @property
+    def needs_publishing(self):
+        """Does this post still need to be published to this service?
+
+        A post that failed with a permanent error, or failed too many
+        times, doesn't; we've given up on it.
+        """
+        return self.next_retry_at is not None
 
     def report_success(self, external_id=None):
         self.report_attempt(error=None)
         if external_id:
             self.external_id = str(external_id)
         
-    def report_failure(self, error="Unknown error."):
+    def report_failure(self, error="Unknown error.", permanent=False):
+        """Report a failed attempt to publish this post, and schedule
+        the next attempt.
+
+        :param permanent: If this is True, trying again won't help
+            (e.g. the service rejected the post as a duplicate), so
+            there won't be another attempt.
+        """
         if isinstance(error, Exception):
             error = str(error)
         self.report_attempt(error)
+        if permanent:
+            self.error_class = self.PERMANENT
+            return
+        self.error_class = self.TRANSIENT
+        if self.attempts < self.MAX_ATTEMPTS:
+            self.next_retry_at = self.most_recent_attempt + datetime.timedelta(
+                seconds=self.retry_delay(self.attempts)
+            )
+
+    @classmethod
+    def stats(cls, _db, since, bot_ids=None, now=None):
+        """Summarize the publications most recently attempted after
+        `since`, by service and by bot.
+
+        :param bot_ids: Only consider posts by bots with these IDs.
+        :return: A 2-tuple of dictionaries, one keyed by service and
+            one by bot ID. Each value is a dictionary with the number
+            of publications, the proportion whose most recent attempt
+            failed, the 50th and 95th percentile duration in seconds,
+            and the average number of bytes sent per day.
+        """
+        now = now or _now()
+        days = max((now - since).total_seconds(), 1) / (24 * 60 * 60)
+        connection = _db.connection()
+        table = cls.__table__
+        posts = Post.__table__
+
+        def restrict(query):
+            query = query.select_from(table.join(posts)).where(
+                table.c.most_recent_attempt >= since
+            )
+            if bot_ids is not None:
+                query = query.where(posts.c.bot_id.in_(bot_ids))
+            return query
+
+        def summarize(column):
+            # The nearest-rank percentile is the smallest duration
+            # that at least that proportion of the durations are no
+            # bigger than. Publications with no duration get a
+            # partition of their own, so they don't count.
+            cume_dist = func.cume_dist().over(
+                partition_by=[column, table.c.duration == None],
+                order_by=table.c.duration
+            )
+            ranked = restrict(select([
+                column.label('key'), table.c.duration, table.c.error_class,
+                table.c.bytes_sent, cume_dist.label('cume_dist')
+            ])).alias()
+            query = select([
+                ranked.c.key, func.count(), func.count(ranked.c.error_class),
+                func.sum(ranked.c.bytes_sent)
+            ] + [
+                func.min(case([(ranked.c.cume_dist >= fraction,
+                                ranked.c.duration)]))
+                for fraction in (0.5, 0.95)
+            ]).group_by(ranked.c.key)
+
+            # The database does the sorting and counting, and sends
+            # back one row per key.
+            summary = {}
+            for key, count, errors, bytes_sent, p50, p95 in (
+                    connection.execute(query)
+            ):
+                summary[key] = dict(
+                    publications=count,
+                    error_rate=errors / float(count),
+                    p50=p50,
+                    p95=p95,
+                    bytes_per_day=(bytes_sent or 0) / days,
+                )
+            return summary
+        return summarize(table.c.service), summarize(posts.c.bot_id)
+
+    @classmethod
+    def retry_delay(cls, attempts):
+        """How many seconds to wait before trying again after the
+        given number of failed attempts.
+
+        The delay doubles after each attempt. Half of it is random, so
+        that posts which failed together don't all get retried at the
+        same moment.
+        """
+        delay = min(cls.MAX_RETRY_DELAY, cls.RETRY_DELAY * 2 ** (attempts-1))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+class RateLimit(Base):
+    """A token bucket that limits how often Botfriend makes requests to a
+    service with a particular set of credentials.
+
+    The bucket lives in the database so that it's shared between every
+    process that uses the same credentials. Times are stored as
+    seconds since the epoch so the bucket can be refilled and drawn
+    from in a single UPDATE statement.
+    """
+    __tablename__ = 'rate_limits'
+    id = Column(Integer, primary_key=True)
+
+    # Identifies the service and the credentials used to access it.
+    key = Column(Unicode, index=True, unique=True, nullable=False)
+
+    # The number of requests that can be made right now.
+    tokens = Column(Float, nullable=False)
+
+    # The last time `tokens` was updated.
+    updated = Column(Float, nullable=False)
+
+    # If this is set, the service has told us not to make any more
+    # requests until this time.
+    blocked_until = Column(Float)
+
+    @classmethod
+    def take(cls, _db, key, capacity, per_second, now=None):
+        """Try to take a token from a bucket, refilling it first.
+
+        :param capacity: The maximum number of tokens in the bucket.
+        :param per_second: The number of tokens added to the bucket
+            every second.
+        :param now: The current time, in seconds since the epoch.
+
+        :return: None if a token was taken; otherwise, a datetime
+            at which a token should be available.
+        """
+        if now is None:
+            now = time.time()
+        table = cls.__table__
+        refilled = func.min(
+            capacity, table.c.tokens + (now - table.c.updated) * per_second
+        )
+        take_token = table.update().where(table.c.key==key).where(
+            refilled >= 1).where(
+                or_(table.c.blocked_until==None,
+                    table.c.blocked_until <= now)
+            ).values(tokens=refilled-1, updated=now)
+        if _db.execute(take_token).rowcount:
+            return None
+
+        bucket = _db.query(cls).filter(cls.key==key).populate_existing().first()
+        if not bucket:
+            # This is the first time these credentials have been used.
+            # Start with a full bucket, unless another process beat us
+            # to it.
+            _db.execute(
+                table.insert().prefix_with("OR IGNORE").values(
+                    key=key, tokens=capacity, updated=now
+                )
+            )
+            if _db.execute(take_token).rowcount:
+                return None
+            bucket = _db.query(cls).filter(cls.key==key).populate_existing().one()
+
+        tokens = min(capacity, bucket.tokens + (now - bucket.updated) * per_second)
+        available = now + max(0, (1 - tokens) / float(per_second))
+        if bucket.blocked_until:
+            available = max(available, bucket.blocked_until)
+        return datetime.datetime.utcfromtimestamp(available)
+
+    @classmethod
+    def observe(cls, _db, key, capacity, remaining=None, reset_at=None,
+                now=None):
+        """Update a bucket with rate limit information that came from the
+        service itself.
+
+        :param remaining: The number of requests the service says we
+            can still make.
+        :param reset_at: The time, in seconds since the epoch, at which
+            the service says the limit will be reset.
+        """
+        if remaining is None:
+            return
+        if now is None:
+            now = time.time()
+        table = cls.__table__
+        values = dict(tokens=min(capacity, remaining), updated=now)
+        if remaining < 1 and reset_at:
+            values['blocked_until'] = reset_at
+        else:
+            values['blocked_until'] = None
+        result = _db.execute(
+            table.update().where(table.c.key==key).values(**values)
+        )
+        if not result.rowcount:
+            _db.execute(
+                table.insert().prefix_with("OR IGNORE").values(key=key, **values)
+            )
+
+
+class CircuitBreaker(Base):
+    """Keeps track of whether a service is working, so that when it's
+    down, bots stop trying to publish to it until it comes back.
+
+    A breaker starts out CLOSED. After `threshold` consecutive
+    failures it's OPEN, and nothing is sent to the service until
+    `retry_at`. Then it's HALF_OPEN: one process gets to try the
+    service, and depending on how that goes, the breaker is closed or
+    opened again.
+    """
+    __tablename__ = 'circuit_breakers'
+    id = Column(Integer, primary_key=True)
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    # Identifies the service and the endpoint we use to reach it.
+    key = Column(Unicode, index=True, unique=True, nullable=False)
+
+    state = Column(Unicode, default=CLOSED, nullable=False)
+
+    # The number of failures in a row.
+    failures = Column(Integer, default=0, nullable=False)
+
+    # The most recent time the breaker was opened.
+    opened_at = Column(DateTime)
+
+    # When the breaker is open, the time at which we can try the
+    # service again. When it's half-open, the time at which we can
+    # give up on the process that's trying the service and try it
+    # ourselves.
+    retry_at = Column(DateTime)
+
+    def __repr__(self):
+        return "<CircuitBreaker %s: %s>" % (self.key, self.state)
+
+    @classmethod
+    def for_key(cls, _db, key):
+        breaker, is_new = get_one_or_create(_db, cls, key=key)
+        if is_new:
+            breaker.state = cls.CLOSED
+            breaker.failures = 0
+        return breaker
+
+    def display(self):
+        if self.state == self.CLOSED:
+            return "%s: %s" % (self.key, self.state)
+        return "%s: %s after %d failures, retry at %s" % (
+            self.key, self.state, self.failures,
+            self.retry_at.strftime(TIME_FORMAT)
+        )
+
+    def allow(self, reset_timeout, now=None):
+        """Can we send a request to the service right now?
+
+        If the breaker is open but it's time to try the service again,
+        the breaker becomes half-open, and only the process that made
+        that change is allowed through.
+
+        :param reset_timeout: How many seconds to wait before trying
+            the service again after this call moves the breaker into
+            the half-open state.
+        :return: None if the request can go ahead; otherwise, the time
+            at which it should be tried again.
+        """
+        if self.state == self.CLOSED:
+            return None
+        now = now or _now()
+        if self.retry_at and self.retry_at > now:
+            return self.retry_at
+
+        # It's time to try the service again. Make sure only one
+        # process does it.
+        _db = Session.object_session(self)
+        table = self.__table__
+        retry_at = now + datetime.timedelta(seconds=reset_timeout)
+        result = _db.execute(
+            table.update().where(table.c.id==self.id).where(
+                table.c.state==self.state).where(
+                    table.c.retry_at==self.retry_at
+                ).values(state=self.HALF_OPEN, retry_at=retry_at)
+        )
+        won = result.rowcount
+        _db.refresh(self)
+        if won:
+            return None
+        return self.retry_at
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.retry_at = None
+
+    def record_failure(self, threshold, reset_timeout, now=None):
+        """Record a failed request, opening the breaker if necessary."""
+        now = now or _now()
+        self.failures = (self.failures or 0) + 1
+        if self.state == self.HALF_OPEN or self.failures >= threshold:
+            self.state = self.OPEN
+            self.opened_at = now
+            self.retry_at = now + datetime.timedelta(seconds=reset_timeout)
+
+
+class MediaUpload(Base):
+    """Remembers that a file was uploaded to a service, so it doesn't
+    have to be uploaded again.
+
+    Uploads are shared by every bot that uses the same credentials,
+    and a file is identified by a digest of its contents, so the same
+    image attached to two posts (or sent again when a post is retried)
+    is only uploaded once for as long as the service keeps it.
+    """
+    __tablename__ = 'media_uploads'
+    id = Column(Integer, primary_key=True)
+
+    # Identifies the service and the credentials used to access it.
+    key = Column(Unicode, nullable=False)
+
+    # A digest of the uploaded file; see media_digest().
+    digest = Column(Unicode, nullable=False)
+
+    # The ID the service gave the uploaded file.
+    media_id = Column(Unicode, nullable=False)
+
+    uploaded = Column(DateTime, nullable=False)
+
+    # The time at which the service will forget about the file.
+    expires = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_media_uploads_key_digest', key, digest, unique=True),
+    )
+
+    # Don't use an upload that's about to expire; the post might not
+    # get there in time.
+    EXPIRY_MARGIN = datetime.timedelta(minutes=10)
+
+    def __repr__(self):
+        return "<MediaUpload %s: %s>" % (self.digest, self.media_id)
+
+    @classmethod
+    def lookup(cls, _db, key, digests, now=None):
+        """Find files that have already been uploaded.
+
+        :param digests: A list of digests, as returned by media_digest().
+        :return: A dictionary mapping digests to media IDs, for the
+            files whose uploads haven't expired.
+        """
+        if not digests:
+            return {}
+        now = now or _now()
+        query = _db.query(cls.digest, cls.media_id).filter(
+            cls.key==key).filter(cls.digest.in_(set(digests))).filter(
+                cls.expires > now + cls.EXPIRY_MARGIN
+            )
+        return dict(query)
+
+    @classmethod
+    def record(cls, _db, key, digest, media_id, lifetime, now=None):
+        """Remember that a file was uploaded.
+
+        :param lifetime: The number of seconds the service will keep
+            the file.
+        """
+        now = now or _now()
+        table = cls.__table__
+        values = dict(
+            media_id=str(media_id), uploaded=now,
+            expires=now + datetime.timedelta(seconds=lifetime)
+        )
+        result = _db.execute(
+            table.update().where(table.c.key==key).where(
+                table.c.digest==digest).values(**values)
+        )
+        if not result.rowcount:
+            _db.execute(
+                table.insert().prefix_with("OR IGNORE").values(
+                    key=key, digest=digest, **values
+                )
+            )
+
+    @classmethod
+    def forget(cls, _db, key, digests, family=None, now=None):
+        """Stop using some uploads, and clean up any that have expired.
+
+        :param family: Clean up expired uploads under this key and
+            every key made from it by adding ":" and a suffix (such as
+            the per-post keys of a service whose uploads can't be
+            reused), rather than just under `key`. Otherwise the
+            uploads for a post that's never retried would stay around
+            forever.
+        """
+        now = now or _now()
+        table = cls.__table__
+        if digests:
+            _db.execute(table.delete().where(table.c.key==key).where(
+                table.c.digest.in_(set(digests)))
+            )
+        if family:
+            # ";" comes right after ":", so this is every key that
+            # starts with "family:", and it can use the index.
+            keys = or_(
+                table.c.key==family,
+                and_(table.c.key > family + ":", table.c.key < family + ";")
+            )
+        else:
+            keys = table.c.key==key
+        _db.execute(
+            table.delete().where(keys).where(table.c.expires <= now)
+        )
+
+
+def media_digest(content):
+    """Calculate a digest of an attachment's contents, for use as a key
+    in the MediaUpload table.
+
+    :param content: A bytestring.
+    :return: A hex-encoded SHA-256 digest.
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+class HTTPCacheEntry(Base):
+    """What a bot learned about a URL the last time it fetched it, so
+    the next request can be conditional.
+
+    Entries belong to a bot, not just a URL: if two bots scrape the
+    same feed, one bot being up to date doesn't mean the other is.
+
+    The document itself isn't stored. If it hasn't changed, the posts
+    scraped from it are already in the database.
+    """
+    __tablename__ = 'http_cache'
+    id = Column(Integer, primary_key=True)
+    bot_id = Column(Integer, ForeignKey('bots.id'), nullable=False)
+    url = Column(Unicode, nullable=False)
+
+    # Validators sent by the server, to be sent back as If-None-Match
+    # and If-Modified-Since.
+    etag = Column(Unicode)
+    last_modified = Column(Unicode)
+
+    # A digest of the response body (see media_digest()), so that a
+    # server which doesn't send validators can still be seen to have
+    # sent the same document again.
+    digest = Column(Unicode)
+
+    # The last time the URL was fetched.
+    fetched = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_http_cache_bot_id_url', bot_id, url, unique=True),
+    )
+
+    def __repr__(self):
+        return "<HTTPCacheEntry %s: %s>" % (self.url, self.etag)
+
+    @classmethod
+    def for_url(cls, _db, bot, url):
+        """Find a bot's cache entry for a URL.
+
+        :return: An HTTPCacheEntry, or None if the bot hasn't fetched
+            the URL before.
+        """
+        return _db.query(cls).filter(cls.bot_id==bot.id).filter(
+            cls.url==url).first()
+
+    @property
+    def validators(self):
+        """Headers that make a request conditional on the document
+        having changed since it was last fetched.
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def unchanged(self, response):
+        """Does a response contain the same document as last time?
+
+        :param response: A `requests` Response with a status code of
+            200 or 304.
+        """
+        if response.status_code == 304:
+            return True
+        # Even without a 304, the server may have sent the same
+        # document as last time.
+        return self.digest is not None and (
+            media_digest(response.content) == self.digest
+        )
+
+    def update(self, response, now=None):
+        """Remember the validators sent with a response.
+
+        :param response: A `requests` Response with a status code of
+            200 or 304.
+        """
+        headers = response.headers
+        if response.status_code == 304:
+            # The server may have sent new validators, but it won't
+            # have taken away the old ones.
+            self.etag = headers.get('ETag', self.etag)
+            self.last_modified = headers.get(
+                'Last-Modified', self.last_modified
+            )
+        else:
+            self.etag = headers.get('ETag')
+            self.last_modified = headers.get('Last-Modified')
+            self.digest = media_digest(response.content)
+        self.fetched = now or _now()
 
 
 class Attachment(Base):
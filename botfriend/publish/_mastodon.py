@@ -1,8 +1,21 @@
-from nose.tools import set_trace
-from mastodon import Mastodon
+import datetime
 from botfriend.bot import Publisher
 
 class MastodonPublisher(Publisher):
+
+    # Mastodon allows 300 API calls every five minutes per account.
+    rate_limit_capacity = 300
+    rate_limit_per_minute = 60
+
+    # Mastodon deletes an uploaded file if it isn't attached to a
+    # status within a day, and a file can only be attached to one
+    # status, so an upload is only reused when a post is retried.
+    media_cache_lifetime = 20 * 60 * 60
+    media_reusable = False
+
+    # The most files that can be attached to a status.
+    max_attachments = 4
+
     def __init__(self, bot, full_config, instance):
         for i in 'client_id', 'access_token':
             if not i in instance:
@@ -17,13 +30,27 @@ class MastodonPublisher(Publisher):
                 break
         if not url:
             url = "https://mastodon.social"
+        from mastodon import Mastodon
+        self.url = url
+        self.access_token = instance['access_token']
         self.api = Mastodon(
             client_id = instance['client_id'],
             client_secret = instance['client_secret'],
             access_token = instance['access_token'],
-            api_base_url = url
+            api_base_url = url,
+            ratelimit_method = 'throw',
+            # Don't let a request outlive the publisher's timeout.
+            request_timeout = instance.get('timeout', self.timeout),
         )
 
+    @property
+    def endpoint(self):
+        return self.url
+
+    @property
+    def rate_limit_credential(self):
+        return "%s %s" % (self.url, self.access_token)
+
     def self_test(self):
         # Do something that will raise an exception if the credentials are invalid.
         # Return a string that will let the user know if they somehow gave
@@ -36,31 +63,55 @@ class MastodonPublisher(Publisher):
             raise Exception(repr(verification))
         
     def publish(self, post, publication):
-        media_ids = []
-        arguments = dict()
-        for attachment in post.attachments:
-            if attachment.filename:
-                path = self.attachment_path(attachment.filename)
-                arguments = dict(media_file=path)
-            else:
-                arguments = dict(media_file=attachment.content,
-                                 mime_type=attachment.media_type)
-            if attachment.alt:
-                arguments['description'] = attachment.alt
+        from mastodon import MastodonAPIError, MastodonRatelimitError
         try:
-            media = None
-            if arguments:
-                media = self.api.media_post(**arguments)
-            if media:
-                media_ids.append(media['id'])
+            media_ids = [
+                self.upload(x)
+                for x in post.attachments[:self.max_attachments]
+            ]
             content = publication.content or post.content
             content = self.mastodon_safe(content)
             response = self.api.status_post(
                 content, media_ids=media_ids, sensitive=post.sensitive
             )
+            self.record_request(len(content))
             publication.report_success(response['id'])
+        except MastodonRatelimitError as e:
+            publication.report_deferred(
+                datetime.datetime.utcfromtimestamp(self.api.ratelimit_reset)
+            )
+        except MastodonAPIError as e:
+            # The second argument is the HTTP status code. 422 means
+            # the instance rejected the post itself, so sending it
+            # again won't help.
+            permanent = len(e.args) > 1 and e.args[1] == 422
+            publication.report_failure(e, permanent=permanent)
         except Exception as e:
             publication.report_failure(e)
+        self.observe_rate_limit(
+            self.api.ratelimit_remaining, self.api.ratelimit_reset
+        )
+
+    def upload(self, attachment):
+        """Upload an attachment, unless it's already been uploaded.
+
+        :return: The media ID of the uploaded file.
+        """
+        media_id = self.cached_media_id(attachment)
+        if media_id is not None:
+            return media_id
+        if attachment.filename:
+            path = self.attachment_path(attachment.filename)
+            arguments = dict(media_file=path)
+        else:
+            arguments = dict(media_file=attachment.content,
+                             mime_type=attachment.media_type)
+        if attachment.alt:
+            arguments['description'] = attachment.alt
+        media = self.api.media_post(**arguments)
+        self.record_request(self.attachment_size(attachment))
+        self.remember_media(attachment, media['id'])
+        return media['id']
 
     def mastodon_safe(self, content):
         # TODO: What counts as 'safe' depends on the mastodon instance and
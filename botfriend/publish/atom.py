@@ -1,7 +1,223 @@
+# encoding: utf-8
+"""A publisher that maintains an Atom feed of a bot's most recent posts.
+
+The feed isn't parsed and updated; it's written from scratch, from the
+posts this publisher has published according to the database. Those
+are the same rows the rest of Botfriend uses, so there's nothing extra
+to keep in sync.
+
+Attachments become enclosures. Each one is copied into a `media`
+directory next to the feed the first time it's needed, named after a
+digest of its contents, and linked relative to the feed's URL.
+
+Configuration:
+
+    publish:
+      atom:
+        filename: feed.xml
+        url: https://example.com/my-bot/feed.xml
+        size: 20        # How many posts to keep in the feed
+        batch: true     # Write the feed once per run, not once per post
+"""
+import datetime
+import mimetypes
+import os
+import shutil
+
 from botfriend.bot import Publisher
+from botfriend.model import (
+    Post,
+    Publication,
+)
+from botfriend.util import (
+    atomic_write,
+    xml_generator,
+)
 
 class AtomPublisher(Publisher):
-    def __init__(self, *args, **kwargs):
-        pass
+
+    NAMESPACE = "http://www.w3.org/2005/Atom"
+
+    # The directory, next to the feed, where attachments are written.
+    MEDIA_DIRECTORY = "media"
+
+    def __init__(self, bot, full_config, module_config):
+        module_config = module_config or {}
+        filename = module_config.get('filename', 'feed.xml')
+        if not filename.startswith(os.path.sep):
+            filename = os.path.join(bot.directory, filename)
+        self.path = filename
+        directory = os.path.split(self.path)[0]
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.bot = bot
+        self.url = module_config.get('url') or 'file://' + self.path
+        self.title = module_config.get('title') or full_config.get('name')
+        self.size = module_config.get('size', 20)
+        self.batch = module_config.get('batch', False)
+        self.stale = False
+
+    def self_test(self):
+        directory = os.path.split(self.path)[0]
+        if not os.path.exists(directory):
+            raise IOError("Destination directory %s does not exist." % directory)
+        return "%s (%d entries)" % (self.path, self.size)
+
+    def publish(self, post, publication):
+        # The post becomes part of the feed simply by being published;
+        # the feed itself is written later, from the database.
+        publication.report_success()
+
+    def after_publish(self, _db, publication):
+        if publication.error or publication.next_retry_at:
+            return
+        self.stale = True
+        if not self.batch:
+            self.write_feed(_db)
+
+    def flush(self):
+        if self.stale:
+            self.write_feed(self.bot._db)
+
+    def recent_posts(self, _db):
+        """The posts that belong in the feed, newest first.
+
+        :return: A list of (Post, Publication) 2-tuples.
+        """
+        return _db.query(Post, Publication).join(Post.publications).filter(
+            Post.bot_id==self.bot.model.id
+        ).filter(
+            Publication.service==self.service
+        ).filter(
+            Publication.error==None
+        ).filter(
+            Publication.most_recent_attempt != None
+        ).order_by(
+            Publication.most_recent_attempt.desc(), Post.id.desc()
+        ).limit(self.size).all()
+
+    def write_feed(self, _db):
+        """Write the feed out from scratch."""
+        entries = self.recent_posts(_db)
+        atomic_write(self.path, lambda out: self.render(out, entries))
+        self.stale = False
+
+    def render(self, out, entries):
+        """Write an Atom feed to a binary file.
+
+        :param entries: A list of (Post, Publication) 2-tuples.
+        """
+        xml = xml_generator(out)
+        def element(name, text=None, indent="\n  ", **attributes):
+            xml.ignorableWhitespace(indent)
+            xml.startElement(name, attributes)
+            if text is not None:
+                xml.characters(text)
+            xml.endElement(name)
+
+        if entries:
+            updated = entries[0][1].most_recent_attempt
+        else:
+            updated = datetime.datetime.utcnow()
+
+        xml.startDocument()
+        xml.startElement('feed', {'xmlns': self.NAMESPACE})
+        element('id', self.url)
+        element('title', self.title)
+        element('updated', self.timestamp(updated))
+        element('link', rel='self', href=self.url)
+        xml.ignorableWhitespace("\n  ")
+        xml.startElement('author', {})
+        element('name', self.title, "\n    ")
+        xml.ignorableWhitespace("\n  ")
+        xml.endElement('author')
+        element('generator', "Botfriend")
+        for post, publication in entries:
+            indent = "\n    "
+            content = publication.content or post.content or ""
+            xml.ignorableWhitespace("\n  ")
+            xml.startElement('entry', {})
+            element('id', "%s#post-%d" % (self.url, post.id), indent)
+            element('title', self.entry_title(content), indent)
+            published = publication.first_attempt or publication.most_recent_attempt
+            element('published', self.timestamp(published), indent)
+            element(
+                'updated', self.timestamp(publication.most_recent_attempt),
+                indent
+            )
+            element('content', content, indent, type='text')
+            for attachment in post.attachments:
+                enclosure = self.enclosure(attachment)
+                if enclosure:
+                    element('link', None, indent, rel='enclosure', **enclosure)
+            xml.ignorableWhitespace("\n  ")
+            xml.endElement('entry')
+        xml.ignorableWhitespace("\n")
+        xml.endElement('feed')
+        xml.ignorableWhitespace("\n")
+        xml.endDocument()
+
+    def enclosure(self, attachment):
+        """Make sure an attachment can be downloaded from next to the
+        feed, and describe it.
+
+        :return: A dictionary of attributes for an enclosure link, or
+            None if the attachment can't be found.
+        """
+        # Naming the copy after its contents means an attachment
+        # that's used by several posts is only copied once, and a
+        # file that changes gets a new copy.
+        digest = self.attachment_digest(attachment)
+        if digest is None:
+            return None
+        extension = mimetypes.guess_extension(attachment.media_type or '')
+        if attachment.content is not None:
+            length = len(attachment.content)
+            content = attachment.content
+            write = lambda out: out.write(content)
+        else:
+            source = self.attachment_path(attachment.filename)
+            extension = extension or os.path.splitext(source)[1]
+            length = os.path.getsize(source)
+            def write(out):
+                with open(source, 'rb') as data:
+                    shutil.copyfileobj(data, out)
+        name = digest + (extension or '')
+
+        directory = os.path.join(
+            os.path.split(self.path)[0], self.MEDIA_DIRECTORY
+        )
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            atomic_write(path, write)
+
+        try:
+            from urllib.parse import urljoin
+        except ImportError:
+            # Python 2
+            from urlparse import urljoin
+        link = dict(
+            href=urljoin(self.url, self.MEDIA_DIRECTORY + "/" + name),
+            length=str(length)
+        )
+        if attachment.media_type:
+            link['type'] = attachment.media_type
+        if attachment.alt:
+            link['title'] = attachment.alt
+        return link
+
+    @classmethod
+    def entry_title(cls, content):
+        """Use the first line of a post, more or less, as its title."""
+        title = content.strip().split("\n")[0]
+        if len(title) > 80:
+            title = title[:79] + u"…"
+        return title or "[no textual content]"
+
+    @classmethod
+    def timestamp(cls, value):
+        return value.strftime("%Y-%m-%dT%H:%M:%SZ")
 
 Publisher = AtomPublisher
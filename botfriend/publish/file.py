@@ -2,12 +2,166 @@
 
 By itself, this is mainly used for testing, but it's also the basis for
 classes like PodcastPublisher.
+
+Normally the file is opened, appended to, and closed for every
+post. With `batch: true`, every publisher writing to the same path in
+a process shares one open file, and lines are buffered until the
+`durability` policy says to write them out:
+
+* `none` (the default): when the script finishes (or, for the daemon,
+  when it finishes with the bot).
+* `flush`: after every post.
+* `fsync`: every `fsync_lines` posts or `fsync_seconds` seconds,
+  whichever comes first, and the file is fsynced afterwards. The time
+  is only checked when a post is written, but anything left over is
+  written and fsynced when the script finishes with the bot.
+
+Lines are always written with a single append, so processes writing
+to the same file never interleave partial lines. If the operating
+system writes less than it was given (which can happen when the disk
+is full or a signal arrives), the rest is written right away.
 """
+import atexit
 import os
-from nose.tools import set_trace
+import threading
+import time
 from botfriend.bot import Publisher
 from botfriend.model import _now
 
+def write_all(fd, data):
+    """Write all of `data` to the file descriptor `fd`.
+
+    os.write() may write only part of what it's given, so keep going
+    until everything has been written.
+    """
+    while data:
+        written = os.write(fd, data)
+        if not written:
+            raise IOError("Could not write to file descriptor %d" % fd)
+        data = data[written:]
+
+
+class LineWriter(object):
+    """Appends buffered lines to a file that stays open."""
+
+    NONE = 'none'
+    FLUSH = 'flush'
+    FSYNC = 'fsync'
+    POLICIES = (NONE, FLUSH, FSYNC)
+
+    # Don't hand the operating system more than this many bytes at
+    # once, so each write is appended in one piece.
+    MAX_WRITE = 64 * 1024
+
+    def __init__(self, path, durability=NONE, fsync_lines=None,
+                 fsync_seconds=None):
+        if durability not in self.POLICIES:
+            raise ValueError(
+                "Unknown durability policy %r (expected one of %s)" % (
+                    durability, ", ".join(self.POLICIES)
+                )
+            )
+        self.path = path
+        self.durability = durability
+        self.fsync_lines = fsync_lines
+        self.fsync_seconds = fsync_seconds
+        self.lock = threading.Lock()
+        self.lines = []
+        self.fd = None
+        self.last_sync = time.time()
+
+    def write(self, line):
+        """Buffer a line, and write out the buffer if the durability
+        policy calls for it.
+        """
+        with self.lock:
+            self.lines.append(line.encode("utf8"))
+            if self.durability == self.FLUSH:
+                self._write()
+            elif self.durability == self.FSYNC and self._sync_due():
+                self._write()
+                self._sync()
+
+    def _sync_due(self):
+        if self.fsync_lines and len(self.lines) >= self.fsync_lines:
+            return True
+        if (self.fsync_seconds
+            and time.time() - self.last_sync >= self.fsync_seconds):
+            return True
+        return not (self.fsync_lines or self.fsync_seconds)
+
+    def flush(self):
+        """Write out everything that's buffered, and fsync the file if
+        the durability policy calls for it.
+        """
+        with self.lock:
+            if not self.lines:
+                return
+            self._write()
+            if self.durability == self.FSYNC:
+                self._sync()
+
+    def _write(self):
+        if self.fd is None:
+            self.fd = os.open(
+                self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+        # Group whole lines into chunks of at most MAX_WRITE bytes (a
+        # single longer line gets a chunk of its own). Lines are taken
+        # out of the buffer as they're written, so if a write fails,
+        # only the lines that weren't written are left.
+        while self.lines:
+            size = len(self.lines[0])
+            count = 1
+            for line in self.lines[1:]:
+                if size + len(line) > self.MAX_WRITE:
+                    break
+                size += len(line)
+                count += 1
+            write_all(self.fd, b"".join(self.lines[:count]))
+            del self.lines[:count]
+
+    def _sync(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+        self.last_sync = time.time()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    # Writers shared by every publisher in this process, keyed by path.
+    _writers = {}
+    _writers_lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, path, *args, **kwargs):
+        """Find or create the writer for `path`.
+
+        The first publisher to ask for a path decides its durability
+        policy.
+        """
+        with cls._writers_lock:
+            writer = cls._writers.get(path)
+            if writer is None:
+                writer = cls._writers[path] = cls(path, *args, **kwargs)
+            return writer
+
+    @classmethod
+    def close_all(cls):
+        with cls._writers_lock:
+            writers = list(cls._writers.values())
+            cls._writers.clear()
+        for writer in writers:
+            writer.close()
+
+# Don't lose buffered lines if a script forgets to flush.
+atexit.register(LineWriter.close_all)
+
+
 class FileOutputPublisher(Publisher):
     def __init__(
             self, bot, full_config, module_config
@@ -19,12 +173,19 @@ class FileOutputPublisher(Publisher):
         dir, ignore = os.path.split(self.path)
         if not os.path.exists(dir):
             os.makedirs(dir)
+        self.writer = None
+        if module_config.get('batch'):
+            self.writer = LineWriter.for_path(
+                self.path, module_config.get('durability', LineWriter.NONE),
+                module_config.get('fsync_lines'),
+                module_config.get('fsync_seconds'),
+            )
 
     def self_test(self):
         dir, ignore = os.path.split(self.path)
         if not os.path.exists(dir):
             raise IOError("Destination directory %s does not exist." % dir)
-            
+
     def publish(self, post, publication):
         publish_at = post.publish_at or _now()
         content = publication.content or post.content or "[no textual content]"
@@ -41,8 +202,22 @@ class FileOutputPublisher(Publisher):
                 )
 
         output = output + " | " + (" | ".join(parts)) + "\n"
-        with open(self.path, 'a') as out:
-            out.write(output)
+        if self.writer:
+            self.writer.write(output)
+        else:
+            # A single write to a file opened for appending, so
+            # concurrent processes don't interleave their lines.
+            fd = os.open(
+                self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+            try:
+                write_all(fd, output.encode("utf8"))
+            finally:
+                os.close(fd)
         publication.report_success()
-        
+
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
+
 Publisher = FileOutputPublisher
@@ -1,23 +1,35 @@
-from pdb import set_trace
+import calendar
 import datetime
-import feedparser
 import os
 import json
-import pytz
-
-from feedgen.feed import FeedGenerator
 
 from botfriend.bot import (
     Bot,
     Publisher,
 )
-from botfriend.feedbridge import Bridge
 from botfriend.model import (
     Post,
 )
+from botfriend.util import (
+    atomic_write,
+    isstr,
+    xml_generator,
+)
 from .file import FileOutputPublisher
 
 class PodcastPublisher(FileOutputPublisher):
+    """Publishes posts as episodes of a podcast.
+
+    The entries in the feed are kept in a JSON index next to the feed
+    itself, so adding an episode means updating a short list and
+    writing the feed out again, not parsing the old feed. Both files
+    are replaced atomically.
+    """
+
+    # Dates in the index are stored in this format, in UTC.
+    DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+    ITUNES_NAMESPACE = "http://www.itunes.com/dtds/podcast-1.0.dtd"
 
     def __init__(
             self, bot, full_config, module_config
@@ -57,52 +69,136 @@ class PodcastPublisher(FileOutputPublisher):
         try:
             self._publish(post, publication)
         except Exception as e:
-            #print("oops", e)
             publication.report_failure(e)
 
     def _publish(self, post, publication):
-        #print("In _publish"_)
-        # Load or create the feed.
-        if os.path.exists(self.path):
-            feed = Bridge(open(self.path)).feed
-        else:
-            feed = FeedGenerator()
-            #print("new feed")
-        feed.load_extension('podcast')
-        #print("got feed")
-        # Set feed-level metadata.
-        feed.title(self.title)
-        feed.link(dict(href=self.url))
-        feed.description(self.description)
-        utc = pytz.timezone("UTC")
-        now = utc.localize(datetime.datetime.utcnow())
-        feed.updated(now)
-        feed.generator("Botfriend")
-        # Add one item.
         state = json.loads(post.state)
-        item = feed.add_entry()
-        guid = state['guid']
-        is_permalink = any(guid.startswith(x) for x in ('http:', 'https:'))
-        item.guid(state['guid'], is_permalink)
-        item.title(state['title'])
-        item.description(state['description'])
-        item.enclosure(
-            state['media_url'], 
-            str(state.get('media_size', 0)),
-            state['media_type']
+        entry = dict(
+            (key, state.get(key)) for key in (
+                'guid', 'title', 'description', 'media_url', 'media_size',
+                'media_type'
+            )
+        )
+        entry['published'] = datetime.datetime.utcnow().strftime(
+            self.DATE_FORMAT
+        )
+
+        # The new entry goes first. If this post was published before,
+        # it replaces the old entry rather than appearing twice.
+        entries = [entry] + [
+            x for x in self.load_entries() if x['guid'] != entry['guid']
+        ]
+        del entries[self.archive_size:]
+
+        atomic_write(
+            self.index_path,
+            lambda out: out.write(json.dumps(entries, indent=1).encode("utf8"))
         )
-        item.published(now)
-        item.updated(now)
-        #print("updated item")
-        # Trim to archive_size items
-        entries = feed._FeedGenerator__feed_entries
-        while len(entries) > self.archive_size:
-            # Remove old entries from consideration.
-            entries.pop(-1)
-
-        # Write the feed back out.
-        feed.rss_file(self.path, pretty=True)
-        #print("wrote to %s" % self.path)
+        atomic_write(self.path, lambda out: self.write_feed(out, entries))
         publication.report_success()
 
+    @property
+    def index_path(self):
+        """The file containing the entries currently in the feed."""
+        return self.path + ".json"
+
+    def load_entries(self):
+        """Load the entries currently in the feed, newest first.
+
+        :return: A list of dictionaries.
+        """
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index:
+                return json.load(index)
+        if os.path.exists(self.path):
+            # This feed was written before there was an index.
+            return self.entries_from_feed()
+        return []
+
+    def entries_from_feed(self):
+        """Extract the entries from an existing RSS file."""
+        import feedparser
+        parsed = feedparser.parse(self.path)
+        entries = []
+        for item in parsed.entries:
+            enclosure = (item.get('enclosures') or [{}])[0]
+            published = item.get('published_parsed')
+            if published:
+                published = datetime.datetime(*published[:6]).strftime(
+                    self.DATE_FORMAT
+                )
+            entries.append(dict(
+                guid=item.get('id') or enclosure.get('href'),
+                title=item.get('title'),
+                description=item.get('summary'),
+                media_url=enclosure.get('href'),
+                media_size=enclosure.get('length'),
+                media_type=enclosure.get('type'),
+                published=published,
+            ))
+        return entries
+
+    def write_feed(self, out, entries):
+        """Write an RSS feed containing `entries` to a binary file."""
+        xml = xml_generator(out)
+        def element(name, text=None, indent="\n    ", **attributes):
+            xml.ignorableWhitespace(indent)
+            xml.startElement(name, attributes)
+            if text is not None:
+                if not isstr(text):
+                    text = str(text)
+                xml.characters(text)
+            xml.endElement(name)
+
+        xml.startDocument()
+        xml.startElement('rss', {
+            'version': '2.0', 'xmlns:itunes': self.ITUNES_NAMESPACE
+        })
+        xml.ignorableWhitespace("\n  ")
+        xml.startElement('channel', {})
+        element('title', self.title)
+        element('link', self.url)
+        element('description', self.description or "")
+        element('docs', "http://www.rssboard.org/rss-specification")
+        element('generator', "Botfriend")
+        element('lastBuildDate', self.rfc822(
+            datetime.datetime.utcnow().strftime(self.DATE_FORMAT)
+        ))
+        for entry in entries:
+            xml.ignorableWhitespace("\n    ")
+            xml.startElement('item', {})
+            indent = "\n      "
+            element('title', entry.get('title'), indent)
+            if entry.get('description') is not None:
+                element('description', entry['description'], indent)
+            guid = entry['guid']
+            is_permalink = any(guid.startswith(x) for x in ('http:', 'https:'))
+            element(
+                'guid', guid, indent,
+                isPermaLink="true" if is_permalink else "false"
+            )
+            if entry.get('media_url'):
+                element(
+                    'enclosure', None, indent, url=entry['media_url'],
+                    length=str(entry.get('media_size') or 0),
+                    type=entry.get('media_type') or 'audio/mpeg'
+                )
+            if entry.get('published'):
+                element('pubDate', self.rfc822(entry['published']), indent)
+            xml.ignorableWhitespace("\n    ")
+            xml.endElement('item')
+        xml.ignorableWhitespace("\n  ")
+        xml.endElement('channel')
+        xml.ignorableWhitespace("\n")
+        xml.endElement('rss')
+        xml.ignorableWhitespace("\n")
+        xml.endDocument()
+
+    @classmethod
+    def rfc822(cls, value):
+        """Convert a date from the index into the format RSS uses."""
+        from email.utils import formatdate
+        value = datetime.datetime.strptime(value, cls.DATE_FORMAT)
+        return formatdate(calendar.timegm(value.timetuple()), usegmt=True)
+
 Publisher = PodcastPublisher
@@ -1,8 +1,6 @@
 # encoding: utf-8
 """Tumblr delivery mechanism for botfriend."""
 import re
-from nose.tools import set_trace
-import pytumblr
 import logging
 from botfriend.bot import Publisher
 
@@ -17,12 +15,18 @@ class TumblrPublisher(Publisher):
                     "Missing required Tumblr configuration key %s" % key
                 )
 
+        import pytumblr
+
         self.api = pytumblr.TumblrRestClient(
             kwargs['consumer_key'], kwargs['consumer_secret'],
             kwargs['access_token'], kwargs['access_token_secret']
         )
         self.tumblr_blog = kwargs['blog']
 
+    @property
+    def endpoint(self):
+        return "api.tumblr.com"
+
     def self_test(self):
         # Do something that will raise an exception if the credentials are invalid.
         # Return a string that will let the user know if they somehow gave
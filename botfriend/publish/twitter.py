@@ -1,15 +1,30 @@
 # encoding: utf-8
 """Twitter delivery mechanism for botfriend."""
 from io import BytesIO
+import datetime
+import mimetypes
 import re
 import unicodedata
-from nose.tools import set_trace
-import tweepy
 import logging
 from botfriend.bot import Publisher
-logging.getLogger("tweepy.binder").setLevel(logging.WARN)
+
+# Twitter error codes that mean a tweet will never be accepted: it's
+# too long, or it's a duplicate of a tweet already posted.
+PERMANENT_ERRORS = (186, 187)
 
 class TwitterPublisher(Publisher):
+
+    # Twitter allows 300 tweets every three hours per account.
+    rate_limit_capacity = 300
+    rate_limit_per_minute = 300 / 180.0
+
+    # Twitter keeps an uploaded file for a day, and it can be attached
+    # to any number of tweets in that time.
+    media_cache_lifetime = 24 * 60 * 60
+
+    # The most files that can be attached to a tweet.
+    max_attachments = 4
+
     def __init__(
             self, bot, full_config, kwargs
     ):
@@ -19,9 +34,21 @@ class TwitterPublisher(Publisher):
                 raise ValueError(
                     "Missing required Twitter configuration key %s" % key
                 )
+        import tweepy
+        logging.getLogger("tweepy.binder").setLevel(logging.WARN)
         auth = tweepy.OAuthHandler(kwargs['consumer_key'], kwargs['consumer_secret'])
         auth.set_access_token(kwargs['access_token'], kwargs['access_token_secret'])
-        self.api = tweepy.API(auth)
+        # Don't let a request outlive the publisher's timeout.
+        self.api = tweepy.API(auth, timeout=kwargs.get('timeout', self.timeout))
+        self.access_token = kwargs['access_token']
+
+    @property
+    def endpoint(self):
+        return "api.twitter.com"
+
+    @property
+    def rate_limit_credential(self):
+        return self.access_token
 
     def self_test(self):
         # Do something that will raise an exception if the credentials are invalid.
@@ -33,28 +60,88 @@ class TwitterPublisher(Publisher):
         return _twitter_safe(content)
         
     def publish(self, post, publication):
+        import tweepy
         content = publication.content or post.content
         content = self.twitter_safe(content)
         arguments = dict(status=content)
-        if post.attachments:
-            # The update_with_media API endpoint is deprecated.
-            # Here are the new docs:
-            # https://developer.twitter.com/en/docs/media/upload-media/overview
-            attachment = post.attachments[0]
-            method = self.api.update_with_media
-            if attachment.filename:
-                path = self.attachment_path(attachment.filename)
-                arguments['filename'] = path
-            else:
-                arguments['file'] = BytesIO(attachment.content)
-        else:
-            # Just a regular tweet.
-            method = self.api.update_status
         try:
-            response = method(**arguments)
+            media_ids = [
+                self.upload(x)
+                for x in post.attachments[:self.max_attachments]
+            ]
+            if media_ids:
+                arguments['media_ids'] = media_ids
+            response = self.api.update_status(**arguments)
+            if isinstance(content, str):
+                content = content.encode("utf8")
+            self.record_request(len(content))
             publication.report_success(response.id)
         except tweepy.error.TweepError as e:
-            publication.report_failure(e)
+            response = getattr(e, 'response', None)
+            reset_at = self._observe_headers(response)
+            if getattr(e, 'api_code', None) == 88 or (
+                response is not None and response.status_code == 429
+            ):
+                # We've run out of requests. Try again when Twitter
+                # says the limit will be reset.
+                if reset_at:
+                    until = datetime.datetime.utcfromtimestamp(reset_at)
+                else:
+                    until = (
+                        datetime.datetime.utcnow()
+                        + datetime.timedelta(minutes=15)
+                    )
+                publication.report_deferred(until)
+            else:
+                publication.report_failure(
+                    e, permanent=getattr(e, 'api_code', None) in PERMANENT_ERRORS
+                )
+        else:
+            self._observe_headers(getattr(self.api, 'last_response', None))
+
+    def upload(self, attachment):
+        """Upload an attachment, unless it's already been uploaded.
+
+        :return: The media ID of the uploaded file.
+        """
+        media_id = self.cached_media_id(attachment)
+        if media_id is not None:
+            return media_id
+        if attachment.filename:
+            path = self.attachment_path(attachment.filename)
+            media = self.api.media_upload(path)
+        else:
+            # Twitter needs a filename to guess the type of the file.
+            extension = mimetypes.guess_extension(
+                attachment.media_type or ''
+            ) or ''
+            media = self.api.media_upload(
+                "attachment" + extension, file=BytesIO(attachment.content)
+            )
+        self.record_request(self.attachment_size(attachment))
+        self.remember_media(
+            attachment, media.media_id,
+            getattr(media, 'expires_after_secs', None)
+        )
+        return media.media_id
+
+    def _observe_headers(self, response):
+        """Pass on the rate limit information in an HTTP response.
+
+        :return: The time, in seconds since the epoch, at which the
+            rate limit will be reset, if Twitter said.
+        """
+        if response is None:
+            return None
+        headers = response.headers
+        remaining = headers.get('x-rate-limit-remaining')
+        reset_at = headers.get('x-rate-limit-reset')
+        if remaining is not None:
+            remaining = int(remaining)
+        if reset_at is not None:
+            reset_at = int(reset_at)
+        self.observe_rate_limit(remaining, reset_at)
+        return reset_at
 
 def _twitter_safe(content):
     """Turn a string into something that won't get rejected by Twitter."""
@@ -1,15 +1,27 @@
-from nose.tools import set_trace
 from argparse import ArgumentParser
+import datetime
+import heapq
+import json
 import logging
 import os
+import signal
 import sys
 import time
 
 from .config import Configuration
+from .metrics import (
+    METRICS,
+    Metrics,
+    phase,
+)
 from .model import (
     _now,
+    BotModel,
+    CircuitBreaker,
     InvalidPost,
     Post,
+    Publication,
+    storage_pragmas,
     TIME_FORMAT,
 )
 
@@ -33,6 +45,16 @@ class BotScript(Script):
             '--config',
             help="Directory containing the botfriend database.",
         )
+        parser.add_argument(
+            '--workers',
+            help="Process bots in this many parallel worker processes. (Default is 1)",
+            type=int,
+            default=1
+        )
+        parser.add_argument(
+            '--metrics-file',
+            help="Write per-bot timings, in the Prometheus text format, to this file.",
+        )
         parser.add_argument(
             'bots', 
             help='Operate on this bot.',
@@ -41,59 +63,247 @@ class BotScript(Script):
         )
         return parser
     
-    def __init__(self):
-        """Instantiate and run a script."""
-        parser = self.parser()
-        self.args = parser.parse_args()
-        if self.args.config:
-            config_directory = self.args.config
-        else:
-            config_directory = Configuration.default_directory()
+    def __init__(self, args=None, config=None):
+        """Instantiate a script.
+
+        :param args: Parsed command-line arguments. By default, the
+            arguments are parsed from sys.argv.
+        :param config: A Configuration. By default, the configuration
+            is loaded from the directory named in the arguments.
+        """
+        if args is None:
+            args = self.parser().parse_args()
+        self.args = args
+        if config is None:
+            if self.args.config:
+                config_directory = self.args.config
+            else:
+                config_directory = Configuration.default_directory()
 
+            if not os.path.exists(config_directory):
+                self.log.warn(
+                    "%s does not exist, creating it.", config_directory
+                )
+                os.makedirs(config_directory)
 
-        if not os.path.exists(config_directory):
-            self.log.warn(
-                "%s does not exist, creating it.", config_directory
+            self.log.debug("Using config directory %s", config_directory)
+            config = Configuration.from_directory(
+                config_directory, self.args.bots
             )
-            os.makedirs(config_directory)
+        self.config = config
+        if self.metrics_file:
+            METRICS.enable()
+
+    @property
+    def metrics_file(self):
+        return getattr(self.args, 'metrics_file', None)
+
+    def load_metrics(self):
+        """Pick up where the last run's --metrics-file left off.
 
-        self.log.debug("Using config directory %s", config_directory)
-        self.config = Configuration.from_directory(config_directory, self.args.bots)
+        Counters and histograms are supposed to keep going up, but
+        every run starts counting from zero. Adding the totals from
+        the previous file means the file only ever goes up, so
+        Prometheus' rate() and increase() work across runs.
+        """
+        if self.metrics_file:
+            METRICS.merge(Metrics.read_textfile(self.metrics_file))
+
+    def write_metrics(self):
+        """Write out the metrics, if --metrics-file was given."""
+        if self.metrics_file:
+            METRICS.write_textfile(self.metrics_file)
+
+    @property
+    def sorted_bots(self):
+        return sorted(self.config.bots, key=lambda x: x.module_name)
+
+    # If this is True, --workers splits the bots between worker
+    # processes. A script that uses its workers some other way, or
+    # that reads standard input or talks to the user (which a worker
+    # process can't do), must turn this off.
+    SHARD_BOTS = True
 
     @classmethod
     def run(cls):
         instance = cls()
+        instance.load_metrics()
+        if cls.SHARD_BOTS and getattr(instance.args, 'workers', 1) > 1:
+            found = instance.process_bots_in_workers()
+        else:
+            found = instance.process_bots()
+        instance.write_metrics()
+        if not found:
+            if instance.args.bots:
+                instance.log.error("Could not find any bots named %s in %s.",
+                                   instance.args.bots, instance.config.directory
+                )
+            else:
+                instance.log.error("No bots in %s", instance.config.directory)
+
+    def process_bots(self):
+        """Process every bot, one at a time.
+
+        :return: True if there were any bots to process.
+        """
         found = False
-        for model in sorted(
-                instance.config.bots,
-                key=lambda x: x.implementation.module_name
-        ):
+        for model in self.sorted_bots:
             try:
                 found = True
-                instance.process_bot(model)
+                self.process_bot(model)
             except InvalidPost as e:
                 # This _should_ crash the whole script -- we don't
                 # want to commit invalid posts to the database.
                 raise e
             except Exception as e:
                 # Don't let a 'normal' error crash the whole script.
-                model.implementation.log.error(str(e), exc_info=e)
-        instance.config._db.commit()
-        if not found:
-            if instance.args.bots:
-                instance.log.error("Could not find any bots named %s in %s.",
-                                   instance.args.bots, instance.config.directory
+                model.log.error(str(e), exc_info=e)
+        for model in self.config.bots:
+            model.flush_publishers()
+        self.config._db.commit()
+        return found
+
+    def process_bots_in_workers(self):
+        """Split the bots between a number of worker processes.
+
+        Each worker loads its own share of the bots into its own
+        database session, and commits after processing each bot.
+
+        :return: True if there were any bots to process.
+        """
+        names = [x.module_name for x in self.sorted_bots]
+        if not names:
+            return False
+        workers = min(self.args.workers, len(names))
+        shards = [names[i::workers] for i in range(workers)]
+
+        # Make sure this process isn't holding a database lock that
+        # would block the workers, or an open SQLite connection that
+        # they would inherit: SQLite's locks don't survive a fork.
+        # Each worker opens its own session.
+        _db = self.config._db
+        _db.commit()
+        connection = _db.bind
+        _db.close()
+        connection.close()
+        connection.engine.dispose()
+
+        # The workers are forked so that they inherit the bot code
+        # that's already been imported.
+        import multiprocessing
+        context = multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            # Python 3 may default to another way of starting processes.
+            context = multiprocessing.get_context("fork")
+        pool = context.Pool(workers)
+
+        # The workers have all been started, so this process can
+        # connect again.
+        _db.bind = connection.engine.connect()
+        jobs = [
+            (self.__class__, self.args, self.config.directory, shard)
+            for shard in shards
+        ]
+        try:
+            for results, metrics in pool.imap_unordered(_process_shard, jobs):
+                METRICS.merge(metrics)
+                for result in results:
+                    self.report(result)
+        except Exception:
+            # If a worker created an invalid post, stop the other
+            # workers before they can commit anything else.
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        return True
+
+    def process_shard(self):
+        """Process this worker's share of the bots, committing after
+        each one.
+
+        :return: A list of BotRunResults.
+        """
+        results = []
+        _db = self.config._db
+        for model in self.sorted_bots:
+            name = model.module_name
+            start = time.time()
+            try:
+                self.process_bot(model)
+                model.flush_publishers()
+            except InvalidPost as e:
+                # Don't commit the invalid post, and don't process any
+                # more bots.
+                _db.rollback()
+                results.append(
+                    BotRunResult(name, time.time()-start, str(e), invalid=True)
                 )
-            else:
-                instance.log.error("No bots in %s", instance.config.directory)
-        
+                break
+            except Exception as e:
+                # The session may be unusable (e.g. the database was
+                # locked), so throw away whatever this bot did before
+                # doing anything else.
+                _db.rollback()
+                model.log.error(str(e), exc_info=e)
+                model.flush_publishers()
+                _db.commit()
+                results.append(BotRunResult(name, time.time()-start, str(e)))
+                continue
+            _db.commit()
+            results.append(BotRunResult(name, time.time()-start))
+        return results
+
+    def report(self, result):
+        """Report the outcome of processing a bot in a worker process."""
+        if result.invalid:
+            raise InvalidPost("%s: %s" % (result.name, result.error))
+        if result.error:
+            self.log.error(
+                "%s failed after %.2fs: %s", result.name, result.seconds,
+                result.error
+            )
+        else:
+            self.log.info("%s finished in %.2fs", result.name, result.seconds)
+
     def process_bot(self, bot_model):
         raise NotImplementedError()
 
 
+class BotRunResult(object):
+    """The outcome of processing one bot in a worker process."""
+
+    def __init__(self, name, seconds, error=None, invalid=False):
+        self.name = name
+        self.seconds = seconds
+        self.error = error
+        self.invalid = invalid
+
+
+def _process_shard(job):
+    """Process some bots in a worker process.
+
+    :param job: A 4-tuple (script class, parsed arguments, config
+        directory, list of bot names).
+    :return: A 2-tuple (list of BotRunResults, snapshot of the
+        metrics gathered while processing them).
+    """
+    script_class, args, directory, names = job
+    # Anything inherited from the parent process has already been
+    # counted there.
+    METRICS.reset()
+    config = Configuration.from_directory(directory, names)
+    results = script_class(args, config).process_shard()
+    return results, METRICS.snapshot()
+
+
 class SingleBotScript(BotScript):
     """A script that _must_ be run against a single bot."""
 
+    # There's only one bot, and the script may read standard input.
+    SHARD_BOTS = False
+
     @classmethod
     def parser(cls):
         parser = ArgumentParser()
@@ -113,66 +323,122 @@ class SingleBotScript(BotScript):
 class RepublicationScript(BotScript):
     """Attempt to publish already created posts that failed in their
     delivery.
+
+    Failed publications are retried with exponential backoff, so only
+    the ones that are due are tried.
     """
     @classmethod
     def parser(cls):
         parser = BotScript.parser()
         parser.add_argument(
             "--limit",
-            help="Limit the number of posts to republish per bot.",
+            help="Limit the number of publications to retry per bot.",
             type=int,
             default=1
         )
         return parser
     
     def process_bot(self, bot_model):
-        undelivered = bot_model.undeliverable_posts.limit(self.args.limit)
-        for post in undelivered:
-            for publication in post.publications:
-                if not publication.error:
-                    continue
-                # Find the publisher responsible for this
-                matches  = [x for x in bot_model.implementation.publishers
-                            if x.service == publication.service]
-                if not matches:
-                    # This bot doesn't use this publisher anymore.
-                    continue
-                [publisher] = matches
-                bot_model.log.info(
-                    "Attempting to republish to %s: %s" % (
-                        publication.service,
-                        post.content
-                    )
-                )
-                bot_model.implementation.post_to_publisher(publisher, post, publication)
-                if publication.error:
-                    bot_model.log.info("Failure: %s" % publication.error)
-                else:
-                    bot_model.log.info("Success!")
+        due = bot_model.due_publications().limit(self.args.limit).all()
+        if due:
+            bot_model.implementation.republish(due)
 
 
 class BotListScript(BotScript):
     """List your bots."""
 
     def process_bot(self, model):
-        print(model.implementation.module_name)
+        print(model.module_name)
 
 
 class DashboardScript(BotScript):
-    """Display the current status of one or more bots."""
-    def process_bot(self, bot_model):
+    """Display the current status of one or more bots.
+
+    Everything shown is gathered for all the bots at once by
+    BotModel.fleet_status, so the number of queries doesn't grow with
+    the number of bots.
+    """
+
+    NAME = "Dashboard"
+
+    # There's one set of queries for all the bots.
+    SHARD_BOTS = False
 
+    @classmethod
+    def parser(cls):
+        parser = BotScript.parser()
+        parser.add_argument(
+            '--json',
+            help="Also write the status of every bot as JSON to this file.",
+        )
+        return parser
+
+    def __init__(self, args=None, config=None):
+        super(DashboardScript, self).__init__(args, config)
+        # Show the database settings actually in effect, which may
+        # not be the ones that were asked for.
+        pragmas = storage_pragmas(self.config._db.connection())
+        self.log.info(
+            "Storage: %s" % ", ".join("%s=%s" % x for x in pragmas)
+        )
+        # Show any services that bots have stopped publishing to.
+        tripped = self.config._db.query(CircuitBreaker).filter(
+            CircuitBreaker.state != CircuitBreaker.CLOSED
+        ).order_by(CircuitBreaker.key)
+        for breaker in tripped:
+            self.log.info("Circuit breaker %s" % breaker.display())
+
+    def process_bots(self):
+        bots = self.sorted_bots
+        if not bots:
+            return False
+        now = _now()
+        status = BotModel.fleet_status(self.config._db, bots, now)
+        for bot_model in bots:
+            self.show(bot_model, status[bot_model.id], now)
+        if getattr(self.args, 'json', None):
+            with open(self.args.json, 'w') as out:
+                json.dump(
+                    [self.to_json(x, status[x.id]) for x in bots],
+                    out, indent=2, sort_keys=True
+                )
+        return True
+
+    def process_bot(self, bot_model):
         now = _now()
-        recent = bot_model.recent_posts().limit(1).all()
+        status = BotModel.fleet_status(self.config._db, [bot_model], now)
+        self.show(bot_model, status[bot_model.id], now)
+
+    def show(self, bot_model, status, now):
+        """Log the status of one bot.
+
+        :param status: The bot's entry in BotModel.fleet_status().
+        """
+        recent = status['last_post']
         if not recent:
             bot_model.log.info("Has never posted.")
         else:
-            [recent] = recent
             bot_model.log.info("Most recent post: %s" % recent.content)
-            for publication in recent.publications:
-                if publication.error:
+            for publication in status['publications']:
+                if publication.next_retry_at and publication.error:
+                    bot_model.log.info(
+                        "%s ERROR: %s (retrying at %s)" % (
+                            publication.service, publication.error,
+                            publication.next_retry_at
+                        )
+                    )
+                elif publication.next_retry_at:
+                    bot_model.log.info(
+                        "%s deferred until %s" % (
+                            publication.service, publication.next_retry_at
+                        )
+                    )
+                elif publication.error:
                     bot_model.log.info(
-                        "%s ERROR: %s" % (publication.service, publication.error)
+                        "%s ERROR: %s (gave up after %d attempts)" % (
+                            publication.service, publication.error,
+                            publication.attempts
+                        )
                     )
                 else:
                     bot_model.log.info(
@@ -192,22 +458,33 @@ class DashboardScript(BotScript):
             bot_model.log.info("Next up: %s" % content)
                     
         # Announce scheduled posts.
-        scheduled = bot_model.scheduled
-        next_post_time = bot_model.next_post_time
-        if len(scheduled) > 0:
-            first = scheduled[0]
-            announce_list(len(scheduled), first.content, "scheduled")
-            next_post_time = first.publish_at or bot_model.next_post_time
+        if status['scheduled']:
+            announce_list(
+                status['scheduled'], status['next_scheduled'].content,
+                "scheduled"
+            )
+
+        # Announce problems refreshing the bot's state.
+        if bot_model.state_refresh_error:
+            bot_model.log.info(
+                "State refresh failed: %s" % bot_model.state_refresh_error
+            )
+        elif bot_model.state_refresh_seconds:
+            bot_model.log.info(
+                "State refresh took %.1fs" % bot_model.state_refresh_seconds
+            )
+
+        # Announce posts generated ahead of time.
+        if status['buffered']:
+            bot_model.log.info("%d posts pre-generated" % status['buffered'])
 
         # Announce backlog posts.
-        try:
-            backlog = bot_model.backlog
-            if backlog:
-                first = backlog[0]
-                announce_list(len(backlog), first, "in backlog")
-        except ValueError as e:
-            pass
-        
+        if status['backlog']:
+            announce_list(
+                status['backlog'], status['next_backlog'], "in backlog"
+            )
+
+        next_post_time = status['next_post_time']
         if next_post_time:
             minutes = (next_post_time-now).total_seconds()/60
             if minutes < 0:
@@ -218,10 +495,145 @@ class DashboardScript(BotScript):
         else:
             bot_model.log.info("Next post not scheduled.")
 
+    def to_json(self, bot_model, status):
+        """Convert a bot's status into something that can be written
+        out as JSON.
+        """
+        def time(value):
+            if value is None:
+                return None
+            return value.isoformat()
+
+        def publication_status(publication):
+            if publication.next_retry_at and publication.error:
+                return "retrying"
+            elif publication.next_retry_at:
+                return "deferred"
+            elif publication.error:
+                return "failed"
+            return "published"
+
+        recent = status['last_post']
+        if recent:
+            last_post = dict(
+                content=recent.content,
+                publications=[
+                    dict(
+                        service=x.service, status=publication_status(x),
+                        error=x.error, attempts=x.attempts,
+                        most_recent_attempt=time(x.most_recent_attempt),
+                        next_retry_at=time(x.next_retry_at),
+                    ) for x in status['publications']
+                ]
+            )
+        else:
+            last_post = None
+        scheduled = status['next_scheduled']
+        return dict(
+            bot=bot_model.module_name,
+            name=bot_model.name,
+            last_post=last_post,
+            scheduled=dict(
+                count=status['scheduled'],
+                next=scheduled.content if scheduled else None,
+                next_publish_at=time(scheduled.publish_at) if scheduled else None,
+            ),
+            backlog=dict(
+                count=status['backlog'], next=status['next_backlog']
+            ),
+            buffered=status['buffered'],
+            next_post_time=time(status['next_post_time']),
+            state_refresh_seconds=bot_model.state_refresh_seconds,
+            state_refresh_error=bot_model.state_refresh_error,
+        )
+
             
+class StatsScript(BotScript):
+    """Show how publishing has been going, by service and by bot:
+    latency, error rate, and how much data is being sent.
+    """
+
+    NAME = "Stats"
+
+    # There's one query for all the bots.
+    SHARD_BOTS = False
+
+    ROW = "%-24s %8s %7s %8s %8s %10s"
+
+    @classmethod
+    def parser(cls):
+        parser = BotScript.parser()
+        parser.add_argument(
+            '--days',
+            help="Look at publications attempted in the last this many days. (Default is 7)",
+            type=float,
+            default=7
+        )
+        parser.add_argument(
+            '--json',
+            help="Write the statistics as JSON to this file.",
+        )
+        return parser
+
+    def process_bots(self):
+        bots = dict((x.id, x.name) for x in self.config.bots)
+        if not bots:
+            return False
+        now = _now()
+        since = now - datetime.timedelta(days=self.args.days)
+        bot_ids = list(bots) if self.args.bots else None
+        by_service, by_bot = Publication.stats(
+            self.config._db, since, bot_ids, now
+        )
+        by_bot = dict(
+            (bots.get(bot_id, "Bot %s" % bot_id), summary)
+            for bot_id, summary in by_bot.items()
+        )
+        if self.args.json:
+            with open(self.args.json, 'w') as out:
+                json.dump(
+                    dict(since=since.strftime(TIME_FORMAT),
+                         services=by_service, bots=by_bot),
+                    out, indent=2, sort_keys=True
+                )
+        print("Publications since %s" % since.strftime(TIME_FORMAT))
+        for heading, summaries in (("Service", by_service), ("Bot", by_bot)):
+            print("")
+            print(self.ROW % (
+                heading, "Posts", "Errors", "p50", "p95", "Sent/day"
+            ))
+            for key, summary in sorted(summaries.items()):
+                print(self.ROW % (
+                    key, summary['publications'],
+                    "%.1f%%" % (summary['error_rate'] * 100),
+                    _seconds(summary['p50']), _seconds(summary['p95']),
+                    _bytes(summary['bytes_per_day'])
+                ))
+        return True
+
+
+def _seconds(value):
+    if value is None:
+        return "-"
+    if value < 1:
+        return "%dms" % (value * 1000)
+    return "%.2fs" % value
+
+def _bytes(value):
+    for unit in ("B", "KiB", "MiB"):
+        if value < 1024:
+            return "%.1f %s" % (value, unit)
+        value /= 1024.0
+    return "%.1f GiB" % value
+
+
 class PostScript(BotScript):
     """Create a new post for one or all bots."""
 
+    # By default, wait this many seconds for a background state refresh
+    # to finish before exiting.
+    STATE_REFRESH_TIMEOUT = 60
+
     @classmethod
     def parser(cls):
         parser = BotScript.parser()
@@ -235,6 +647,11 @@ class PostScript(BotScript):
             help="Post even if the scheduler would not normally post now.",
             action='store_true'
         )
+        parser.add_argument(
+            '--state-refresh-timeout',
+            help="Wait this many seconds for a background state refresh to finish before giving up on it. (Default: %(default)s)",
+            type=float, default=cls.STATE_REFRESH_TIMEOUT
+        )
         return parser
     
     def process_bot(self, bot_model):
@@ -253,7 +670,252 @@ class PostScript(BotScript):
         for post in posts:
             for publication in implementation.publish(post):
                 publication.post.bot.log.info(publication.display())
-        self.config._db.commit()
+        with phase(bot_model.module_name, 'commit'):
+            self.config._db.commit()
+
+        # Now that nothing is waiting on us, get ready for next time.
+        if implementation.fill_buffer():
+            self.config._db.commit()
+
+        # If the bot's state was being refreshed in the background,
+        # wait a while for that to finish so the new state isn't lost
+        # when this process exits.
+        if implementation.finish_state_refresh(
+                timeout=self.args.state_refresh_timeout
+        ) or implementation.abandon_state_refresh():
+            self.config._db.commit()
+
+class DaemonScript(BotScript):
+    """Stay running, and process each bot only when it has something to do.
+
+    Configuration is loaded once. Bots are kept in a priority queue
+    ordered by Bot.next_action_time, and the daemon sleeps until the
+    earliest of those times. When it processes a bot, it also retries
+    any of the bot's publications that are due, as bin/republish
+    would.
+
+    A bot that had nothing to post, but would like to be processed
+    again right away (say, because its backlog is empty), is backed
+    off: the daemon waits twice as long each time, up to
+    --max-interval.
+
+    SIGHUP reloads the configuration. (Changes to a bot's Python code
+    still require a restart.) SIGTERM or SIGINT makes the daemon exit
+    once it's finished with the current bot.
+    """
+
+    NAME = "Daemon"
+
+    @classmethod
+    def parser(cls):
+        parser = BotScript.parser()
+        parser.add_argument(
+            '--min-interval',
+            help="Wait at least this many seconds before processing the same bot again. (Default is 60)",
+            type=int,
+            default=60
+        )
+        parser.add_argument(
+            '--max-interval',
+            help="Check on every bot at least this often, in seconds, in case posts were scheduled by another process. (Default is 900)",
+            type=int,
+            default=900
+        )
+        parser.add_argument(
+            '--republish-limit',
+            help="Retry at most this many failed publications per bot each time it's processed. (Default is 1)",
+            type=int,
+            default=1
+        )
+        parser.add_argument(
+            '--metrics-port',
+            help="Serve per-bot timings, in the Prometheus text format, over HTTP on this port.",
+            type=int,
+        )
+        return parser
+
+    @classmethod
+    def run(cls):
+        parser = cls.parser()
+        args = parser.parse_args()
+        if args.workers != 1:
+            parser.error(
+                "the daemon processes one bot at a time, so --workers "
+                "isn't supported"
+            )
+        instance = cls(args)
+        instance.load_metrics()
+        if instance.args.metrics_port:
+            METRICS.enable()
+            METRICS.serve(instance.args.metrics_port)
+        instance.install_signal_handlers()
+        instance.loop()
+
+    def install_signal_handlers(self):
+        self.reload_requested = False
+        self.stop_requested = False
+
+        def reload(signum, frame):
+            self.reload_requested = True
+
+        def stop(signum, frame):
+            self.stop_requested = True
+        signal.signal(signal.SIGHUP, reload)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+    def reload(self):
+        """Reload the configuration from disk and start the queue over."""
+        directory = self.config.directory
+        self.close_database()
+        self.config = Configuration.from_directory(directory, self.args.bots)
+        self.log.info("Reloaded configuration from %s", directory)
+        self.build_queue()
+
+    def close_database(self):
+        """Close the session, along with its connection and engine,
+        so reloading doesn't leave them open.
+        """
+        _db = self.config._db
+        connection = _db.bind
+        _db.close()
+        connection.close()
+        connection.engine.dispose()
+
+    def build_queue(self):
+        self.queue = []
+        self.deadlines = {}
+        # How many times in a row each bot has had nothing to do.
+        self.idle_rounds = {}
+        if not self.config.bots:
+            self.log.error("No bots in %s", self.config.directory)
+        for bot_model in self.config.bots:
+            self.schedule(bot_model, _now())
+
+    def schedule(self, bot_model, earliest, idle=False):
+        """Put a bot into the queue, to be processed when it next has
+        something to do.
+
+        :param earliest: Don't process the bot before this time.
+        :param idle: If this is True, the bot was just processed and
+            had nothing to do. If it still wants to be processed right
+            away, it's backed off instead.
+        """
+        try:
+            deadline = bot_model.implementation.next_action_time
+        except Exception as e:
+            bot_model.log.error(str(e), exc_info=e)
+            deadline = None
+        now = _now()
+        if idle and (not deadline or deadline <= now):
+            rounds = self.idle_rounds.get(bot_model.name, 0) + 1
+            self.idle_rounds[bot_model.name] = rounds
+            backoff = min(
+                self.args.min_interval * 2 ** rounds, self.args.max_interval
+            )
+            earliest = max(earliest, now + datetime.timedelta(seconds=backoff))
+        else:
+            self.idle_rounds.pop(bot_model.name, None)
+        latest = now + datetime.timedelta(seconds=self.args.max_interval)
+        deadline = max(earliest, min(deadline or latest, latest))
+        self.deadlines[bot_model.name] = deadline
+
+        # The bot's name breaks ties, so BotModels are never compared.
+        heapq.heappush(self.queue, (deadline, bot_model.name, bot_model))
+
+    def loop(self):
+        self.build_queue()
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+                continue
+            if not self.queue:
+                self.sleep_until(
+                    _now() + datetime.timedelta(seconds=self.args.max_interval)
+                )
+                continue
+            deadline, name, bot_model = self.queue[0]
+            if self.deadlines.get(name) != deadline:
+                # This entry was superseded when the bot was rescheduled.
+                heapq.heappop(self.queue)
+                continue
+            if deadline > _now():
+                self.sleep_until(deadline)
+                continue
+            heapq.heappop(self.queue)
+            started = _now()
+            done = self.process_bot_safely(bot_model)
+            self.write_metrics()
+            idle = not (
+                done or bot_model.implementation.state_refresh_in_progress
+            )
+            self.schedule(
+                bot_model,
+                started + datetime.timedelta(seconds=self.args.min_interval),
+                idle
+            )
+        self.close_database()
+        self.log.info("Shut down.")
+
+    def sleep_until(self, deadline):
+        """Sleep until `deadline`, waking up early if a signal arrives."""
+        while not (self.stop_requested or self.reload_requested):
+            remaining = (deadline - _now()).total_seconds()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 1))
+
+    def process_bot_safely(self, bot_model):
+        """Process a bot, logging any error rather than raising it.
+
+        :return: The number of posts published and publications
+            retried.
+        """
+        _db = self.config._db
+        try:
+            done = self.process_bot(bot_model)
+            bot_model.flush_publishers()
+            _db.commit()
+            return done
+        except InvalidPost as e:
+            # We don't want to commit invalid posts to the database,
+            # but that's no reason to stop posting for the other bots.
+            _db.rollback()
+            bot_model.log.error(str(e), exc_info=e)
+        except Exception as e:
+            _db.rollback()
+            bot_model.log.error(str(e), exc_info=e)
+        return 0
+
+    def process_bot(self, bot_model):
+        """Publish whatever the bot has to publish, retry any
+        publications that are due, and get ready for next time.
+
+        :return: The number of posts published and publications
+            retried.
+        """
+        implementation = bot_model.implementation
+        posts = implementation.publishable_posts
+        for post in posts:
+            for publication in implementation.publish(post):
+                bot_model.log.info(publication.display())
+        due = bot_model.due_publications().limit(
+            self.args.republish_limit
+        ).all()
+        implementation.republish(due)
+        # Commit what's been published before spending time on posts
+        # that won't be needed until later.
+        with phase(bot_model.module_name, 'commit'):
+            self.config._db.commit()
+        implementation.fill_buffer()
+
+        # Pick up the result of a background state refresh, or start
+        # one if it's time. Either way, don't wait for it.
+        implementation.finish_state_refresh()
+        implementation.start_state_refresh()
+        return len(posts) + len(due)
+
 
 class StateAwareScript(BotScript):
 
@@ -287,6 +949,9 @@ class StateShowScript(StateAwareScript):
 class StateSetScript(StateAwareScript):
     """Set the internal state for a bot."""
 
+    # This may read standard input.
+    SHARD_BOTS = False
+
     @classmethod
     def parser(cls):
         parser = SingleBotScript.parser()
@@ -325,21 +990,75 @@ class StateRefreshScript(StateAwareScript):
         print(self._state_status(bot_model))
 
 class StressTestScript(BotScript):
-    """Stress-test a bot's generative capabilities without posting anything."""
+    """Stress-test a bot's generative capabilities without posting anything.
+
+    For a bot with a generate_text() method, the rounds are split
+    between --workers processes and the script reports throughput,
+    latency, memory use, and how often the generator came up empty
+    or repeated an archived post. Other bots fall back to their own
+    stress_test() method.
+    """
+
+    # --workers splits up each bot's rounds, not the bots themselves.
+    SHARD_BOTS = False
 
     @classmethod
     def parser(cls):
+        import multiprocessing
+        try:
+            workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+            workers = 1
         parser = BotScript.parser()
+        parser.set_defaults(workers=workers)
         parser.add_argument(
             '--rounds',
             help="Run the bot's generator this many times. (Default is 10,000)",
             type=int,
             default=10000
         )
+        parser.add_argument(
+            '--seed',
+            help="Seed the random number generator in worker N with this number plus N. (Default is 0)",
+            type=int,
+            default=0
+        )
+        parser.add_argument(
+            '--print',
+            help="Print the generated text.",
+            dest='show',
+            action='store_true'
+        )
+        parser.add_argument(
+            '--json',
+            help="Write the results as JSON to this file.",
+        )
         return parser
 
+    def process_bots(self):
+        self.results = []
+        found = super(StressTestScript, self).process_bots()
+        if self.args.json and self.results:
+            with open(self.args.json, 'w') as out:
+                json.dump(self.results, out, indent=2, sort_keys=True)
+        return found
+
     def process_bot(self, bot_model):
-        bot_model.implementation.stress_test(self.args.rounds)
+        implementation = bot_model.implementation
+        if not hasattr(implementation, 'generate_text'):
+            implementation.stress_test(self.args.rounds)
+            return
+        from .benchmark.stress import describe, stress_test
+
+        # Make sure the workers see everything this process knows.
+        self.config._db.commit()
+        result = stress_test(
+            self.config.directory, bot_model.module_name, self.args.rounds,
+            self.args.workers, self.args.seed, self.args.show
+        )
+        for line in describe(result):
+            bot_model.log.info(line)
+        self.results.append(result)
 
 class PublisherTestScript(BotScript):
     """Verify  that a bot's publishers are functioning without posting anything."""
@@ -352,7 +1071,10 @@ class PublisherTestScript(BotScript):
             except Exception as e:
                 print("FAIL %s %s: %s" % (
                     bot_model.name, publisher.service, e
-                ))        
+                ))
+            breaker = publisher.circuit_breaker(self.config._db, create=False)
+            if breaker:
+                print("     circuit breaker %s" % breaker.display())
 
 class BacklogShowScript(BotScript):
     """Show the backlog posts for a bot."""
@@ -368,23 +1090,32 @@ class BacklogShowScript(BotScript):
         )
         return parser
 
+    # Read the backlog this many items at a time.
+    PAGE_SIZE = 1000
+
     def process_bot(self, bot_model):
-        backlog = bot_model.implementation.backlog
-        count = len(backlog)
-        if self.args.limit:
-            max_i = self.args.limit - 1
-        else:
-            max_i = None
+        count = bot_model.backlog_size
         if count:
             if count == 1:
                 item = "post"
             else:
                 item = "posts"
             bot_model.log.info("%d %s in backlog" % (count, item))
-            for i, content in enumerate(backlog):
-                bot_model.log.info(content)
-                if max_i is not None and i > max_i:
+            # A limit of zero, like no limit at all, shows the whole
+            # backlog.
+            remaining = self.args.limit or None
+            position = None
+            while remaining is None or remaining > 0:
+                page_size = self.PAGE_SIZE
+                if remaining is not None:
+                    page_size = min(page_size, remaining)
+                    remaining -= page_size
+                page = bot_model.backlog_page(limit=page_size, after=position)
+                if not page:
                     break
+                for backlog_item in page:
+                    bot_model.log.info(backlog_item.value)
+                position = page[-1].position
         else:
             bot_model.log.info("No backlog.")
 
@@ -422,14 +1153,13 @@ class BacklogLoadScript(SingleBotScript):
                 )
         bot.extend_backlog(items)
         self.log.info("Appended %d items to backlog." % len(items))
-        self.log.info("Backlog size now %d items" % len(bot_model.backlog))
+        self.log.info("Backlog size now %d items" % bot_model.backlog_size)
 
 
 class BacklogClearScript(SingleBotScript):
 
     def process_bot(self, bot_model):
-        backlog = bot_model.backlog
-        if backlog:
+        if bot_model.backlog_size:
             bot_model.log.warn(
                 "About to clear the backlog for %s.", bot_model.name
             )
@@ -1,16 +1,45 @@
 import datetime
+import gzip
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+import os
+import shutil
+import tempfile
+import threading
+import time
 from nose.tools import (
     assert_raises,
     eq_,
     set_trace,
 )
 from . import DatabaseTest
-from bot import Bot
+from metrics import (
+    METRICS,
+    Metrics,
+)
+from bot import (
+    Bot,
+    Publisher,
+    ScraperBot,
+    TextGeneratorBot,
+)
+from publish.file import (
+    FileOutputPublisher,
+    LineWriter,
+)
+from publish.atom import AtomPublisher
+from publish.podcast import PodcastPublisher
 from model import (
+    CircuitBreaker,
     InvalidPost,
+    media_digest,
     Post,
+    Publication,
     _now,
 )
+from web import HTTPClient
 
 class TestBot(DatabaseTest):
     
@@ -194,3 +223,1206 @@ class TestBot(DatabaseTest):
         delta = bot._next_scheduled_post([])
         assert isinstance(delta, datetime.timedelta)
         eq_(6*60, delta.seconds)
+
+    def test_next_action_time(self):
+        bot = self._bot(StateRefreshBot, config=dict(schedule=60))
+        now = _now()
+
+        # A bot that has never posted needs to post right away.
+        bot.model.next_post_time = None
+        assert bot.next_action_time <= _now()
+
+        # Otherwise, it has something to do at its next post time.
+        in_an_hour = now + datetime.timedelta(hours=1)
+        bot.model.next_post_time = in_an_hour
+        eq_(in_an_hour, bot.next_action_time)
+
+        # ...or when its next scheduled post needs to be published,
+        # if that's sooner.
+        in_a_minute = now + datetime.timedelta(minutes=1)
+        self._post(bot.model, "scheduled", publish_at=in_a_minute)
+        eq_(in_a_minute, bot.model.next_scheduled_post_time)
+        eq_(in_a_minute, bot.next_action_time)
+
+        # ...or when its state needs to be updated, if that's sooner.
+        bot.state_update_schedule = 0.5
+        bot.model.last_state_update_time = now
+        eq_(now + datetime.timedelta(seconds=30), bot.next_state_update_time)
+        eq_(now + datetime.timedelta(seconds=30), bot.next_action_time)
+
+        # ...or, if state is refreshed in the background, when that
+        # refresh should start.
+        bot.state_update_lead = 0.25
+        eq_(now + datetime.timedelta(seconds=15), bot.next_action_time)
+
+        # ...or when a failed publication is due to be retried.
+        post = self._post(bot.model, "failed")
+        publication = Publication(post=post, service="a")
+        self._db.add(publication)
+        publication.report_deferred(now + datetime.timedelta(seconds=5))
+        eq_(now + datetime.timedelta(seconds=5), bot.model.next_retry_time)
+        eq_(now + datetime.timedelta(seconds=5), bot.next_action_time)
+
+
+class StateRefreshBot(Bot):
+    """Refreshes its state by calling a function."""
+
+    def refresh_state(self, state, last_update):
+        self.update_thread = threading.current_thread()
+        self.refreshed_from = (state, last_update)
+        return self.refresh()
+
+
+class TestStateRefresh(DatabaseTest):
+
+    def _refresh_bot(self, refresh):
+        bot = self._bot(
+            StateRefreshBot,
+            config=dict(schedule=60, state_update_schedule=60,
+                        state_update_lead=10)
+        )
+        bot.refresh = refresh
+        bot.model.state = "old state"
+        return bot
+
+    def test_refresh_in_background(self):
+        release = threading.Event()
+        def refresh():
+            release.wait()
+            return "new state"
+        bot = self._refresh_bot(refresh)
+
+        # The state is fresh, so there's nothing to do.
+        eq_(False, bot.start_state_refresh())
+
+        # Once the state is about to expire, publishing kicks off a
+        # refresh in a worker thread without waiting for it.
+        bot.model.last_state_update_time = _now() - datetime.timedelta(
+            minutes=55
+        )
+        eq_(False, bot.check_and_update_state())
+        eq_(True, bot.state_refresh_in_progress)
+        eq_("old state", bot.model.state)
+        assert bot.next_action_time <= _now()
+        eq_(False, bot.finish_state_refresh())
+        eq_(False, bot.finish_state_refresh(timeout=0.01))
+
+        # When the refresh is done, the new state is swapped in.
+        release.set()
+        eq_(True, bot.finish_state_refresh(timeout=None))
+        eq_(False, bot.state_refresh_in_progress)
+        assert bot.update_thread != threading.current_thread()
+        assert bot.update_thread.daemon
+
+        # The worker thread was given the old state rather than
+        # having to look it up.
+        eq_("old state", bot.refreshed_from[0])
+        assert bot.refreshed_from[1] < _now() - datetime.timedelta(minutes=50)
+        eq_("new state", bot.model.state)
+        eq_(None, bot.model.state_refresh_error)
+        assert bot.model.state_refresh_seconds >= 0
+        assert bot.model.last_state_update_time > _now() - datetime.timedelta(
+            minutes=1
+        )
+
+    def test_failed_refresh(self):
+        def refresh():
+            raise ValueError("no state for you")
+        bot = self._refresh_bot(refresh)
+        bot.model.last_state_update_time = _now() - datetime.timedelta(
+            minutes=55
+        )
+        eq_(True, bot.start_state_refresh())
+        eq_(False, bot.finish_state_refresh(timeout=None))
+
+        # The failure was recorded and the old state is still in use.
+        eq_("no state for you", bot.model.state_refresh_error)
+        eq_("old state", bot.model.state)
+
+        # The state wasn't refreshed, but the refresh isn't tried
+        # again right away.
+        eq_(False, bot.start_state_refresh())
+        eq_(False, bot.check_and_update_state())
+        eq_(False, bot.state_refresh_in_progress)
+        assert bot.next_state_refresh_time > _now() + datetime.timedelta(
+            minutes=2
+        )
+
+        # Once a quarter of the lead time has passed, it's tried again.
+        bot._state_refresh_failed_at -= datetime.timedelta(minutes=3)
+        eq_(True, bot.start_state_refresh())
+        bot.finish_state_refresh(timeout=None)
+
+    def test_abandoned_refresh(self):
+        started = threading.Event()
+        release = threading.Event()
+        def refresh():
+            started.set()
+            release.wait()
+            return "new state"
+        bot = self._refresh_bot(refresh)
+        bot.model.last_state_update_time = _now() - datetime.timedelta(
+            minutes=55
+        )
+        eq_(False, bot.abandon_state_refresh())
+        eq_(True, bot.start_state_refresh())
+        started.wait()
+
+        # Giving up on the refresh records it as a failure.
+        eq_(True, bot.abandon_state_refresh())
+        eq_(False, bot.state_refresh_in_progress)
+        assert bot.model.state_refresh_error.startswith(
+            "Didn't finish within"
+        )
+        eq_("old state", bot.model.state)
+
+        # If the worker thread finishes after all, its result is ignored.
+        release.set()
+        bot.update_thread.join()
+        eq_(False, bot.finish_state_refresh())
+        eq_("old state", bot.model.state)
+
+    def test_no_state_updates_synchronously(self):
+        # A bot with no state at all can't publish without it, so it
+        # waits for update_state.
+        bot = self._refresh_bot(lambda: "first state")
+        bot.model._state = None
+        bot.model.last_state_update_time = None
+        eq_(True, bot.check_and_update_state())
+        eq_("first state", bot.model.state)
+        eq_(False, bot.state_refresh_in_progress)
+        eq_(threading.current_thread(), bot.update_thread)
+
+    def test_update_state_is_always_synchronous(self):
+        # A bot that only implements update_state() might use the
+        # database, so it doesn't refresh in the background even if
+        # state_update_lead is set.
+        bot = self._bot(config=dict(
+            schedule=60, state_update_schedule=60, state_update_lead=10
+        ))
+        bot.model.state = "old state"
+        bot.model.last_state_update_time = _now() - datetime.timedelta(
+            minutes=55
+        )
+        eq_(False, bot.refreshes_state_in_background)
+        eq_(None, bot.next_state_refresh_time)
+        eq_(False, bot.start_state_refresh())
+        eq_(False, bot.state_refresh_in_progress)
+
+
+class MockPublisher(Publisher):
+    """Records which thread it was called from."""
+
+    def __init__(self, service, error=None, block=None, credential=None,
+                 endpoint=None):
+        self.service = service
+        self.error = error
+        self.block = block
+        self.credential = credential
+        self._endpoint = endpoint
+        self.threads = []
+
+    @property
+    def endpoint(self):
+        return self._endpoint
+
+    @property
+    def rate_limit_credential(self):
+        return self.credential
+
+    def publish(self, post, publication):
+        self.threads.append(threading.current_thread())
+        if self.block:
+            self.block.wait()
+        if isinstance(self.error, Exception):
+            raise self.error
+        if self.error:
+            publication.report_failure(self.error)
+        else:
+            publication.report_success(self.service + "-" + post.content)
+
+
+class TestPublish(DatabaseTest):
+
+    def test_publish_serially(self):
+        bot = self._bot()
+        publisher = MockPublisher("a")
+        bot.publishers = [publisher]
+        post = self._post(bot.model, "content")
+        [publication] = bot.publish(post)
+        eq_("a-content", publication.external_id)
+        eq_([threading.current_thread()], publisher.threads)
+
+    def test_publication_in_flight(self):
+        bot = self._bot()
+        seen = []
+        class Watcher(MockPublisher):
+            def publish(self, post, publication):
+                # If this process died now, the committed Publication
+                # would come due for a retry after the timeout.
+                seen.append((publication.needs_publishing,
+                             publication.next_retry_at))
+                super(Watcher, self).publish(post, publication)
+        publisher = Watcher("a")
+        publisher.timeout = 30
+        bot.publishers = [publisher]
+        before = _now()
+        post = self._post(bot.model, "content")
+        [publication] = bot.publish(post)
+        [(needs_publishing, retry_at)] = seen
+        eq_(True, needs_publishing)
+        assert retry_at >= before + datetime.timedelta(seconds=30)
+        eq_(None, publication.next_retry_at)
+        eq_(False, publication.needs_publishing)
+
+        # If the publisher doesn't report anything, the mark is taken
+        # off again.
+        class Silent(MockPublisher):
+            def publish(self, post, publication):
+                pass
+        bot.publishers = [Silent("b")]
+        post = self._post(bot.model, "content 2")
+        [publication] = bot.publish(post)
+        eq_(None, publication.next_retry_at)
+        eq_(None, publication._in_flight)
+
+    def test_publish_records_cost(self):
+        bot = self._bot()
+        publisher = MockPublisher("a")
+        bot.publishers = [publisher]
+        post = self._post(bot.model, "content")
+        post.attach("image/png", content=b"12345")
+        [publication] = bot.publish(post)
+
+        # By default, a publisher is assumed to have made one request
+        # containing the post and its attachments.
+        assert publication.duration >= 0
+        eq_(1, publication.requests)
+        eq_(len("content") + 5, publication.bytes_sent)
+
+        # A publisher can say what it actually sent.
+        class Uploader(MockPublisher):
+            def publish(self, post, publication):
+                self.record_request(1000)
+                self.record_request(10)
+                super(Uploader, self).publish(post, publication)
+        bot = self._bot(config=dict(schedule=1, publish_concurrency=2))
+        bot.publishers = [Uploader("b"), MockPublisher("c", error="argh")]
+        post = self._post(bot.model, "content 2")
+        b, c = sorted(bot.publish(post), key=lambda x: x.service)
+        eq_(2, b.requests)
+        eq_(1010, b.bytes_sent)
+        assert c.duration >= 0
+        eq_("argh", c.error)
+        eq_(1, c.requests)
+
+    def test_publish_concurrently(self):
+        bot = self._bot(config=dict(schedule=1, publish_concurrency=4))
+        release = threading.Event()
+        success = MockPublisher("success")
+        failure = MockPublisher("failure", error="argh")
+        exception = MockPublisher("exception", error=ValueError("oops"))
+        slow = MockPublisher("slow", block=release)
+        slow.timeout = 0.1
+        bot.publishers = [success, failure, exception, slow]
+        post = self._post(bot.model, "content")
+        try:
+            publications = bot.publish(post)
+        finally:
+            release.set()
+
+        # Every publisher ran in a worker thread.
+        for publisher in bot.publishers:
+            [thread] = publisher.threads
+            assert thread != threading.current_thread()
+
+        # The outcomes were applied to the real Publications.
+        by_service = dict((x.service, x) for x in publications)
+        eq_("success-content", by_service['success'].external_id)
+        eq_(None, by_service['success'].error)
+        assert by_service['success'].most_recent_attempt
+        eq_("argh", by_service['failure'].error)
+        eq_("Uncaught exception: oops", by_service['exception'].error)
+        # The slow publisher may yet publish the post, so it's
+        # deferred rather than failed, and won't be retried soon.
+        slow_publication = by_service['slow']
+        eq_(None, slow_publication.error)
+        assert slow_publication.next_retry_at > _now() + datetime.timedelta(
+            hours=1
+        )
+        assert slow.threads[0].daemon
+
+        # The abandoned thread may still be using the slow publisher,
+        # so the bot has switched to a copy of it.
+        replacement = bot.publishers[-1]
+        assert replacement is not slow
+        eq_("slow", replacement.service)
+
+        # A publisher that succeeded won't be tried again.
+        eq_(3, len(bot.publish(post)))
+
+    def test_timeout_starts_when_publisher_runs(self):
+        bot = self._bot()
+        bot.publish_concurrency = 1
+
+        class Slow(MockPublisher):
+            def publish(self, post, publication):
+                time.sleep(0.2)
+                super(Slow, self).publish(post, publication)
+        first = Slow("first")
+        second = Slow("second")
+        first.timeout = second.timeout = 0.3
+        bot.publishers = [first, second]
+        post = self._post(bot.model, "content")
+        pending = [
+            (x, bot.make_publication(x, post)[0]) for x in bot.publishers
+        ]
+        bot._publish_concurrently(post, pending)
+
+        # The publishers ran one at a time, and neither was charged
+        # for the time the second one spent waiting for the first.
+        for publisher, publication in pending:
+            eq_(publisher.service + "-content", publication.external_id)
+            eq_(None, publication.next_retry_at)
+        assert first.threads[0] != second.threads[0]
+        eq_([first, second], bot.publishers)
+
+        # Once a publisher times out, the next one gets to run.
+        release = threading.Event()
+        stuck = MockPublisher("stuck", block=release)
+        stuck.timeout = 0.1
+        after = MockPublisher("after")
+        post = self._post(bot.model, "content 2")
+        pending = [
+            (x, bot.make_publication(x, post)[0]) for x in (stuck, after)
+        ]
+        try:
+            bot._publish_concurrently(post, pending)
+        finally:
+            release.set()
+        [(replacement, stuck_publication), (x, after_publication)] = pending
+        assert replacement is not stuck
+        assert stuck_publication.next_retry_at > _now()
+        eq_("after-content 2", after_publication.external_id)
+
+    def test_replacement(self):
+        publisher = MockPublisher("a", credential="secret")
+        publisher._requests = [100]
+        publisher._uploaded_media = [("digest", "id", 60)]
+        replacement = publisher.replacement()
+        eq_("secret", replacement.credential)
+        for name in Publisher.PER_CALL_STATE:
+            eq_(None, getattr(replacement, name))
+
+        # The original's state is untouched, and nothing the original
+        # does from now on affects the replacement.
+        eq_([100], publisher._requests)
+        publisher._uploaded_media.append(("digest 2", "id 2", 60))
+        eq_(None, replacement._uploaded_media)
+
+    def test_rate_limited_publication_is_deferred(self):
+        bot = self._bot()
+        publisher = MockPublisher("limited", credential="secret")
+        publisher.rate_limit_capacity = 1
+        publisher.rate_limit_per_minute = 1
+        bot.publishers = [publisher]
+        post = self._post(bot.model, "content")
+        [publication] = bot.publish(post)
+        eq_("limited-content", publication.external_id)
+
+        # The second post has to wait for the bucket to refill.
+        post2 = self._post(bot.model, "content 2")
+        [publication] = bot.publish(post2)
+        eq_(1, len(publisher.threads))
+        eq_(None, publication.external_id)
+        assert publication.next_retry_at > _now()
+        assert publication.needs_publishing
+        eq_([post2], bot.model.undeliverable_posts.all())
+
+        # Once the publisher gets a chance to publish it, the
+        # publication is no longer deferred.
+        publication.report_success("done")
+        eq_(None, publication.next_retry_at)
+        eq_(False, publication.needs_publishing)
+
+    def test_circuit_breaker_defers_publication(self):
+        bot = self._bot()
+        publisher = MockPublisher("down", error="503", endpoint="down.com")
+        publisher.circuit_breaker_threshold = 2
+        bot.publishers = [publisher]
+        for i in range(2):
+            post = self._post(bot.model, "content %d" % i)
+            [publication] = bot.publish(post)
+            eq_("503", publication.error)
+        breaker = publisher.circuit_breaker(self._db)
+        eq_(CircuitBreaker.OPEN, breaker.state)
+        eq_("down:down.com", breaker.key)
+
+        # The breaker is open, so the next post isn't even sent to
+        # the publisher.
+        post = self._post(bot.model, "content 3")
+        [publication] = bot.publish(post)
+        eq_(2, len(publisher.threads))
+        eq_(None, publication.error)
+        eq_(breaker.retry_at, publication.next_retry_at)
+
+        # Once it's time to try the service again, one request goes
+        # through. If the publisher defers it, or doesn't report
+        # anything, we still don't know whether the service is back.
+        def defer(post, publication):
+            publication.report_deferred(_now() + datetime.timedelta(hours=1))
+        for publish in (defer, lambda post, publication: None):
+            breaker.retry_at = _now() - datetime.timedelta(seconds=1)
+            publisher.publish = publish
+            bot.publish(self._post(bot.model, "content"))
+            eq_(CircuitBreaker.HALF_OPEN, breaker.state)
+
+        # A real response closes the breaker.
+        breaker.retry_at = _now() - datetime.timedelta(seconds=1)
+        del publisher.publish
+        publisher.error = None
+        [publication] = bot.publish(self._post(bot.model, "content 4"))
+        eq_("down-content 4", publication.external_id)
+        eq_(CircuitBreaker.CLOSED, breaker.state)
+
+        # A publisher without an endpoint has no circuit breaker.
+        eq_(None, MockPublisher("local").circuit_breaker(self._db))
+
+    def test_after_publish_failure(self):
+        class Clumsy(MockPublisher):
+            def after_publish(self, _db, publication):
+                raise IOError("disk full")
+
+        bot = self._bot()
+        clumsy = Clumsy("clumsy", endpoint="clumsy.com")
+        other = MockPublisher("other")
+        bot.publishers = [clumsy, other]
+        breaker = clumsy.circuit_breaker(self._db)
+        breaker.record_failure(5, 60)
+        eq_(1, breaker.failures)
+
+        # The post still counts as published, the circuit breaker
+        # hears about it, and the other publisher still gets the post.
+        post = self._post(bot.model, "content")
+        first, second = bot.publish(post)
+        eq_("clumsy-content", first.external_id)
+        eq_(None, first.error)
+        eq_(0, breaker.failures)
+        eq_("other-content", second.external_id)
+
+    def test_rate_limit_key(self):
+        publisher = MockPublisher("service", credential="secret")
+        eq_(None, publisher.rate_limit_key)
+        publisher.rate_limit_capacity = 10
+        publisher.rate_limit_per_minute = 10
+        key = publisher.rate_limit_key
+        assert key.startswith("service:")
+        assert "secret" not in key
+
+    def test_media_cache(self):
+        class Uploader(MockPublisher):
+            media_cache_lifetime = 3600
+            uploads = 0
+            def publish(self, post, publication):
+                for attachment in post.attachments:
+                    if self.cached_media_id(attachment) is None:
+                        self.uploads += 1
+                        self.remember_media(attachment, self.uploads)
+                super(Uploader, self).publish(post, publication)
+
+        bot = self._bot()
+        publisher = Uploader("a", credential="secret")
+        bot.publishers = [publisher]
+        post = self._post(bot.model, "content")
+        post.attach("image/png", content=b"12345")
+        bot.publish(post)
+        eq_(1, publisher.uploads)
+
+        # The same file attached to another post isn't uploaded again,
+        # but a new file is.
+        post = self._post(bot.model, "content 2")
+        post.attach("image/png", content=b"12345")
+        post.attach("image/png", content=b"67890")
+        bot.publish(post)
+        eq_(2, publisher.uploads)
+
+        # If a post that used an old upload fails, the upload is
+        # forgotten in case that's why.
+        publisher.error = "argh"
+        post = self._post(bot.model, "content 3")
+        post.attach("image/png", content=b"12345")
+        bot.publish(post)
+        eq_(2, publisher.uploads)
+        publisher.error = None
+        bot.publish(post)
+        eq_(3, publisher.uploads)
+
+        # If files can't be reused, an upload is kept until the post
+        # is published.
+        publisher.media_reusable = False
+        publisher.error = "argh"
+        post = self._post(bot.model, "content 4")
+        post.attach("image/png", content=b"new")
+        bot.publish(post)
+        eq_(4, publisher.uploads)
+        publisher.error = None
+        bot.publish(post)
+        eq_(4, publisher.uploads)
+        post = self._post(bot.model, "content 5")
+        post.attach("image/png", content=b"new")
+        bot.publish(post)
+        eq_(5, publisher.uploads)
+
+        # An upload that's waiting for its post to be retried can't
+        # be used by a different post with the same file.
+        publisher.error = "argh"
+        waiting = self._post(bot.model, "content 6")
+        waiting.attach("image/png", content=b"shared")
+        bot.publish(waiting)
+        eq_(6, publisher.uploads)
+        publisher.error = None
+        post = self._post(bot.model, "content 7")
+        post.attach("image/png", content=b"shared")
+        bot.publish(post)
+        eq_(7, publisher.uploads)
+
+        # But the first post still gets to use its own upload.
+        bot.publish(waiting)
+        eq_(7, publisher.uploads)
+
+        # A publisher without credentials doesn't cache anything.
+        eq_(None, Uploader("b").media_cache_key)
+
+
+class SequenceBot(TextGeneratorBot):
+    """Generates text from a predetermined list."""
+
+    texts = []
+
+    def generate_text(self):
+        self.generated = getattr(self, 'generated', 0) + 1
+        return self.texts.pop(0)
+
+
+class TestPregeneration(DatabaseTest):
+
+    def _sequence_bot(self, texts, **pregenerate):
+        bot = self._bot(
+            SequenceBot, config=dict(schedule=1, pregenerate=pregenerate)
+        )
+        bot.texts = list(texts)
+        return bot
+
+    def test_no_buffer_by_default(self):
+        bot = self._sequence_bot(["a"])
+        eq_(0, bot.buffer_depth)
+        eq_(0, bot.fill_buffer())
+        eq_(0, bot.model.buffer_size)
+
+    def test_fill_buffer(self):
+        bot = self._sequence_bot(["old", "a", "old", "b", "c", "d"], depth=3)
+        # "old" has already been published, so it won't be buffered
+        # again.
+        old = self._post(bot.model, "old", published=True)
+
+        eq_(3, bot.fill_buffer())
+        eq_(["a", "b", "c"], [x.content for x in bot.model.buffered_posts])
+
+        # Buffered posts aren't scheduled posts.
+        eq_([], bot.model.scheduled)
+
+        # The buffer is full, so nothing more is generated.
+        eq_(0, bot.fill_buffer())
+        eq_(["d"], bot.texts)
+
+    def test_fill_buffer_leaves_existing_posts_alone(self):
+        bot = self._sequence_bot(["later", "waiting", "a", "b"], depth=2)
+        # These posts haven't been published yet, but they weren't
+        # generated for the buffer.
+        later = self._post(bot.model, "later")
+        later.publish_at = _now() + datetime.timedelta(days=1)
+        waiting = self._post(bot.model, "waiting")
+        waiting.created = _now() - datetime.timedelta(minutes=1)
+
+        eq_(2, bot.fill_buffer())
+        eq_(["a", "b"], [x.content for x in bot.model.buffered_posts])
+        eq_(False, later.buffered)
+        eq_(False, waiting.buffered)
+
+    def test_publishable_posts_takes_from_buffer(self):
+        bot = self._sequence_bot(["a", "b"], depth=1)
+        bot.fill_buffer()
+        eq_(1, bot.generated)
+        [post] = bot.publishable_posts
+        eq_("a", post.content)
+        eq_(False, post.buffered)
+        eq_(1, bot.generated)
+        self._publication(post=post)
+
+        # With the buffer empty, a post is generated on the spot.
+        bot.model.next_post_time = None
+        [post] = bot.publishable_posts
+        eq_("b", post.content)
+        eq_(2, bot.generated)
+
+    def test_stale_posts_expire(self):
+        bot = self._sequence_bot(["a", "b", "c"], depth=2, ttl=60)
+        bot.fill_buffer()
+        [a, b] = bot.model.buffered_posts
+        a.created = _now() - datetime.timedelta(minutes=61)
+
+        # "a" is too old to publish, so it's thrown away.
+        eq_(b, bot.model.pop_buffer(bot.buffer_ttl))
+        eq_(0, bot.model.buffer_size)
+        eq_([], self._db.query(Post).filter(Post.content=="a").all())
+
+
+
+class TestMetrics(DatabaseTest):
+
+    def setup(self):
+        super(TestMetrics, self).setup()
+        METRICS.reset()
+        METRICS.enable()
+
+    def teardown(self):
+        METRICS.enabled = False
+        METRICS.reset()
+        super(TestMetrics, self).teardown()
+
+    def test_phases(self):
+        bot = self._bot(config=dict(schedule=1))
+        bot.publishers = [MockPublisher("a"), MockPublisher("b", error="no")]
+        [post] = bot.publishable_posts
+        bot.publish(post)
+        name = bot.module_name
+
+        def count(phase, **labels):
+            labels.update(bot=name, phase=phase)
+            key = ('botfriend_phase_seconds', tuple(sorted(labels.items())))
+            return METRICS.histograms[key][2]
+        eq_(1, count('new_post'))
+        eq_(1, count('object_to_post'))
+        eq_(1, count('publish', service='a'))
+        eq_(1, count('publish', service='b'))
+
+        # Turning the new post into a Post hit the database.
+        key = ('botfriend_sql_statements_total', (
+            ('bot', name), ('phase', 'object_to_post')
+        ))
+        assert METRICS.counters[key] > 0
+
+        outcomes = dict(
+            (dict(labels)['service'], dict(labels)['outcome'])
+            for (metric, labels) in METRICS.counters
+            if metric == 'botfriend_publications_total'
+        )
+        eq_(dict(a='success', b='error'), outcomes)
+
+    def test_disabled(self):
+        METRICS.enabled = False
+        bot = self._bot(config=dict(schedule=1))
+        bot.publishable_posts
+        eq_({}, METRICS.histograms)
+        eq_({}, METRICS.counters)
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.enabled = True
+        metrics.increment(
+            'botfriend_publications_total',
+            dict(bot='a "bot"', service='x', outcome='success')
+        )
+        metrics.observe(
+            'botfriend_phase_seconds', dict(bot='a', phase='new_post'), 0.02
+        )
+
+        # Measurements from a worker process are added to ours.
+        metrics.merge(metrics.snapshot())
+        lines = metrics.render().splitlines()
+        assert '# TYPE botfriend_phase_seconds histogram' in lines
+        assert 'botfriend_phase_seconds_bucket{bot="a",phase="new_post",le="0.01"} 0' in lines
+        assert 'botfriend_phase_seconds_bucket{bot="a",phase="new_post",le="0.025"} 2' in lines
+        assert 'botfriend_phase_seconds_bucket{bot="a",phase="new_post",le="+Inf"} 2' in lines
+        assert 'botfriend_phase_seconds_count{bot="a",phase="new_post"} 2' in lines
+        assert '# TYPE botfriend_publications_total counter' in lines
+        assert 'botfriend_publications_total{bot="a \\"bot\\"",outcome="success",service="x"} 2' in lines
+
+    def test_textfile_totals_carry_over(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "botfriend.prom")
+        try:
+            # There's nothing to carry over the first time.
+            eq_(({}, {}), Metrics.read_textfile(path))
+
+            first = Metrics()
+            first.enabled = True
+            first.increment(
+                'botfriend_publications_total',
+                dict(bot='a "bot"\nb', service='x', outcome='success')
+            )
+            first.observe(
+                'botfriend_phase_seconds', dict(bot='a', phase='new_post'),
+                0.02
+            )
+            first.write_textfile(path)
+
+            # The next run reads back exactly what was written...
+            second = Metrics()
+            second.merge(Metrics.read_textfile(path))
+            eq_(first.render(), second.render())
+
+            # ...and adds its own measurements to it.
+            second.enabled = True
+            second.observe(
+                'botfriend_phase_seconds', dict(bot='a', phase='new_post'), 3
+            )
+            second.write_textfile(path)
+            lines = open(path).read().splitlines()
+            assert 'botfriend_phase_seconds_bucket{bot="a",phase="new_post",le="0.025"} 1' in lines
+            assert 'botfriend_phase_seconds_count{bot="a",phase="new_post"} 2' in lines
+            assert 'botfriend_phase_seconds_sum{bot="a",phase="new_post"} 3.02' in lines
+            assert 'botfriend_publications_total{bot="a \\"bot\\"\\nb",outcome="success",service="x"} 1' in lines
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestFileOutput(DatabaseTest):
+
+    def setup(self):
+        super(TestFileOutput, self).setup()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "out.txt")
+
+    def teardown(self):
+        LineWriter.close_all()
+        shutil.rmtree(self.directory)
+        super(TestFileOutput, self).teardown()
+
+    def contents(self):
+        if not os.path.exists(self.path):
+            return ""
+        return open(self.path).read()
+
+    def test_durability_none(self):
+        writer = LineWriter(self.path)
+        writer.write("one\n")
+        writer.write("two\n")
+        eq_("", self.contents())
+        writer.flush()
+        eq_("one\ntwo\n", self.contents())
+        writer.close()
+
+    def test_durability_flush(self):
+        writer = LineWriter(self.path, LineWriter.FLUSH)
+        writer.write("one\n")
+        eq_("one\n", self.contents())
+        writer.close()
+
+    def test_durability_fsync(self):
+        writer = LineWriter(self.path, LineWriter.FSYNC, fsync_lines=2)
+        writer.write("one\n")
+        eq_("", self.contents())
+        writer.write("two\n")
+        eq_("one\ntwo\n", self.contents())
+        writer.close()
+
+        assert_raises(ValueError, LineWriter, self.path, "sometimes")
+
+    def test_large_batches_are_split_between_lines(self):
+        writer = LineWriter(self.path)
+        writer.MAX_WRITE = 10
+        writes = []
+        real_write = os.write
+        def write(fd, data):
+            writes.append(data)
+            return real_write(fd, data)
+        os.write = write
+        try:
+            for line in ("aaaa\n", "bbbb\n", "cccc\n", "a long line\n"):
+                writer.write(line)
+            writer.flush()
+        finally:
+            os.write = real_write
+        eq_([b"aaaa\nbbbb\n", b"cccc\n", b"a long line\n"], writes)
+        writer.close()
+
+    def test_short_writes_are_finished(self):
+        # The operating system only writes a few bytes at a time.
+        real_write = os.write
+        def write(fd, data):
+            return real_write(fd, data[:3])
+        os.write = write
+        try:
+            writer = LineWriter(self.path)
+            writer.write("one\n")
+            writer.write("two\n")
+            writer.flush()
+            eq_("one\ntwo\n", self.contents())
+
+            bot = self._bot()
+            publisher = FileOutputPublisher(bot, {}, dict(filename=self.path))
+            publisher.service = "file"
+            bot.publishers = [publisher]
+            post = self._post(bot.model, "content")
+            bot.publish(post)
+        finally:
+            os.write = real_write
+        assert self.contents().endswith(" | content\n")
+        writer.close()
+
+    def test_batched_publisher(self):
+        bot = self._bot()
+        config = dict(filename=self.path, batch=True)
+        publisher = FileOutputPublisher(bot, {}, config)
+        publisher.service = "file"
+        other = FileOutputPublisher(bot, {}, config)
+        # Publishers writing to the same file share a writer.
+        assert publisher.writer is other.writer
+        bot.publishers = [publisher]
+
+        post = self._post(bot.model, "content")
+        [publication] = bot.publish(post)
+        eq_(None, publication.error)
+        eq_("", self.contents())
+        bot.flush_publishers()
+        assert self.contents().endswith(" | content\n")
+
+
+class TestPodcastPublisher(DatabaseTest):
+
+    def setup(self):
+        super(TestPodcastPublisher, self).setup()
+        self.directory = tempfile.mkdtemp()
+        self.bot = self._bot(directory=self.directory)
+        self.publisher = PodcastPublisher(
+            self.bot, dict(name="A Podcast"),
+            dict(filename="feed.xml", url="http://example.com/feed.xml",
+                 archive_size=2)
+        )
+        self.publisher.service = "podcast"
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+        super(TestPodcastPublisher, self).teardown()
+
+    def publish(self, number):
+        post, is_new = PodcastPublisher.make_post(
+            self.bot, "Episode %d" % number,
+            "http://example.com/%d.mp3" % number, media_size=number
+        )
+        publication = Publication(post=post, service="podcast")
+        self.publisher.publish(post, publication)
+        eq_(None, publication.error)
+
+    def titles(self):
+        import feedparser
+        parsed = feedparser.parse(self.publisher.path)
+        return [x.title for x in parsed.entries]
+
+    def test_publish(self):
+        self.publish(1)
+        self.publish(2)
+        eq_(["Episode 2", "Episode 1"], self.titles())
+
+        # Only archive_size entries are kept.
+        self.publish(3)
+        eq_(["Episode 3", "Episode 2"], self.titles())
+        eq_(["http://example.com/3.mp3", "http://example.com/2.mp3"],
+            [x['guid'] for x in self.publisher.load_entries()])
+
+        # Publishing an episode again moves it to the front rather
+        # than duplicating it.
+        self.publish(2)
+        eq_(["Episode 2", "Episode 3"], self.titles())
+
+        # Nothing was left behind by the atomic writes.
+        eq_(["feed.xml", "feed.xml.json"], sorted(os.listdir(self.directory)))
+
+    def test_feed_without_index(self):
+        # A feed written before there was an index is read once to
+        # create the index.
+        self.publish(1)
+        os.remove(self.publisher.index_path)
+        self.publish(2)
+        eq_(["Episode 2", "Episode 1"], self.titles())
+        [new, old] = self.publisher.load_entries()
+        eq_("http://example.com/1.mp3", old['media_url'])
+        eq_("1", str(old['media_size']))
+
+
+class TestAtomPublisher(DatabaseTest):
+
+    def setup(self):
+        super(TestAtomPublisher, self).setup()
+        self.directory = tempfile.mkdtemp()
+        self.bot = self._bot(directory=self.directory)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+        super(TestAtomPublisher, self).teardown()
+
+    def publisher(self, **config):
+        config.setdefault('url', "http://example.com/bot/feed.xml")
+        publisher = AtomPublisher(self.bot, dict(name="A Bot"), config)
+        publisher.service = "atom"
+        self.bot.publishers = [publisher]
+        return publisher
+
+    def entries(self, publisher):
+        import feedparser
+        return feedparser.parse(publisher.path).entries
+
+    def test_rolling_window(self):
+        publisher = self.publisher(size=2)
+        for content in ("one", "two", "three"):
+            post = self._post(self.bot.model, content)
+            self.bot.publish(post)
+        eq_(["three", "two"], [x.title for x in self.entries(publisher)])
+
+        # A failed publication isn't in the feed.
+        failure = MockPublisher("atom", error="argh")
+        self.bot.publishers = [failure]
+        self.bot.publish(self._post(self.bot.model, "four"))
+        publisher.write_feed(self._db)
+        eq_(["three", "two"], [x.title for x in self.entries(publisher)])
+
+    def test_attachments(self):
+        publisher = self.publisher()
+        post = self._post(self.bot.model, "picture")
+        post.attach("image/png", content=b"not really a png", alt="A picture")
+        photo = os.path.join(self.directory, "1.jpg")
+        with open(photo, 'wb') as out:
+            out.write(b"not really a jpeg")
+        # Filenames are relative to the botfriend package.
+        package = os.path.split(publisher.attachment_path("x"))[0]
+        post.attach("image/jpeg", filename=os.path.relpath(photo, package))
+        self.bot.publish(post)
+        [entry] = self.entries(publisher)
+        stored, on_disk = entry.enclosures
+        eq_("image/png", stored.type)
+        eq_("16", stored.length)
+        assert stored.href.startswith("http://example.com/bot/media/")
+        path = os.path.join(
+            self.directory, "media", stored.href.split("/")[-1]
+        )
+        eq_(b"not really a png", open(path, 'rb').read())
+        eq_("image/jpeg", on_disk.type)
+        eq_("17", on_disk.length)
+        digest = media_digest(b"not really a jpeg")
+        eq_("http://example.com/bot/media/%s.jpg" % digest, on_disk.href)
+        path = os.path.join(self.directory, "media", digest + ".jpg")
+        eq_(b"not really a jpeg", open(path, 'rb').read())
+
+        # Another post with a copy of the same file shares the
+        # enclosure, rather than copying it again.
+        copy = os.path.join(self.directory, "copy.jpg")
+        shutil.copy(photo, copy)
+        post = self._post(self.bot.model, "same picture")
+        post.attach("image/jpeg", filename=copy)
+        self.bot.publish(post)
+        entry = self.entries(publisher)[0]
+        [enclosure] = entry.enclosures
+        eq_(on_disk.href, enclosure.href)
+        eq_(2, len(os.listdir(os.path.join(self.directory, "media"))))
+
+    def test_batch(self):
+        publisher = self.publisher(batch=True)
+        for content in ("one", "two"):
+            self.bot.publish(self._post(self.bot.model, content))
+        # Nothing is written until the publisher is flushed.
+        eq_(False, os.path.exists(publisher.path))
+        self.bot.flush_publishers()
+        eq_(["two", "one"], [x.title for x in self.entries(publisher)])
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    """Sends a gzipped response and remembers who asked for it."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.client_address, self.headers.get('User-Agent'))
+        )
+        self.server.cookies.append(self.headers.get('Cookie'))
+        etag = self.server.etag
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = gzip.compress(self.server.body)
+        self.send_response(200)
+        if etag:
+            self.send_header("ETag", etag)
+        if self.server.cookie:
+            self.send_header("Set-Cookie", self.server.cookie)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHTTPClient(DatabaseTest):
+
+    def setup(self):
+        super(TestHTTPClient, self).setup()
+        self.server = HTTPServer(('127.0.0.1', 0), RecordingHandler)
+        self.server.requests = []
+        self.server.cookies = []
+        self.server.cookie = None
+        self.server.etag = None
+        self.server.body = b"hello"
+        self.url = "http://%s:%d/" % self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def teardown(self):
+        METRICS.enabled = False
+        METRICS.reset()
+        HTTPClient.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestHTTPClient, self).teardown()
+
+    def test_configuration(self):
+        client = HTTPClient.from_config(None)
+        eq_(HTTPClient.USER_AGENT, client.user_agent)
+        eq_((HTTPClient.CONNECT_TIMEOUT, HTTPClient.READ_TIMEOUT),
+            client.timeout)
+        client = HTTPClient.from_config(dict(user_agent="my bot", timeout=[1, 2]))
+        eq_("my bot", client.user_agent)
+        eq_((1, 2), client.timeout)
+
+    def test_connections_are_shared(self):
+        client = HTTPClient(user_agent="my bot")
+        other = HTTPClient()
+        eq_(b"hello", client.get(self.url).content)
+        eq_(b"hello", client.get(self.url).content)
+        eq_(b"hello", other.get(self.url).content)
+
+        # Every request went over the same connection, but each
+        # client sent its own User-Agent.
+        [address] = set(x for x, agent in self.server.requests)
+        eq_(["my bot", "my bot", HTTPClient.USER_AGENT],
+            [agent for x, agent in self.server.requests])
+
+    def test_cookies_are_not_shared(self):
+        client = HTTPClient()
+        other = HTTPClient()
+        self.server.cookie = "login=secret"
+        client.get(self.url)
+        self.server.cookie = None
+        client.get(self.url)
+        other.get(self.url)
+
+        # A client sends back the cookies it was given, but another
+        # client using the same connection doesn't.
+        eq_([None, "login=secret", None], self.server.cookies)
+        [address] = set(x for x, agent in self.server.requests)
+
+    def test_close(self):
+        client = HTTPClient()
+        eq_(b"hello", client.get(self.url).content)
+        HTTPClient.close()
+
+        # The client gets a new connection from a new pool.
+        eq_(b"hello", client.get(self.url).content)
+        eq_(2, len(set(x for x, agent in self.server.requests)))
+
+    def test_scraper_bot(self):
+        class Scraper(ScraperBot):
+            def scrape(self, response):
+                return []
+
+        bot = self._bot(cls=Scraper, config=dict(
+            schedule=1, url=self.url, http=dict(user_agent="scraper")
+        ))
+        eq_(b"hello", bot.make_request().content)
+        eq_("scraper", self.server.requests[0][1])
+
+    def test_scraper_bot_cache_after_failure(self):
+        class Scraper(ScraperBot):
+            scraped = []
+            fail = True
+            def scrape(self, response):
+                self.scraped.append(response.content)
+                if self.fail:
+                    self.fail = False
+                    raise ValueError("Can't parse this")
+                return []
+
+        bot = self._bot(cls=Scraper, config=dict(schedule=1, url=self.url))
+        self.server.etag = '"1"'
+        assert_raises(ValueError, bot.new_post)
+
+        # The document couldn't be scraped, so its validators weren't
+        # stored. The next request isn't conditional, and the same
+        # document is scraped again.
+        eq_({}, bot.headers)
+        eq_([], bot.new_post())
+        eq_([b"hello", b"hello"], Scraper.scraped)
+        eq_({'If-None-Match': '"1"'}, bot.headers)
+
+        # Once it's been scraped, it isn't scraped again.
+        bot.new_post()
+        eq_([b"hello", b"hello"], Scraper.scraped)
+
+    def test_scraper_bot_cache(self):
+        class Scraper(ScraperBot):
+            scraped = []
+            def scrape(self, response):
+                self.scraped.append(response.content)
+                return []
+
+        METRICS.reset()
+        METRICS.enable()
+        bot = self._bot(cls=Scraper, config=dict(schedule=1, url=self.url))
+        self.server.etag = '"1"'
+        bot.new_post()
+        eq_({'If-None-Match': '"1"'}, bot.headers)
+
+        # The server says the document hasn't changed, so it isn't
+        # scraped again.
+        bot.new_post()
+        eq_([b"hello"], Scraper.scraped)
+
+        # A server without validators can send the same document
+        # again; it isn't scraped again either.
+        self.server.etag = None
+        bot.new_post()
+        eq_([b"hello"], Scraper.scraped)
+        eq_({}, bot.headers)
+
+        # But a new document is scraped.
+        self.server.body = b"goodbye"
+        bot.new_post()
+        eq_([b"hello", b"goodbye"], Scraper.scraped)
+
+        labels = lambda outcome: (
+            'botfriend_http_cache_total',
+            (('bot', bot.module_name), ('outcome', outcome))
+        )
+        counters = METRICS.snapshot()[0]
+        eq_(2, counters[labels('hit')])
+        eq_(2, counters[labels('miss')])
+
+        # Another bot scraping the same URL has its own validators.
+        other = self._bot(
+            cls=Scraper, botmodel=self._botmodel("other"),
+            config=dict(schedule=1, url=self.url)
+        )
+        eq_({}, other.headers)
+
+        # The cache can be turned off.
+        bot = self._bot(cls=Scraper, config=dict(
+            schedule=1, url=self.url, http_cache=False
+        ))
+        bot.new_post()
+        eq_([b"hello", b"goodbye", b"goodbye"], Scraper.scraped)
@@ -1,12 +1,28 @@
 import datetime
 import json
+import os
+import shutil
+import sys
+import tempfile
+from sqlalchemy import event
 from nose.tools import (
     assert_raises,
     eq_,
     set_trace,
 )
 from model import (
-    _now
+    _now,
+    BotModel,
+    CircuitBreaker,
+    content_digest,
+    engine,
+    HTTPCacheEntry,
+    MediaUpload,
+    Post,
+    Publication,
+    RateLimit,
+    storage_pragmas,
+    storage_profile,
 )
 from . import DatabaseTest
 
@@ -135,6 +151,36 @@ class TestBotModel(DatabaseTest):
         eq_([failed_first, failed_second],
             self.bot.undeliverable_posts.all())
 
+    def test_for_directory_does_not_import_bot_code(self):
+        directory = tempfile.mkdtemp()
+        module = "lazily_loaded_bot"
+        bot_directory = os.path.join(directory, module)
+        os.mkdir(bot_directory)
+        with open(os.path.join(bot_directory, "bot.yaml"), "w") as f:
+            f.write("name: Lazy Bot\nschedule: 60\n")
+        open(os.path.join(bot_directory, "__init__.py"), "w").close()
+        sys.path.append(directory)
+        try:
+            config = BotModel.load_config(bot_directory, dict(schedule=1))
+            eq_(dict(name="Lazy Bot", schedule=60), config)
+
+            model = BotModel.for_directory(self._db, bot_directory, config)
+            eq_("Lazy Bot", model.name)
+            eq_(module, model.module_name)
+            assert module not in sys.modules
+
+            # The bot's code is imported when the implementation is
+            # first needed.
+            bot = model.implementation
+            assert module in sys.modules
+            eq_(model, bot.model)
+            eq_(60, bot.schedule)
+            assert model.implementation is bot
+        finally:
+            sys.path.remove(directory)
+            sys.modules.pop(module, None)
+            shutil.rmtree(directory)
+
     def test_state(self):
         eq_(None, self.bot.last_state_update_time)
         
@@ -167,10 +213,13 @@ class TestBotModel(DatabaseTest):
         # Any list full of JSONable objects can be stored as
         # BotModel.backlog.
         eq_([], self.bot.backlog)
+        eq_(0, self.bot.backlog_size)
         backlog = [1234]
         self.bot.backlog = backlog
-        eq_(json.dumps(backlog), self.bot._backlog)
         eq_(backlog, self.bot.backlog)
+        eq_(1, self.bot.backlog_size)
+        [item] = self.bot.backlog_items
+        eq_(json.dumps(1234), item.payload)
 
         # You can't store some random JSONable object as Bot.backlog,
         # it has to be a list.
@@ -181,3 +230,524 @@ class TestBotModel(DatabaseTest):
         # BotModel.pop_backlog removes one item from the backlog.
         eq_(1234, self.bot.pop_backlog())
         eq_([], self.bot.backlog)
+        eq_(None, self.bot.pop_backlog())
+
+    def test_backlog_order(self):
+        # Items are added to the end of the backlog and popped off
+        # the front.
+        self.bot.extend_backlog(["a", {"b": 1}])
+        self.bot.extend_backlog(["c"])
+        eq_(["a", {"b": 1}, "c"], self.bot.backlog)
+        eq_("a", self.bot.pop_backlog())
+        self.bot.extend_backlog(["d"])
+        eq_([{"b": 1}, "c", "d"], self.bot.backlog)
+
+        # The backlog can be read one page at a time.
+        [first, second] = self.bot.backlog_page(limit=2)
+        eq_([{"b": 1}, "c"], [first.value, second.value])
+        eq_(["d"], [x.value for x in self.bot.backlog_page(
+            after=second.position)])
+
+        # Setting the backlog replaces its contents.
+        self.bot.backlog = ["e"]
+        eq_(["e"], self.bot.backlog)
+        self.bot.clear_backlog()
+        eq_(0, self.bot.backlog_size)
+
+    def test_fleet_status(self):
+        now = _now()
+        quiet = self._botmodel("quiet")
+        busy = self._botmodel("busy")
+        busy.next_post_time = now + datetime.timedelta(hours=1)
+
+        old = self._post(busy, "old", published=True)
+        [publication] = old.publications
+        publication.most_recent_attempt = now - datetime.timedelta(days=1)
+        recent = self._post(busy, "recent", published=True)
+        [publication] = recent.publications
+        publication.most_recent_attempt = now - datetime.timedelta(hours=1)
+        failed = Publication(post=recent, service="other")
+        failed.report_failure("argh")
+        self._post(busy, "whenever")
+        soon = self._post(
+            busy, "soon", publish_at=now + datetime.timedelta(minutes=5)
+        )
+        self._post(busy, "later", publish_at=now + datetime.timedelta(days=1))
+        buffered = self._post(busy, "buffered")
+        buffered.buffered = True
+        busy.extend_backlog(["first", "second"])
+        self._db.flush()
+
+        status = BotModel.fleet_status(self._db, [quiet, busy], now)
+        eq_(dict(last_post=None, publications=[], scheduled=0,
+                 next_scheduled=None, backlog=0, next_backlog=None,
+                 buffered=0, next_post_time=None), status[quiet.id])
+
+        busy_status = status[busy.id]
+        eq_(recent, busy_status['last_post'])
+        eq_(set(recent.publications), set(busy_status['publications']))
+        eq_(2, len(busy_status['publications']))
+        eq_(len(busy.scheduled), busy_status['scheduled'])
+        eq_(busy.scheduled[0], busy_status['next_scheduled'])
+        eq_(soon, busy_status['next_scheduled'])
+        eq_(soon.publish_at, busy_status['next_post_time'])
+        eq_(2, busy_status['backlog'])
+        eq_("first", busy_status['next_backlog'])
+        eq_(1, busy_status['buffered'])
+
+    def test_fleet_status_query_count(self):
+        # Adding bots doesn't add queries.
+        def count_queries(bots):
+            statements = []
+            def capture(*args):
+                statements.append(args[2])
+            event.listen(self.connection, "before_cursor_execute", capture)
+            try:
+                BotModel.fleet_status(self._db, bots)
+            finally:
+                event.remove(self.connection, "before_cursor_execute", capture)
+            return len(statements)
+        bots = []
+        for i in range(10):
+            bot = self._botmodel("bot%d" % i)
+            self._post(bot, "published %d" % i, published=True)
+            self._post(bot, "scheduled %d" % i)
+            bot.extend_backlog(["backlog %d" % i])
+            bots.append(bot)
+        self._db.flush()
+        eq_(count_queries(bots[:1]), count_queries(bots))
+
+
+class TestStorageProfile(object):
+
+    def test_storage_profile(self):
+        profile = storage_profile()
+        eq_("WAL", profile['journal_mode'])
+
+        # Individual settings can be overridden.
+        profile = storage_profile(dict(synchronous="FULL", mmap_size=0))
+        eq_("FULL", profile['synchronous'])
+        eq_(0, profile['mmap_size'])
+        eq_("WAL", profile['journal_mode'])
+
+        # But only settings we know about, with sensible values.
+        assert_raises(ValueError, storage_profile, dict(foreign_keys=1))
+        assert_raises(
+            ValueError, storage_profile, dict(synchronous="OFF; DROP TABLE")
+        )
+        assert_raises(ValueError, storage_profile, dict(mmap_size=True))
+        assert_raises(ValueError, storage_profile, dict(cache_size=1.5))
+
+        # Numbers can be given as strings, including negative numbers.
+        profile = storage_profile(dict(cache_size="-8000", mmap_size="0"))
+        eq_(-8000, profile['cache_size'])
+        eq_(0, profile['mmap_size'])
+
+    def test_pragmas_applied_to_connection(self):
+        e, connection = engine(":memory:", dict(busy_timeout=1234))
+        pragmas = dict(storage_pragmas(connection))
+        eq_(1234, pragmas['busy_timeout'])
+        # An in-memory database can't use WAL.
+        eq_("memory", pragmas['journal_mode'])
+        # 2 is "MEMORY".
+        eq_(2, pragmas['temp_store'])
+        connection.close()
+
+
+class TestPost(DatabaseTest):
+
+    def test_content_hash(self):
+        bot = self._botmodel()
+        post = self._post(bot, "some content")
+        eq_(content_digest("some content"), post.content_hash)
+        eq_(16, len(post.content_hash))
+
+        # The hash is kept up to date when the content changes.
+        post.content = "new content"
+        eq_(content_digest("new content"), post.content_hash)
+        post.content = None
+        eq_(None, post.content_hash)
+
+        # Content is normalized before being hashed.
+        eq_(content_digest("caf\u00e9"), content_digest("cafe\u0301"))
+        eq_(content_digest("caf\u00e9"), content_digest(b"caf\xc3\xa9"))
+
+    def test_from_content_reuses_existing_post(self):
+        bot = self._botmodel()
+        post, is_new = Post.from_content(bot, "some content")
+        eq_(True, is_new)
+        post2, is_new = Post.from_content(bot, "some content")
+        eq_(post, post2)
+        eq_(False, is_new)
+
+        # A different bot gets its own Post.
+        post3, is_new = Post.from_content(self._botmodel(), "some content")
+        assert post3 != post
+        eq_(True, is_new)
+
+        # reuse_existing=False always creates a new Post.
+        post4, is_new = Post.from_content(
+            bot, "some content", reuse_existing=False
+        )
+        assert post4 != post
+        eq_(post.content_hash, post4.content_hash)
+
+
+class TestPublication(DatabaseTest):
+
+    def test_retry_delay(self):
+        # The delay doubles with every attempt, with up to half of it
+        # random...
+        for attempts, delay in ((1, 60), (2, 120), (5, 960)):
+            for i in range(10):
+                actual = Publication.retry_delay(attempts)
+                assert delay / 2.0 <= actual <= delay
+
+        # ...up to a maximum.
+        assert Publication.retry_delay(50) <= Publication.MAX_RETRY_DELAY
+
+    def test_report_failure(self):
+        post = self._post(self._botmodel(), "content")
+        publication = Publication(post=post, service="service")
+        publication.report_failure("argh")
+        eq_(1, publication.attempts)
+        eq_(Publication.TRANSIENT, publication.error_class)
+        delay = publication.next_retry_at - publication.most_recent_attempt
+        assert 30 <= delay.total_seconds() <= 60
+        eq_(True, publication.needs_publishing)
+
+        # The next failure means a longer wait.
+        publication.report_failure("argh")
+        eq_(2, publication.attempts)
+        delay = publication.next_retry_at - publication.most_recent_attempt
+        assert 60 <= delay.total_seconds() <= 120
+
+        # Success clears the error and the retry.
+        publication.report_success("id")
+        eq_(3, publication.attempts)
+        eq_(None, publication.error)
+        eq_(None, publication.error_class)
+        eq_(None, publication.next_retry_at)
+        eq_(False, publication.needs_publishing)
+
+    def test_permanent_failure(self):
+        post = self._post(self._botmodel(), "content")
+        publication = Publication(post=post, service="service")
+        publication.report_failure("duplicate", permanent=True)
+        eq_(Publication.PERMANENT, publication.error_class)
+        eq_(None, publication.next_retry_at)
+        eq_(False, publication.needs_publishing)
+
+    def test_give_up_after_max_attempts(self):
+        post = self._post(self._botmodel(), "content")
+        publication = Publication(post=post, service="service")
+        for i in range(Publication.MAX_ATTEMPTS - 1):
+            publication.report_failure("argh")
+            assert publication.next_retry_at
+        publication.report_failure("argh")
+        eq_(Publication.TRANSIENT, publication.error_class)
+        eq_(None, publication.next_retry_at)
+        assert "gave up after 10 attempts" in publication.display()
+
+    def test_due_publications(self):
+        bot = self._botmodel()
+        now = _now()
+        def publication(content, next_retry_at):
+            post = self._post(bot, content)
+            publication = Publication(post=post, service="service")
+            publication.report_failure("argh")
+            publication.next_retry_at = next_retry_at
+            return publication
+        later = publication("later", now + datetime.timedelta(hours=1))
+        due = publication("due", now - datetime.timedelta(minutes=1))
+        overdue = publication("overdue", now - datetime.timedelta(hours=1))
+        gave_up = publication("gave up", None)
+        other_bot = publication("other bot", now - datetime.timedelta(hours=1))
+        other_bot.post.bot = self._botmodel()
+        self._db.flush()
+
+        eq_([overdue, due], bot.due_publications(now).all())
+        eq_([overdue, due, later],
+            bot.due_publications(now + datetime.timedelta(days=1)).all())
+
+    def test_stats(self):
+        bot = self._botmodel()
+        other = self._botmodel()
+        now = _now()
+        def publication(bot, content, duration, bytes_sent, error=None,
+                        service="service", attempted=now):
+            post = self._post(bot, content)
+            publication = Publication(post=post, service=service)
+            if error:
+                publication.report_failure(error)
+            else:
+                publication.report_success()
+            publication.most_recent_attempt = attempted
+            publication.report_cost(duration, 1, bytes_sent)
+            return publication
+        for i in range(10):
+            publication(bot, "post %d" % i, i, 100)
+        publication(bot, "failed", 20, 100, error="argh")
+        publication(other, "other service", 1, 50, service="other")
+        publication(bot, "too old", 100, 10000,
+                    attempted=now - datetime.timedelta(days=30))
+        self._db.flush()
+
+        since = now - datetime.timedelta(days=2)
+        by_service, by_bot = Publication.stats(self._db, since, now=now)
+        service = by_service['service']
+        eq_(11, service['publications'])
+        eq_(1/11.0, service['error_rate'])
+        eq_(5, service['p50'])
+        eq_(20, service['p95'])
+        eq_(550, service['bytes_per_day'])
+        eq_(1, by_service['other']['publications'])
+        eq_(set([bot.id, other.id]), set(by_bot))
+        eq_(11, by_bot[bot.id]['publications'])
+
+        # The stats can be restricted to certain bots.
+        by_service, by_bot = Publication.stats(
+            self._db, since, [other.id], now=now
+        )
+        eq_(['other'], list(by_service))
+        eq_([other.id], list(by_bot))
+
+
+class TestRateLimit(DatabaseTest):
+
+    def test_take(self):
+        # A new bucket starts out full.
+        for i in range(3):
+            eq_(None, RateLimit.take(self._db, "key", 3, 0.5, now=100))
+
+        # Once it's empty, we're told when the next token will show up.
+        eq_(datetime.datetime.utcfromtimestamp(102),
+            RateLimit.take(self._db, "key", 3, 0.5, now=100))
+
+        # A different key has its own bucket.
+        eq_(None, RateLimit.take(self._db, "other", 3, 0.5, now=100))
+
+        # The bucket refills over time...
+        eq_(None, RateLimit.take(self._db, "key", 3, 0.5, now=102))
+
+        # ...but never past its capacity.
+        for i in range(3):
+            eq_(None, RateLimit.take(self._db, "key", 3, 0.5, now=1000))
+        assert RateLimit.take(self._db, "key", 3, 0.5, now=1000)
+
+    def test_observe(self):
+        eq_(None, RateLimit.take(self._db, "key", 3, 0.5, now=100))
+
+        # If the service says we have no requests left, we don't make
+        # any more until the time it says the limit is reset, even if
+        # the bucket would otherwise have refilled.
+        RateLimit.observe(self._db, "key", 3, remaining=0, reset_at=200,
+                          now=100)
+        eq_(datetime.datetime.utcfromtimestamp(200),
+            RateLimit.take(self._db, "key", 3, 0.5, now=150))
+        eq_(None, RateLimit.take(self._db, "key", 3, 0.5, now=200))
+
+        # Observing a limit creates the bucket if necessary.
+        RateLimit.observe(self._db, "new", 3, remaining=1, now=100)
+        eq_(None, RateLimit.take(self._db, "new", 3, 0.5, now=100))
+        assert RateLimit.take(self._db, "new", 3, 0.5, now=100)
+
+        # No information, no change.
+        RateLimit.observe(self._db, "new", 3, remaining=None, now=100)
+        assert RateLimit.take(self._db, "new", 3, 0.5, now=100)
+
+
+class TestMediaUpload(DatabaseTest):
+
+    def test_record_and_lookup(self):
+        now = _now()
+        MediaUpload.record(self._db, "key", "a", 1, 3600, now=now)
+        MediaUpload.record(self._db, "key", "b", 2, 60, now=now)
+        MediaUpload.record(self._db, "other", "c", 3, 3600, now=now)
+
+        # Uploads are only found under the key they were made with,
+        # and not if they're about to expire.
+        eq_(dict(a="1"), MediaUpload.lookup(
+            self._db, "key", ["a", "b", "c", "d"], now=now
+        ))
+        eq_({}, MediaUpload.lookup(self._db, "key", [], now=now))
+
+        # Recording an upload again replaces the old one.
+        MediaUpload.record(self._db, "key", "b", 4, 3600, now=now)
+        eq_(dict(a="1", b="4"), MediaUpload.lookup(
+            self._db, "key", ["a", "b"], now=now
+        ))
+
+        # Expired uploads are cleaned up along with the ones we're
+        # told to forget.
+        later = now + datetime.timedelta(seconds=1800)
+        MediaUpload.record(self._db, "key", "b", 5, 60, now=later)
+        MediaUpload.forget(
+            self._db, "key", ["a"], now=later + datetime.timedelta(seconds=61)
+        )
+        eq_(0, self._db.query(MediaUpload).filter(
+            MediaUpload.key=="key").count())
+        eq_(1, self._db.query(MediaUpload).count())
+
+    def test_forget_family(self):
+        now = _now()
+        for key in ("key", "key:post-1", "key:post-2", "keyring", "other"):
+            MediaUpload.record(self._db, key, "a", 1, 60, now=now)
+        MediaUpload.record(self._db, "key:post-3", "a", 1, 3600, now=now)
+
+        # Cleaning up after one post also cleans up expired uploads
+        # for other posts made with the same credentials.
+        MediaUpload.forget(
+            self._db, "key:post-3", [], family="key",
+            now=now + datetime.timedelta(seconds=61)
+        )
+        eq_(["key:post-3", "keyring", "other"], sorted(
+            x.key for x in self._db.query(MediaUpload)
+        ))
+
+
+class TestCircuitBreaker(DatabaseTest):
+
+    def test_open_and_close(self):
+        breaker = CircuitBreaker.for_key(self._db, "service:endpoint")
+        eq_(CircuitBreaker.CLOSED, breaker.state)
+        now = _now()
+        eq_(None, breaker.allow(60, now))
+
+        # A couple of failures don't open the breaker...
+        breaker.record_failure(3, 60, now)
+        breaker.record_failure(3, 60, now)
+        eq_(CircuitBreaker.CLOSED, breaker.state)
+        eq_(None, breaker.allow(60, now))
+
+        # ...but a third one does.
+        breaker.record_failure(3, 60, now)
+        eq_(CircuitBreaker.OPEN, breaker.state)
+        retry_at = now + datetime.timedelta(seconds=60)
+        eq_(retry_at, breaker.retry_at)
+        eq_(retry_at, breaker.allow(60, now))
+
+        # Once it's time to try again, the breaker is half-open, and
+        # only one request is let through.
+        self._db.flush()
+        later = retry_at + datetime.timedelta(seconds=1)
+        eq_(None, breaker.allow(60, later))
+        eq_(CircuitBreaker.HALF_OPEN, breaker.state)
+        eq_(later + datetime.timedelta(seconds=60), breaker.allow(60, later))
+
+        # If that request fails, the breaker opens again right away.
+        breaker.record_failure(3, 60, later)
+        eq_(CircuitBreaker.OPEN, breaker.state)
+        eq_(4, breaker.failures)
+
+        # If it succeeds, the breaker is closed.
+        breaker.record_success()
+        eq_(CircuitBreaker.CLOSED, breaker.state)
+        eq_(0, breaker.failures)
+        eq_(None, breaker.allow(60, later))
+
+    def test_for_key(self):
+        breaker = CircuitBreaker.for_key(self._db, "key")
+        eq_(breaker, CircuitBreaker.for_key(self._db, "key"))
+        assert breaker != CircuitBreaker.for_key(self._db, "other key")
+
+
+class TestQueryPlans(DatabaseTest):
+    """Make sure the queries run on every tick are backed by indexes."""
+
+    def setup(self):
+        super(TestQueryPlans, self).setup()
+        self.bot = self._botmodel()
+        now = _now()
+        self._post(self.bot, "whenever")
+        self._post(self.bot, "scheduled", publish_at=now)
+        self._post(self.bot, "published", publish_at=now, published=True)
+        failed = self._post(self.bot, "failed", publish_at=now, published=True)
+        [publication] = failed.publications
+        publication.report_failure("argh")
+        self._db.flush()
+
+    def query_plans(self, run_queries):
+        """Run some queries and return the SQLite query plan for
+        each SELECT statement they executed.
+        """
+        statements = []
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append((statement, parameters))
+        event.listen(self.connection, "before_cursor_execute", capture)
+        try:
+            run_queries()
+        finally:
+            event.remove(self.connection, "before_cursor_execute", capture)
+        assert statements
+        plans = []
+        for statement, parameters in statements:
+            plan = self.connection.execute(
+                "EXPLAIN QUERY PLAN " + statement, parameters
+            )
+            plans.append((statement, [row[-1] for row in plan]))
+        return plans
+
+    def assert_no_table_scans(self, run_queries):
+        for statement, plan in self.query_plans(run_queries):
+            # Reading through the rows of a subquery is fine; it's
+            # the tables underneath that mustn't be scanned.
+            subqueries = set(
+                x.split()[1] for x in plan if x.startswith("CO-ROUTINE")
+            )
+            scans = [x for x in plan if x.startswith("SCAN")
+                     and x.split()[1] not in subqueries]
+            eq_([], scans, "Table scan in %s: %r" % (statement, plan))
+
+    def test_ready_scheduled_posts(self):
+        self.bot.next_post_time = None
+        self.assert_no_table_scans(lambda: self.bot.ready_scheduled_posts)
+
+    def test_scheduled(self):
+        self.assert_no_table_scans(lambda: self.bot.scheduled)
+
+    def test_recent_posts(self):
+        def run():
+            self.bot.recent_posts().all()
+            self.bot.recent_posts(published_after=2).all()
+            self.bot.recent_posts(require_success=False).all()
+        self.assert_no_table_scans(run)
+
+    def test_undeliverable_posts(self):
+        self.assert_no_table_scans(lambda: self.bot.undeliverable_posts.all())
+
+    def test_due_publications(self):
+        self.assert_no_table_scans(lambda: self.bot.due_publications().all())
+
+    def test_publication_stats(self):
+        since = _now() - datetime.timedelta(days=1)
+        for post in self.bot.posts:
+            for publication in post.publications:
+                publication.report_cost(1, 1, 100)
+        self._db.flush()
+        self.assert_no_table_scans(
+            lambda: Publication.stats(self._db, since)
+        )
+
+    def test_http_cache(self):
+        self.assert_no_table_scans(
+            lambda: HTTPCacheEntry.for_url(self._db, self.bot, "http://a/")
+        )
+
+    def test_media_uploads(self):
+        self.assert_no_table_scans(
+            lambda: MediaUpload.lookup(self._db, "key", ["a", "b"])
+        )
+
+    def test_undeliverable_posts_includes_deferred(self):
+        deferred = self._post(self.bot, "deferred", published=True)
+        [publication] = deferred.publications
+        publication.report_deferred(_now())
+        posts = [x.content for x in self.bot.undeliverable_posts]
+        eq_(set(["failed", "deferred"]), set(posts))
+
+    def test_from_content(self):
+        self.assert_no_table_scans(
+            lambda: Post.from_content(self.bot, "whenever")
+        )
@@ -0,0 +1,443 @@
+import ast
+import datetime
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from nose.tools import (
+    assert_raises,
+    eq_,
+    set_trace,
+)
+from benchmark.fleet import generate_fleet
+from benchmark.simulated import SimulatedPublisher
+from benchmark.startup import StartupBenchmarkScript
+from benchmark import stress
+from benchmark.throughput import FleetBenchmarkScript
+from bot import Publisher
+from model import (
+    Attachment,
+    BacklogItem,
+    BotModel,
+    _now,
+    Post,
+    production_session,
+    Publication,
+)
+from scripts import (
+    BacklogShowScript,
+    DaemonScript,
+    PostScript,
+    RepublicationScript,
+)
+
+
+class FleetTest(object):
+    """Runs scripts against a small generated fleet of bots, in its
+    own database.
+    """
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp(prefix="botfriend-test-")
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def fleet(self, **kwargs):
+        kwargs.setdefault('posts', 3)
+        kwargs.setdefault('backlog', 0)
+        kwargs.setdefault('scheduled', 0)
+        kwargs.setdefault('error_rate', 0)
+        return generate_fleet(self.directory, **kwargs)
+
+    def script(self, script_class, *argv):
+        argv = ['--config', self.directory] + list(argv)
+        return script_class(script_class.parser().parse_args(argv))
+
+
+class TestFleet(FleetTest):
+
+    def test_generate_fleet(self):
+        names = self.fleet(bots=2, backlog=2, scheduled=1, attachment_rate=1)
+        eq_(["fleet0000", "fleet0001"], names)
+
+        # Each bot has 3 published posts and 1 scheduled post, each
+        # with an attachment, and 2 backlog items.
+        script = self.script(PostScript)
+        _db = script.config._db
+        eq_(8, _db.query(Post).count())
+        eq_(6, _db.query(Publication).count())
+        eq_(8, _db.query(Attachment).count())
+        eq_(4, _db.query(BacklogItem).count())
+
+        # The bots publish through the simulated publisher.
+        bot = _db.query(BotModel).filter(BotModel.name==names[0]).one()
+        [publisher] = bot.implementation.publishers
+        assert isinstance(publisher, SimulatedPublisher)
+        eq_("simulated", publisher.service)
+        _db.close()
+
+    def test_simulated_publisher_is_not_a_real_publisher(self):
+        assert_raises(ImportError, Publisher._import_class, "simulated")
+
+
+class TestPostScript(FleetTest):
+
+    def test_state_refresh_timeout(self):
+        [name] = self.fleet(bots=1)
+        script = self.script(PostScript, '--state-refresh-timeout', '0.01')
+        _db = script.config._db
+        bot_model = _db.query(BotModel).filter(BotModel.name==name).one()
+
+        # This bot's state is about to expire, and refreshing it never
+        # finishes.
+        implementation = bot_model.implementation
+        release = threading.Event()
+        class HangingRefresh(type(implementation)):
+            def refresh_state(self, state, last_update):
+                release.wait()
+        implementation.__class__ = HangingRefresh
+        implementation.state_update_schedule = 60
+        implementation.state_update_lead = 10
+        bot_model.state = "old state"
+        bot_model.last_state_update_time = _now() - datetime.timedelta(
+            minutes=55
+        )
+
+        # The script doesn't wait for the refresh past its timeout.
+        script.process_bot(bot_model)
+        release.set()
+        eq_(False, implementation.state_refresh_in_progress)
+        _db.expire_all()
+        assert bot_model.state_refresh_error.startswith(
+            "Didn't finish within"
+        )
+        eq_("old state", bot_model.state)
+        _db.close()
+
+
+class TestBacklogShowScript(FleetTest):
+
+    def setup(self):
+        super(TestBacklogShowScript, self).setup()
+        self.fleet(bots=1, backlog=5)
+
+    def shown(self, *argv):
+        script = self.script(BacklogShowScript, *argv)
+        bot_model = script.config.bots[0]
+        messages = []
+        class Capture(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+        handler = Capture()
+        bot_model.log.addHandler(handler)
+        try:
+            script.process_bot(bot_model)
+        finally:
+            bot_model.log.removeHandler(handler)
+            script.config._db.close()
+        eq_("5 posts in backlog", messages[0])
+        return len(messages) - 1
+
+    def test_limit(self):
+        eq_(2, self.shown('--limit', '2'))
+        eq_(5, self.shown('--limit', '10'))
+
+    def test_no_limit(self):
+        # Leaving out --limit, or passing zero, shows everything.
+        eq_(5, self.shown())
+        eq_(5, self.shown('--limit', '0'))
+
+
+class TestRepublicationScript(FleetTest):
+
+    def test_exception_counts_as_failure(self):
+        [name] = self.fleet(bots=1)
+        script = self.script(RepublicationScript)
+        _db = script.config._db
+        bot_model = script.config.bots[0]
+        [publisher] = bot_model.implementation.publishers
+        class Broken(type(publisher)):
+            def publish(self, post, publication):
+                raise IOError("connection reset")
+        publisher.__class__ = Broken
+        publisher.circuit_breaker_threshold = 100
+
+        post = bot_model.posts[0]
+        [publication] = post.publications
+        publication.report_failure("Simulated failure")
+        before = publication.attempts
+        for attempt in range(before + 1, before + 4):
+            publication.next_retry_at = _now() - datetime.timedelta(
+                seconds=1
+            )
+            script.process_bot(bot_model)
+            eq_(attempt, publication.attempts)
+            eq_("Uncaught exception: connection reset", publication.error)
+            # Each failure pushes the next retry further out.
+            assert publication.next_retry_at > _now()
+        _db.close()
+
+
+class TestDaemon(FleetTest):
+
+    def test_idle_bot_is_backed_off(self):
+        [name] = self.fleet(bots=1)
+        script = self.script(
+            DaemonScript, '--min-interval', '10', '--max-interval', '100'
+        )
+        script.build_queue()
+        bot_model = script.config.bots[0]
+
+        # This bot is always ready to post, but never has anything
+        # to post.
+        implementation = bot_model.implementation
+        class IdleBot(type(implementation)):
+            def generate_text(self):
+                return None
+        implementation.__class__ = IdleBot
+
+        def process():
+            now = _now()
+            posted = script.process_bot_safely(bot_model)
+            script.schedule(
+                bot_model, now + datetime.timedelta(seconds=10), not posted
+            )
+            return (script.deadlines[name] - now).total_seconds()
+
+        # Each time it has nothing to do, the daemon waits twice as
+        # long before checking on it again, up to --max-interval.
+        for expect in (20, 40, 80, 100, 100):
+            wait = process()
+            assert expect <= wait < expect + 5, (expect, wait)
+
+        # Once it has something to post, it's checked as usual.
+        implementation.__class__ = IdleBot.__bases__[0]
+        bot_model.next_post_time = None
+        process()
+        eq_({}, script.idle_rounds)
+        script.config._db.close()
+
+    def test_due_publications_are_retried(self):
+        [name] = self.fleet(bots=1)
+        script = self.script(DaemonScript)
+        script.build_queue()
+        bot_model = script.config.bots[0]
+        bot_model.next_post_time = _now() + datetime.timedelta(hours=1)
+        [publication] = bot_model.posts[0].publications
+        publication.report_failure("Simulated failure")
+        retry_at = publication.next_retry_at
+        eq_(retry_at, bot_model.implementation.next_action_time)
+
+        publication.next_retry_at = _now() - datetime.timedelta(seconds=1)
+        eq_(1, script.process_bot_safely(bot_model))
+        eq_(None, publication.error)
+        eq_(None, publication.next_retry_at)
+        script.close_database()
+
+    def test_workers_are_rejected(self):
+        old_argv = sys.argv
+        sys.argv = ['botfriend.daemon', '--workers', '2']
+        try:
+            assert_raises(SystemExit, DaemonScript.run)
+        finally:
+            sys.argv = old_argv
+
+
+class TestStress(FleetTest):
+
+    def test_stress_test(self):
+        [name] = self.fleet(bots=1)
+        result = stress.stress_test(
+            self.directory, name, 10, workers=2, seed=1
+        )
+        eq_(10, result['rounds'])
+        eq_(2, result['workers'])
+        eq_(0, result['none_rate'])
+        eq_(0, result['duplicate_rate'])
+        latency = result['latency_ms']
+        assert 0 <= latency['p50'] <= latency['p99'] <= latency['max']
+        assert result['peak_rss_kb'] > 0
+        assert stress.describe(result)[0].startswith("10 rounds")
+
+
+class TestFleetBenchmark(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp(prefix="botfriend-test-")
+        self.baseline = os.path.join(self.directory, "baseline.json")
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def benchmark(self, *argv):
+        argv = [
+            '--bots', '2', '--posts', '3', '--backlog', '2',
+            '--latency', '0', '--baseline', self.baseline
+        ] + list(argv)
+        script = FleetBenchmarkScript(
+            FleetBenchmarkScript.parser().parse_args(argv)
+        )
+        return script.benchmark()
+
+    def test_benchmark(self):
+        # Record a baseline for every script.
+        eq_(0, self.benchmark('--update'))
+        baseline = json.load(open(self.baseline))
+        eq_(['backlog.load', 'dashboard', 'post', 'republish',
+             'scheduled.load', 'stats'], sorted(baseline['seconds']))
+
+        # A generous baseline is met.
+        for name in baseline['seconds']:
+            baseline['seconds'][name] = 1000
+        with open(self.baseline, 'w') as out:
+            json.dump(baseline, out)
+        eq_(0, self.benchmark())
+
+        # An impossible one isn't.
+        for name in baseline['seconds']:
+            baseline['seconds'][name] = 0
+        with open(self.baseline, 'w') as out:
+            json.dump(baseline, out)
+        eq_(1, self.benchmark())
+
+        # A baseline can't be compared against a different fleet.
+        eq_(1, self.benchmark('--bots', '1'))
+
+
+class TestWorkers(FleetTest):
+
+    def test_shards_share_a_database(self):
+        names = self.fleet(bots=4, latency=1)
+
+        # Publishing takes longer than a worker will wait for the
+        # database, so this only works if no worker holds on to the
+        # database while it publishes.
+        with open(os.path.join(self.directory, 'default.yaml'), 'w') as out:
+            out.write("storage:\n  busy_timeout: 200\n")
+        script = self.script(PostScript, '--workers', '2')
+        eq_(True, script.process_bots_in_workers())
+        script.config._db.close()
+
+        _db = production_session(os.path.join(self.directory, 'botfriend.sqlite'))
+        published = _db.query(Publication).filter(
+            Publication.attempts==1).filter(Publication.error==None)
+        # Every bot has its archive of 3 posts, and published one more.
+        eq_(len(names) * 4, published.count())
+        _db.close()
+
+
+class TestStartupBenchmark(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp(prefix="botfriend-test-")
+        self.budget = os.path.join(self.directory, "budget.json")
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def benchmark(self, *argv):
+        argv = ['--runs', '1', '--budget', self.budget] + list(argv)
+        script = StartupBenchmarkScript(
+            StartupBenchmarkScript.parser().parse_args(argv)
+        )
+        return script.benchmark()
+
+    def test_harness(self):
+        # Record a budget for one script.
+        eq_(0, self.benchmark('--update', 'post'))
+        budget = json.load(open(self.budget))
+        eq_(['post'], list(budget))
+        assert budget['post'] > 0
+
+        # A script that takes longer than its budget fails.
+        with open(self.budget, 'w') as out:
+            json.dump(dict(post=0), out)
+        eq_(1, self.benchmark('post'))
+
+    def test_heavy_imports(self):
+        output = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       100 |        100 | botfriend.model",
+            "import time:       100 |        100 |   requests.adapters",
+            "import time:       100 |        100 | tweepyish",
+        ])
+        eq_(["requests.adapters"], StartupBenchmarkScript.heavy_imports(output))
+
+    def test_heavy_import_fails_benchmark(self):
+        # Make a script that imports every heavy module (or a stand-in
+        # for it) as soon as it starts.
+        modules = os.path.join(self.directory, "modules")
+        bin_dir = os.path.join(self.directory, "bin")
+        os.makedirs(modules)
+        os.makedirs(bin_dir)
+        heavy = StartupBenchmarkScript.HEAVY_MODULES
+        for name in heavy:
+            open(os.path.join(modules, name + ".py"), 'w').close()
+        with open(os.path.join(bin_dir, "eager"), 'w') as out:
+            out.write("import sys\nsys.path.insert(0, %r)\n" % modules)
+            for name in heavy:
+                out.write("import %s\n" % name)
+
+        script = StartupBenchmarkScript(
+            StartupBenchmarkScript.parser().parse_args(
+                ['--runs', '1', '--budget', self.budget, 'eager']
+            )
+        )
+        script.BIN_DIR = bin_dir
+        eq_(sorted(heavy), script.heavy_imports(script.import_profile("eager")))
+
+        # Even a generous budget doesn't save it.
+        with open(self.budget, 'w') as out:
+            json.dump(dict(eager=100000), out)
+        eq_(1, script.benchmark())
+
+    def test_heavy_modules_include_service_clients(self):
+        # Every third-party module that the publishers and the HTTP
+        # client put off importing is on the list, so the check would
+        # notice if one started being imported right away.
+        paths = glob.glob(
+            os.path.join(StartupBenchmarkScript.package_dir, "publish", "*.py")
+        ) + [os.path.join(StartupBenchmarkScript.package_dir, "web.py")]
+        deferred = set()
+        for path in paths:
+            tree = ast.parse(open(path).read())
+            for function in ast.walk(tree):
+                if not isinstance(function, ast.FunctionDef):
+                    continue
+                for node in ast.walk(function):
+                    if isinstance(node, ast.Import):
+                        names = [x.name for x in node.names]
+                    elif isinstance(node, ast.ImportFrom) and not node.level:
+                        names = [node.module]
+                    else:
+                        continue
+                    deferred.update(x.split(".")[0] for x in names)
+        if hasattr(sys, 'stdlib_module_names'):
+            stdlib = set(sys.stdlib_module_names)
+        else:
+            # Before Python 3.10, list the standard modules a
+            # publisher might import when it needs them.
+            stdlib = set([
+                'base64', 'datetime', 'email', 'gzip', 'hashlib', 'http',
+                'io', 'json', 'mimetypes', 'os', 're', 'tempfile', 'time',
+                'urllib', 'xml', 'zlib',
+            ])
+        deferred -= stdlib
+        # Python 2's names for standard modules.
+        deferred -= set(['urlparse'])
+        deferred.discard("botfriend")
+        assert "pytumblr" in deferred
+        eq_(set(), deferred - set(StartupBenchmarkScript.HEAVY_MODULES))
+
+    def test_scripts_dont_import_heavy_modules(self):
+        script = StartupBenchmarkScript(
+            StartupBenchmarkScript.parser().parse_args([])
+        )
+        for name in script.scripts:
+            output = script.import_profile(name)
+            eq_([], script.heavy_imports(output), name)
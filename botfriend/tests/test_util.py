@@ -0,0 +1,28 @@
+from nose.tools import eq_
+from util import percentile
+
+class TestPercentile(object):
+
+    def test_empty(self):
+        eq_(None, percentile([], 0.5))
+
+    def test_even_length(self):
+        eq_(1, percentile([1, 2], 0.5))
+        eq_(2, percentile([1, 2], 0.95))
+        values = list(range(1, 11))
+        eq_(1, percentile(values, 0))
+        eq_(5, percentile(values, 0.5))
+        eq_(10, percentile(values, 0.95))
+        eq_(10, percentile(values, 0.99))
+        eq_(10, percentile(values, 1))
+
+    def test_odd_length(self):
+        eq_(7, percentile([7], 0.5))
+        values = [1, 2, 3]
+        eq_(1, percentile(values, 0.3))
+        eq_(2, percentile(values, 0.5))
+        eq_(3, percentile(values, 0.95))
+        values = list(range(1, 100))
+        eq_(50, percentile(values, 0.5))
+        eq_(95, percentile(values, 0.95))
+        eq_(99, percentile(values, 0.99))
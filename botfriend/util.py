@@ -1,7 +1,70 @@
+import math
+import os
 import sys
+import tempfile
+import time
 major, minor, release = sys.version_info[:3]
 def isstr(x):
     """Compatibility method equivalent to isinstance(x, basestring)"""
     if major == 2:
         return isinstance(x, basestring)
     return isinstance(x, bytes) or isinstance(x, str)
+
+# A clock for timing things. time.perf_counter is new in Python 3.3.
+timer = getattr(time, 'perf_counter', time.time)
+
+def percentile(values, fraction):
+    """Find a percentile of a list of numbers, using the nearest-rank
+    method.
+
+    :param values: A sorted list of numbers.
+    :param fraction: The percentile to find, as a number between 0 and 1.
+    """
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(fraction * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+if major == 2:
+    # os.replace is new in Python 3.3. On POSIX, os.rename also
+    # replaces an existing file atomically.
+    _replace = os.rename
+else:
+    _replace = os.replace
+
+def atomic_write(path, write):
+    """Replace the file at `path` all at once.
+
+    The new contents are written to a temporary file in the same
+    directory, which is then renamed over the old file, so readers
+    see either the old file or the new one, never part of either.
+
+    :param write: A function that takes a binary file object and
+        writes the new contents to it.
+    """
+    directory, filename = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix="." + filename + ".", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            write(out)
+            out.flush()
+            os.fsync(out.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp, os.stat(path).st_mode & 0o777)
+        else:
+            os.chmod(tmp, 0o644)
+        _replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def xml_generator(out):
+    """Make an XMLGenerator that writes UTF-8 to the binary file `out`.
+
+    Where Python supports it, empty elements are written as <tag/>.
+    """
+    from xml.sax.saxutils import XMLGenerator
+    if major == 2:
+        # short_empty_elements is new in Python 3.2.
+        return XMLGenerator(out, 'UTF-8')
+    return XMLGenerator(out, 'UTF-8', short_empty_elements=True)
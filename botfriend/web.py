@@ -0,0 +1,122 @@
+"""Make HTTP requests on behalf of bots.
+
+Every HTTPClient in a process sends its requests through one pool of
+connections, so bots that talk to the same site reuse each other's
+connections instead of opening a new one (and doing a new TLS
+handshake) for every request. Only the pool is shared: each client
+has its own `requests` session, so cookies one bot is given aren't
+sent along with another bot's requests. Each bot can also have its
+own User-Agent and timeouts:
+
+    http:
+      user_agent: "My bot (https://example.com/)"
+      timeout: [5, 30]    # Seconds to connect, seconds to read
+
+Responses compressed with gzip or deflate are decompressed
+transparently.
+"""
+import threading
+
+class HTTPClient(object):
+
+    USER_AGENT = "botfriend (+https://github.com/leonardr/botfriend/)"
+
+    # Give up on a server that takes longer than this many seconds to
+    # accept a connection, or to send any data once it's connected.
+    CONNECT_TIMEOUT = 5
+    READ_TIMEOUT = 30
+
+    # Keep connections open to this many different hosts...
+    POOL_HOSTS = 20
+
+    # ...and no more than this many connections to any one host.
+    # Beyond that, requests wait for a connection to become free.
+    POOL_CONNECTIONS_PER_HOST = 4
+
+    # The connection pool shared by every client in this process.
+    _adapter = None
+    _adapter_lock = threading.Lock()
+
+    def __init__(self, user_agent=None, timeout=None):
+        """
+        :param user_agent: Send this User-Agent instead of the default.
+        :param timeout: Either a number of seconds, used for both
+            connecting and reading, or a (connect, read) 2-tuple.
+        """
+        self.user_agent = user_agent or self.USER_AGENT
+        if timeout is None:
+            timeout = (self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+        elif isinstance(timeout, list):
+            timeout = tuple(timeout)
+        self.timeout = timeout
+        self._session = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a client from the `http` section of a bot's
+        configuration.
+        """
+        config = config or {}
+        return cls(config.get('user_agent'), config.get('timeout'))
+
+    @classmethod
+    def adapter(cls):
+        """Find or create the shared connection pool."""
+        with cls._adapter_lock:
+            if cls._adapter is None:
+                from requests.adapters import HTTPAdapter
+                cls._adapter = HTTPAdapter(
+                    pool_connections=cls.POOL_HOSTS,
+                    pool_maxsize=cls.POOL_CONNECTIONS_PER_HOST,
+                    pool_block=True,
+                )
+            return cls._adapter
+
+    def session(self):
+        """Find or create this client's session, which sends its
+        requests through the shared pool.
+        """
+        adapter = self.adapter()
+        session = self._session
+        if session is None or session.get_adapter("https://") is not adapter:
+            # Either this is the first request, or the pool has been
+            # closed and replaced since the last one.
+            import requests
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return session
+
+    @classmethod
+    def close(cls):
+        """Close every pooled connection."""
+        with cls._adapter_lock:
+            adapter = cls._adapter
+            cls._adapter = None
+        if adapter is not None:
+            adapter.close()
+
+    def request(self, method, url, headers=None, **kwargs):
+        """Make an HTTP request through this client's session.
+
+        Keyword arguments are passed along to `requests`.
+
+        :return: A `requests` Response.
+        """
+        request_headers = {'User-Agent': self.user_agent}
+        request_headers.update(headers or {})
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session().request(
+            method, url, headers=request_headers, **kwargs
+        )
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
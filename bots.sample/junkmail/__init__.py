@@ -1,6 +1,5 @@
 import json
 import random
-import requests
 
 from olipy.ia import Text
 from botfriend.bot import BasicBot
@@ -10,10 +9,11 @@ class JunkMailBot(BasicBot):
 
     COLLECTION = "tednelsonjunkmail"
 
-    def update_state(self):
-        cutoff = self.model.last_state_update_time
-        old_state = self.model.json_state or []
-        query = Text.recent("collection:%s" % self.COLLECTION, cutoff=cutoff)
+    def refresh_state(self, state, last_update):
+        # This may run in a worker thread, so it works from the state
+        # it's given rather than looking at self.model.
+        old_state = json.loads(state) if state else []
+        query = Text.recent("collection:%s" % self.COLLECTION, cutoff=last_update)
         new_items = [x.identifier for x in query]
         all_items = set(old_state + new_items)
         return list(all_items)
@@ -39,7 +39,7 @@ class JunkMailBot(BasicBot):
         # Attach the image.
         if not image_url:
             return None
-        response = requests.get(image_url)
+        response = self.http.get(image_url)
         media_type = response.headers['Content-Type']
         post.attach(media_type, content=response.content)
         return post
@@ -22,7 +22,7 @@ class PodcastBot(BasicBot):
             a += 1
             if a >= max_count:
                 break
-        self.model.json_state = choices
+        return choices
 
     def file(self, item, format_name):
         """Find a file in a specific format."""
@@ -1,7 +1,6 @@
 import random
 import re
 from olipy import corpora
-import requests
 from botfriend.bot import TextGeneratorBot
 
 class WebWords(TextGeneratorBot):
@@ -21,7 +20,7 @@ class WebWords(TextGeneratorBot):
             
             try:
                 self.log.info("Trying to get new state from %s" % url)
-                response = requests.get(url, timeout=5)
+                response = self.http.get(url, timeout=5)
                 potential_new_state = response.content
                 if len(potential_new_state) < 1024 * 10:
                     # This is probably a generic domain parking page.
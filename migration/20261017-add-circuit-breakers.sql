@@ -0,0 +1,11 @@
+-- Keep track of which services are failing, so bots can stop
+-- publishing to them until they recover.
+create table if not exists circuit_breakers (
+  id integer not null primary key,
+  key varchar not null,
+  state varchar not null,
+  failures integer not null,
+  opened_at datetime,
+  retry_at datetime
+);
+create unique index if not exists ix_circuit_breakers_key on circuit_breakers (key);
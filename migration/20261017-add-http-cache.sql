@@ -0,0 +1,13 @@
+-- Remember the validators (ETag and Last-Modified) sent with each
+-- document a bot scrapes, so it can ask for the document again only
+-- if it's changed.
+create table if not exists http_cache (
+  id integer not null primary key,
+  bot_id integer not null references bots(id),
+  url varchar not null,
+  etag varchar,
+  last_modified varchar,
+  digest varchar,
+  fetched datetime
+);
+create unique index if not exists ix_http_cache_bot_id_url on http_cache (bot_id, url);
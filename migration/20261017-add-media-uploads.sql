@@ -0,0 +1,11 @@
+-- Remember which files have been uploaded to each service, so the
+-- same file isn't uploaded again while the service still has it.
+create table if not exists media_uploads (
+  id integer not null primary key,
+  key varchar not null,
+  digest varchar not null,
+  media_id varchar not null,
+  uploaded datetime not null,
+  expires datetime not null
+);
+create unique index if not exists ix_media_uploads_key_digest on media_uploads (key, digest);
@@ -0,0 +1,3 @@
+-- Mark posts that were generated ahead of time and are waiting in a
+-- bot's buffer.
+alter table posts add column buffered boolean not null default 0;
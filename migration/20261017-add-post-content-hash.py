@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Add posts.content_hash and fill it in for every existing post.
+
+SQLite can't calculate the digest itself, so this migration is a
+Python script rather than a SQL file:
+
+$ python migration/20261017-add-post-content-hash.py bots/botfriend.sqlite
+"""
+import os
+import sqlite3
+import sys
+migration_dir = os.path.split(__file__)[0]
+package_dir = os.path.join(migration_dir, "..")
+sys.path.append(os.path.abspath(package_dir))
+from botfriend.model import content_digest
+
+if len(sys.argv) != 2:
+    print("Usage: %s [path to botfriend.sqlite]" % sys.argv[0])
+    sys.exit(1)
+
+db = sqlite3.connect(sys.argv[1])
+columns = [row[1] for row in db.execute("pragma table_info(posts)")]
+if 'content_hash' not in columns:
+    db.execute("alter table posts add column content_hash BLOB")
+db.execute(
+    "create index if not exists ix_posts_bot_id_content_hash on posts (bot_id, content_hash)"
+)
+
+# Work through the posts in batches so a large archive doesn't have to
+# fit in memory.
+batch_size = 1000
+last_id = 0
+updated = 0
+while True:
+    rows = db.execute(
+        "select id, content from posts where id > ? order by id limit ?",
+        (last_id, batch_size)
+    ).fetchall()
+    if not rows:
+        break
+    db.executemany(
+        "update posts set content_hash=? where id=?",
+        [(content_digest(content), id) for id, content in rows]
+    )
+    last_id = rows[-1][0]
+    updated += len(rows)
+db.commit()
+print("Calculated content hashes for %d posts." % updated)
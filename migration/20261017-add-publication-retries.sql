@@ -0,0 +1,11 @@
+-- Track how often each publication has been attempted and when it
+-- should next be retried. Publications that have already failed are
+-- treated as having failed once with a transient error, and are due
+-- to be retried immediately.
+alter table publications add column attempts integer not null default 0;
+alter table publications add column error_class varchar;
+update publications set attempts = 1 where most_recent_attempt is not null;
+update publications set error_class = 'transient',
+  next_retry_at = coalesce(next_retry_at, most_recent_attempt)
+  where error is not null;
+create index if not exists ix_publications_next_retry_at on publications (next_retry_at) where next_retry_at is not null;
@@ -0,0 +1,6 @@
+-- Record how long each publication attempt took and how much it
+-- sent, and index what bin/stats needs to summarize them.
+alter table publications add column duration float;
+alter table publications add column requests integer;
+alter table publications add column bytes_sent integer;
+create index if not exists ix_publications_most_recent_attempt_stats on publications (most_recent_attempt, service, post_id, duration, bytes_sent, error_class);
@@ -0,0 +1,11 @@
+-- Let a publication be deferred until a service's rate limit resets,
+-- and keep a token bucket for each set of service credentials.
+alter table publications add column next_retry_at datetime;
+create table if not exists rate_limits (
+  id integer not null primary key,
+  key varchar not null,
+  tokens float not null,
+  updated float not null,
+  blocked_until float
+);
+create unique index if not exists ix_rate_limits_key on rate_limits (key);
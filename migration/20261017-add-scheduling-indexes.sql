@@ -0,0 +1,8 @@
+-- Replace the single-column indexes on posts.bot_id and
+-- publications.post_id with composite indexes that cover the
+-- scheduling queries.
+drop index if exists ix_posts_bot_id;
+drop index if exists ix_publications_post_id;
+create index if not exists ix_posts_bot_id_publish_at_id on posts (bot_id, publish_at, id);
+create index if not exists ix_publications_post_id_error_most_recent_attempt on publications (post_id, error, most_recent_attempt);
+analyze;
@@ -0,0 +1,3 @@
+-- Record how the most recent background state refresh went.
+alter table bots add column state_refresh_seconds float;
+alter table bots add column state_refresh_error varchar;
@@ -0,0 +1,23 @@
+-- Move each bot's JSON backlog into the backlog_items table, one row
+-- per item, then clear out the old column.
+create table if not exists backlog_items (
+    id INTEGER NOT NULL,
+    bot_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    payload VARCHAR,
+    PRIMARY KEY (id),
+    FOREIGN KEY(bot_id) REFERENCES bots (id)
+);
+create unique index if not exists ix_backlog_items_bot_id_position on backlog_items (bot_id, position);
+
+insert into backlog_items (bot_id, position, payload)
+select bots.id, item.key,
+       -- json_each() turns true and false into 1 and 0, so use the
+       -- type to keep every item's JSON type.
+       case when item.type in ('object', 'array') then json(item.value)
+            when item.type in ('true', 'false', 'null') then item.type
+            else json_quote(item.value) end
+from bots, json_each(bots.backlog) as item
+where bots.backlog is not null and bots.backlog != '';
+
+update bots set backlog = null;
@@ -31,6 +31,7 @@ setuptools.setup(
             'botfriend.backlog.load = botfriend.scripts:BacklogLoadScript.run',
             'botfriend.backlog.show = botfriend.scripts:BacklogShowScript.run',
             'botfriend.bots = botfriend.scripts:BotListScript.run',
+            'botfriend.daemon = botfriend.scripts:DaemonScript.run',
             'botfriend.dashboard = botfriend.scripts:DashboardScript.run',
             'botfriend.post = botfriend.scripts:PostScript.run',
             'botfriend.republish = botfriend.scripts:RepublicationScript.run',
@@ -41,6 +42,7 @@ setuptools.setup(
             'botfriend.state.refresh = botfriend.scripts:StateRefreshScript.run',
             'botfriend.state.set = botfriend.scripts:StateSetScript.run',
             'botfriend.state.show = botfriend.scripts:StateShowScript.run',
+            'botfriend.stats = botfriend.scripts:StatsScript.run',
             'botfriend.test.publisher = botfriend.scripts:PublisherTestScript.run',
             'botfriend.test.stress = botfriend.scripts:StressTestScript.run',
         ]